@@ -1,10 +1,368 @@
-import os, sys, re, shelve, traceback, cPickle, types, itertools
-import bsddb.db
-import sqlalchemy
+import os, sys, re, shelve, traceback, cPickle, types, itertools, inspect
+import sqlite3, zlib, struct, cStringIO, hashlib, pickletools, time, collections, threading
+import socket, errno, shutil, weakref, mmap
+
+try:
+    import bsddb.db
+    SHELVE_OPEN_ERRORS = (bsddb.db.DBFileExistsError,)
+    SHELVE_ERRORS = (bsddb.db.DBPageNotFoundError, bsddb.db.DBAccessError)
+except ImportError:
+    # python built without bsddb, shelve will use another dbm
+    SHELVE_OPEN_ERRORS = ()
+    SHELVE_ERRORS = ()
 
 from SphinxReport.Component import *
 from SphinxReport import Utils
 
+# available storage backends for the cache
+BACKENDS = ("sqlite", "shelve")
+
+def getBackend():
+    '''return the cache backend configured by ``report_cache_backend``.'''
+    backend = Utils.PARAMS.get( "report_cache_backend", "sqlite" )
+    if backend not in BACKENDS:
+        raise ValueError( "unknown cache backend `%s`, expected one of %s" % (backend, str(BACKENDS)))
+    return backend
+
+# journal modes of sqlite databases
+JOURNAL_MODES = ("WAL", "DELETE", "TRUNCATE", "PERSIST")
+
+def getJournalMode():
+    '''return the journal mode of sqlite databases configured
+    by ``report_journal_mode``.
+
+    Write-ahead logging requires shared memory and does not work 
+    on network file systems.
+    '''
+    mode = str(Utils.PARAMS.get( "report_journal_mode", "WAL" )).upper()
+    if mode not in JOURNAL_MODES:
+        raise ValueError( "unknown journal mode `%s`, expected one of %s" % (mode, str(JOURNAL_MODES)))
+    return mode
+
+def isConcurrent():
+    '''return True if the configured cache backend permits
+    several processes to write to the same cache.'''
+    return getBackend() == "sqlite"
+
+def readArrayHeader( infile ):
+    '''read the header of an array in ``.npy`` format from *infile*.
+
+    returns a tuple of shape, fortran_order and dtype.
+    '''
+    import numpy.lib.format
+    version = numpy.lib.format.read_magic( infile )
+    if version == (1,0):
+        return numpy.lib.format.read_array_header_1_0( infile )
+    else:
+        return numpy.lib.format.read_array_header_2_0( infile )
+
+class Serializer( object ):
+    '''convert tracker results to strings and back.
+
+    numpy arrays within a result are stored in the binary ``.npy`` 
+    format. Everything else is pickled with the highest pickle protocol.
+    Serialized data larger than *compress_threshold* bytes are compressed 
+    with :mod:`zlib`. Set *compress_threshold* to 0 to disable compression.
+
+    If *array_dir* is given, arrays of at least *memmap_threshold* bytes 
+    are saved in separate ``.npy`` files in *array_dir*. These are
+    returned as read-only :class:`numpy.memmap` objects, so that 
+    several processes can share them without copying. Files are named 
+    by the digest of their contents and are never modified once 
+    written.
+
+    Each serialized string can carry a *stamp* identifying the code 
+    and data the result was computed from (see :func:`tracker2stamp`).
+
+    Strings not written by a :class:`Serializer` are unpickled 
+    for backwards compatibility.
+    '''
+
+    MAGIC = "SRC\x02"
+    # format without stamp
+    MAGIC_NOSTAMP = "SRC\x01"
+    PLAIN, COMPRESSED = "P", "Z"
+    # prefix of persistent ids of arrays stored in files
+    FILE = "F"
+
+    def __init__(self, 
+                 compress_threshold = 1048576, 
+                 compress_level = 6,
+                 array_dir = None,
+                 memmap_threshold = 16777216 ):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.array_dir = array_dir
+        self.memmap_threshold = memmap_threshold
+
+    def isMapped( self, array ):
+        '''return True if *array* is stored in a separate file.'''
+        return self.array_dir and self.memmap_threshold and array.nbytes >= self.memmap_threshold
+
+    def dumpArrayToFile( self, array ):
+        '''save *array* in ``.npy`` format in :attr:`array_dir`.
+
+        returns the filename.
+        '''
+        import numpy, numpy.lib.format
+        array = numpy.ascontiguousarray( array )
+        digest = hashlib.sha1( "%s%s" % (array.dtype.str, str(array.shape)) )
+        digest.update( array.data )
+        filename = digest.hexdigest() + ".npy"
+        fn = os.path.join( self.array_dir, filename )
+        if os.path.exists( fn ): 
+            # update modification time so that the file is not
+            # garbage collected as unused (see :func:`collectArrays`)
+            try:
+                os.utime( fn, None )
+                return filename
+            except OSError:
+                pass
+
+        try:
+            os.makedirs( self.array_dir )
+        except OSError:
+            pass
+
+        # write to temporary file and rename, so that other processes
+        # never see incomplete files.
+        tmpfn = "%s.%i.tmp" % (fn, os.getpid())
+        outfile = open( tmpfn, "wb" )
+        try:
+            numpy.lib.format.write_array( outfile, array )
+        finally:
+            outfile.close()
+        try:
+            os.rename( tmpfn, fn )
+        except OSError:
+            # file has been created by another process in the meantime
+            os.remove( tmpfn )
+        return filename
+
+    def loadArrayFromFile( self, filename ):
+        '''return array in *filename* as a read-only memory map.'''
+        if not self.array_dir:
+            raise IOError( "no directory for array `%s`" % filename )
+        import numpy
+        return numpy.load( os.path.join( self.array_dir, filename ), mmap_mode = "r" )
+
+    def isArray( self, obj ):
+        '''return True if *obj* is stored in ``.npy`` format.'''
+        if not Utils.isNumpyArray( obj ): return False
+        numpy = sys.modules["numpy"]
+        return type(obj) in (numpy.ndarray, numpy.memmap) and not obj.dtype.hasobject
+
+    def dumpArray( self, array ):
+        '''return *array* in ``.npy`` format.'''
+        import numpy.lib.format
+        outfile = cStringIO.StringIO()
+        numpy.lib.format.write_array( outfile, array )
+        return outfile.getvalue()
+
+    def loadArray( self, data, offset, length ):
+        '''return array in ``.npy`` format stored in the *length*
+        bytes from *offset* in *data*.
+
+        The array shares memory with *data*.
+        '''
+        import numpy
+        infile = cStringIO.StringIO( buffer( data, offset, length ) )
+        shape, fortran_order, dtype = readArrayHeader( infile )
+        count = int(numpy.multiply.reduce( shape ))
+        if count == 0: return numpy.empty( shape, dtype = dtype )
+        array = numpy.frombuffer( data, dtype = dtype, count = count, offset = offset + infile.tell() )
+        if fortran_order: return array.reshape( shape[::-1] ).transpose()
+        else: return array.reshape( shape )
+
+    def parseHeader( self, data ):
+        '''parse header of serialized *data*.
+
+        returns a tuple of stamp, format flag and offset of body. 
+        The flag is None if *data* has not been written by a 
+        :class:`Serializer`.
+        '''
+        if not isinstance( data, str ):
+            return None, None, 0
+        if data.startswith( self.MAGIC ):
+            offset = len(self.MAGIC)
+            length = struct.unpack_from( "<H", data, offset )[0]
+            offset += 2
+            stamp = data[offset:offset+length] or None
+            offset += length
+            return stamp, data[offset], offset + 1
+        elif data.startswith( self.MAGIC_NOSTAMP ):
+            offset = len(self.MAGIC_NOSTAMP)
+            return None, data[offset], offset + 1
+        return None, None, 0
+
+    def getStamp( self, data ):
+        '''return stamp of serialized *data*.'''
+        return self.parseHeader( data )[0]
+
+    def dumps( self, data, stamp = None, files = None ):
+        '''serialize *data* with an optional *stamp*.
+
+        If *files* is a list, the names of files in :attr:`array_dir`
+        that are referenced by the result are appended to it.
+        '''
+        arrays = []
+        def persistent_id( obj ):
+            if self.isArray( obj ):
+                if self.isMapped( obj ):
+                    filename = self.dumpArrayToFile( obj )
+                    if files != None: files.append( filename )
+                    return self.FILE + filename
+                arrays.append( self.dumpArray( obj ) )
+                return str(len(arrays) - 1)
+            return None
+
+        outfile = cStringIO.StringIO()
+        pickler = cPickle.Pickler( outfile, cPickle.HIGHEST_PROTOCOL )
+        pickler.persistent_id = persistent_id
+        pickler.dump( data )
+
+        body = [ struct.pack( "<I", len(arrays) ) ]
+        for array in arrays:
+            body.append( struct.pack( "<Q", len(array) ) )
+            body.append( array )
+        body.append( outfile.getvalue() )
+        body = "".join( body )
+
+        if stamp == None: stamp = ""
+        header = self.MAGIC + struct.pack( "<H", len(stamp) ) + stamp
+
+        if self.compress_threshold and len(body) > self.compress_threshold:
+            return header + self.COMPRESSED + zlib.compress( body, self.compress_level )
+        else:
+            return header + self.PLAIN + body
+
+    def getBody( self, data, offset, flag ):
+        '''return body of serialized *data* starting at *offset*.'''
+        body = data[offset:]
+        if flag == self.COMPRESSED:
+            body = zlib.decompress( body )
+        elif flag != self.PLAIN:
+            raise ValueError( "unknown format `%s` of cached data" % flag )
+        return body
+
+    def skipArrays( self, body ):
+        '''return offset of pickle in *body* after the embedded arrays.'''
+        narrays = struct.unpack_from( "<I", body, 0 )[0]
+        offset = 4
+        for x in range( narrays ):
+            offset += 8 + struct.unpack_from( "<Q", body, offset )[0]
+        return offset
+
+    def getArrayFiles( self, data ):
+        '''return the names of files in :attr:`array_dir` that 
+        are referenced by serialized *data*.
+
+        The pickle is scanned for persistent ids, no objects are
+        created.
+        '''
+        stamp, flag, offset = self.parseHeader( data )
+        if flag == None: return []
+        body = self.getBody( data, offset, flag )
+        files = []
+        last = None
+        for opcode, arg, pos in pickletools.genops( body[self.skipArrays( body ):] ):
+            if opcode.name in ("PERSID", "BINPERSID"):
+                if opcode.name == "PERSID": pid = arg
+                else: pid = last
+                if isinstance( pid, str ) and pid.startswith( self.FILE ):
+                    files.append( pid[len(self.FILE):] )
+            last = arg
+        return files
+
+    def loads( self, data ):
+        '''deserialize *data*.'''
+        if not isinstance( data, str ):
+            # objects stored by previous versions of the shelve backend
+            return data
+
+        stamp, flag, offset = self.parseHeader( data )
+        if flag == None:
+            return cPickle.loads( data )
+
+        # use a mutable buffer so that arrays are writeable
+        body = bytearray( self.getBody( data, offset, flag ) )
+
+        narrays = struct.unpack_from( "<I", body, 0 )[0]
+        offset = 4
+        arrays = []
+        for x in range( narrays ):
+            length = struct.unpack_from( "<Q", body, offset )[0]
+            offset += 8
+            arrays.append( self.loadArray( body, offset, length ) )
+            offset += length
+
+        def persistent_load( pid ):
+            if pid.startswith( self.FILE ):
+                return self.loadArrayFromFile( pid[len(self.FILE):] )
+            return arrays[int(pid)]
+
+        unpickler = cPickle.Unpickler( cStringIO.StringIO( buffer( body, offset ) ) )
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+def getTrackerCode( tracker ):
+    '''return the source code of *tracker*.
+
+    Only the code of the class or function is returned as 
+    in :func:`Utils.getCode`.
+    '''
+    if hasattr( tracker, "func_name" ):
+        name, obj = tracker.func_name, tracker
+    else:
+        name, obj = tracker.__class__.__name__, tracker.__class__
+
+    try:
+        pathname = inspect.getsourcefile( obj )
+    except TypeError:
+        return []
+    if not pathname or not os.path.exists( pathname ): 
+        return []
+    return Utils.getCode( name, pathname )
+
+# stamps of trackers computed during the current build
+_stamps = weakref.WeakKeyDictionary()
+
+def resetStamps():
+    '''forget the stamps computed so far.
+
+    Persistent workers call this at the start of each build.
+    '''
+    _stamps.clear()
+
+def tracker2stamp( tracker ):
+    '''derive a stamp for the cached data of *tracker*.
+
+    The stamp combines a hash of the tracker's code with the
+    optional fingerprint of its data sources returned by
+    :meth:`Tracker.getFingerprint`. Stamps are computed once
+    per tracker and build, see :func:`resetStamps`.
+    '''
+    try:
+        return _stamps[tracker]
+    except (KeyError, TypeError):
+        pass
+
+    stamp = hashlib.md5( "".join( getTrackerCode( tracker ) ) )
+
+    fingerprint = None
+    if hasattr( tracker, "getFingerprint" ):
+        fingerprint = tracker.getFingerprint()
+
+    if fingerprint is not None: stamp.update( str(fingerprint) )
+
+    stamp = stamp.hexdigest()
+    try:
+        _stamps[tracker] = stamp
+    except TypeError:
+        # tracker can not be weakly referenced
+        pass
+    return stamp
+
 def tracker2key( tracker ):
     '''derive cache filename from a tracker.'''
 
@@ -17,19 +375,678 @@ def tracker2key( tracker ):
 
     return Utils.quote_filename( ".".join((modulename,name)))
 
+# claims of processes on other hosts older than this number 
+# of seconds are considered stale
+CLAIM_TIMEOUT = 600
+# interval in seconds between checks for claims of other processes
+CLAIM_INTERVAL = 0.1
+
+# True if processes computing the same data share the caches
+_shared = False
+
+def setShared( shared = True ):
+    '''declare that several processes computing the same data
+    share the caches. Keys are only claimed in shared caches
+    (see :meth:`Cache.claim`).'''
+    global _shared
+    _shared = shared
+
+def isShared():
+    '''return True if caches are shared between processes.'''
+    return _shared
+
+def getOwner():
+    '''return the owner ("host:pid") of claims by this process.'''
+    return "%s:%i" % (socket.gethostname(), os.getpid())
+
+def isAlive( owner ):
+    '''return True if process *owner* ("host:pid") is alive.
+
+    Processes on other hosts are assumed to be alive.
+    '''
+    host, pid = owner.rsplit( ":", 1 )
+    if host != socket.gethostname(): return True
+    try:
+        os.kill( int(pid), 0 )
+    except OSError, msg:
+        return msg.errno != errno.ESRCH
+    return True
+
+# keys claimed by this process in each cache file
+_held = collections.defaultdict( set )
+_held_lock = threading.Lock()
+# process that runs the thread refreshing claims
+_refresher_pid = None
+
+def holdClaims( filename, keys ):
+    '''record that this process has claimed *keys* in *filename*.
+
+    A thread refreshes the time of the claims held by this process
+    every quarter of :data:`CLAIM_TIMEOUT`, so that processes on 
+    other hosts do not consider them stale while they are computed.
+    '''
+    global _refresher_pid
+    with _held_lock:
+        # a child process does not hold the claims of its parent
+        if _refresher_pid != os.getpid():
+            _held.clear()
+            _refresher_pid = os.getpid()
+            refresher = threading.Thread( target = refreshClaims )
+            refresher.daemon = True
+            refresher.start()
+        _held[filename].update( keys )
+
+def dropClaims( filename, keys ):
+    '''record that this process has released *keys* in *filename*.'''
+    with _held_lock:
+        _held[filename].difference_update( keys )
+        if not _held[filename]: del _held[filename]
+
+def refreshClaims():
+    '''refresh the claims held by this process periodically.'''
+    owner = getOwner()
+    while True:
+        time.sleep( CLAIM_TIMEOUT / 4.0 )
+        with _held_lock:
+            filenames = _held.keys()
+        for filename in filenames:
+            try:
+                db = sqlite3.connect( filename, timeout = 60 )
+                try:
+                    db.execute( "UPDATE claims SET time = ? WHERE owner = ?", (time.time(), owner) )
+                    db.commit()
+                finally:
+                    db.close()
+            except sqlite3.Error, msg:
+                warn( "could not refresh claims in %s: msg=%s" % (filename, msg) )
+
+class SQLiteStorage( object ):
+    '''dictionary-like storage of strings in an sqlite database.
+
+    By default, the database uses write-ahead logging so that several 
+    processes can read from and write to the same cache at the same 
+    time (see :func:`getJournalMode`). 
+    Writes are collected and committed in batches of *batch_size* 
+    items or when :meth:`sync` is called.
+
+    For each item, the size and the time of the last access are 
+    recorded for least-recently-used eviction. Access times of items 
+    that have been read are updated when :meth:`sync` is called. 
+    The storage also keeps a table of usage counters 
+    (see :meth:`addStats`) and a table of items that are being
+    computed (see :meth:`claim`).
+    '''
+
+    def __init__(self, filename, batch_size = 100, timeout = 60 ):
+
+        self.filename = filename
+        self.batch_size = batch_size
+        self._pending = {}
+        self._accessed = set()
+        self._stats = {}
+
+        self._db = sqlite3.connect( filename, timeout = timeout )
+        self._db.text_factory = str
+        try:
+            self._db.execute( "PRAGMA journal_mode=%s" % getJournalMode() )
+            self._db.execute( "PRAGMA synchronous=NORMAL" )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)" )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)" )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT, time REAL)" )
+            # add columns to caches created by previous versions
+            columns = [ x[1] for x in self._db.execute( "PRAGMA table_info(data)" ) ]
+            if "size" not in columns:
+                self._db.execute( "ALTER TABLE data ADD COLUMN size INTEGER" )
+                self._db.execute( "ALTER TABLE data ADD COLUMN atime REAL" )
+                self._db.execute( "UPDATE data SET size = length(value), atime = 0" )
+            self._db.commit()
+        except sqlite3.DatabaseError:
+            self._db.close()
+            raise
+
+    def keys( self ):
+        '''return keys in storage.'''
+        keys = [ x[0] for x in self._db.execute( "SELECT key FROM data" ) ]
+        stored = set(keys)
+        return keys + [ x for x in self._pending if x not in stored ]
+
+    def __contains__( self, key ):
+        if key in self._pending: return True
+        return self._db.execute( "SELECT 1 FROM data WHERE key = ?", (key,) ).fetchone() != None
+
+    def __getitem__( self, key ):
+        if key in self._pending: return self._pending[key][0]
+        row = self._db.execute( "SELECT value FROM data WHERE key = ?", (key,) ).fetchone()
+        if row == None: raise KeyError( key )
+        self._accessed.add( key )
+        return str(row[0])
+
+    def __setitem__( self, key, data ):
+        self.setItem( key, data, len(data) )
+
+    def setItem( self, key, data, size ):
+        '''store *data* under *key*. 
+
+        *size* is the number of bytes the item occupies on disk 
+        including any external files.
+        '''
+        self._pending[key] = (data, size)
+        if len(self._pending) >= self.batch_size: self.sync()
+
+    def __delitem__( self, key ):
+        self.removeItems( (key,) )
+
+    def removeItems( self, keys ):
+        '''remove items with *keys* from storage.'''
+        for key in keys: 
+            self._pending.pop( key, None )
+            self._accessed.discard( key )
+        self._db.executemany( "DELETE FROM data WHERE key = ?", [ (key,) for key in keys ] )
+        self._db.commit()
+
+    def claim( self, keys ):
+        '''claim *keys* for computation by this process in a 
+        single transaction.
+
+        Claims of processes that are no longer alive (see 
+        :meth:`isClaimed`) are taken over.
+
+        returns the set of claimed keys.
+        '''
+        owner, now = getOwner(), time.time()
+        claimed = set()
+        try:
+            for key in keys:
+                if self._db.execute( "INSERT OR IGNORE INTO claims (key, owner, time) VALUES (?,?,?)",
+                                     (key, owner, now) ).rowcount == 1:
+                    claimed.add( key )
+                elif not self.isClaimed( key ):
+                    self._db.execute( "UPDATE claims SET owner = ?, time = ? WHERE key = ?", 
+                                      (owner, now, key) )
+                    claimed.add( key )
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+        if claimed: holdClaims( self.filename, claimed )
+        return claimed
+
+    def isClaimed( self, key ):
+        '''return True if *key* is claimed by another process 
+        that is alive.
+
+        Claims of processes on other hosts can not be checked.
+        They are considered stale if they have not been refreshed 
+        for :data:`CLAIM_TIMEOUT` seconds.
+        '''
+        row = self._db.execute( "SELECT owner, time FROM claims WHERE key = ?", (key,) ).fetchone()
+        if row == None: return False
+        owner, t = row
+        if owner == getOwner(): return False
+        if owner.rsplit( ":", 1 )[0] == socket.gethostname(): return isAlive( owner )
+        return time.time() - t < CLAIM_TIMEOUT
+
+    def release( self, keys ):
+        '''write pending data and release the claims on *keys*
+        in a single transaction.'''
+        self._write()
+        self._db.executemany( "DELETE FROM claims WHERE key = ?", [ (key,) for key in keys ] )
+        self._db.commit()
+        dropClaims( self.filename, keys )
+
+    def releaseOwner( self, owner ):
+        '''release all claims of process *owner* ("host:pid").
+
+        returns the number of released claims.
+        '''
+        n = self._db.execute( "DELETE FROM claims WHERE owner = ?", (owner,) ).rowcount
+        self._db.commit()
+        return n
+
+    def addStats( self, counts ):
+        '''add *counts*, a dictionary of counter names and values, to
+        the usage counters. Counters are saved by :meth:`sync`.'''
+        for name, value in counts.iteritems():
+            self._stats[name] = self._stats.get( name, 0 ) + value
+
+    def getStats( self ):
+        '''return dictionary of usage counters.'''
+        stats = dict( self._db.execute( "SELECT name, value FROM stats" ).fetchall() )
+        for name, value in self._stats.iteritems():
+            stats[name] = stats.get( name, 0 ) + value
+        return stats
+
+    def getUsage( self ):
+        '''return tuple with number of items and their total size.'''
+        nitems, size = self._db.execute( "SELECT COUNT(*), SUM(size) FROM data" ).fetchone()
+        return nitems, size or 0
+
+    def getAccessTimes( self ):
+        '''return list of tuples (atime, size, key) of all items.'''
+        return self._db.execute( "SELECT atime, size, key FROM data" ).fetchall()
+
+    def vacuum( self ):
+        '''commit pending writes and reclaim unused space.'''
+        self.sync()
+        self._db.execute( "PRAGMA wal_checkpoint(TRUNCATE)" )
+        self._db.execute( "VACUUM" )
+
+    def sync( self ):
+        '''commit pending writes, access times and counters.'''
+        if self._write(): self._db.commit()
+
+    def _write( self ):
+        '''write pending data, access times and counters without
+        committing them.
+
+        returns False if there was nothing to write.
+        '''
+        if not (self._pending or self._accessed or self._stats): return False
+        now = time.time()
+        if self._pending:
+            self._db.executemany( "INSERT OR REPLACE INTO data (key, value, size, atime) VALUES (?,?,?,?)",
+                                  [ (key, sqlite3.Binary( data ), size, now) \
+                                        for key, (data, size) in self._pending.iteritems() ] )
+        if self._accessed:
+            self._db.executemany( "UPDATE data SET atime = ? WHERE key = ?",
+                                  [ (now, key) for key in self._accessed ] )
+        if self._stats:
+            self._db.executemany( "INSERT OR IGNORE INTO stats (name, value) VALUES (?,0)",
+                                  [ (name,) for name in self._stats ] )
+            self._db.executemany( "UPDATE stats SET value = value + ? WHERE name = ?",
+                                  [ (value, name) for name, value in self._stats.iteritems() ] )
+        self._pending = {}
+        self._accessed = set()
+        self._stats = {}
+        return True
+
+    def close( self ):
+        '''commit pending writes and close database.'''
+        try:
+            self.sync()
+        finally:
+            self._db.close()
+
+def isSQLiteCache( filename ):
+    '''return True if *filename* is a cache in an sqlite database.'''
+    if not os.path.isfile( filename ): return False
+    infile = open( filename, "rb" )
+    try:
+        return infile.read( 16 ) == "SQLite format 3\x00"
+    finally:
+        infile.close()
+
+def getCacheNames( cache_dir = None ):
+    '''return names of the sqlite caches in *cache_dir*.
+
+    If *cache_dir* is not given, ``report_cachedir`` is used.
+    '''
+    if cache_dir == None: cache_dir = Utils.PARAMS.get( "report_cachedir", None )
+    if not cache_dir or not os.path.isdir( cache_dir ): return []
+    return sorted( [ x for x in os.listdir( cache_dir ) \
+                         if not re.search( "-(wal|shm|journal)$", x ) and \
+                         isSQLiteCache( os.path.join( cache_dir, x ) ) ] )
+
+def releaseClaims( owner, cache_dir = None ):
+    '''release the claims of process *owner* ("host:pid") in 
+    all caches in *cache_dir*, for example after the process
+    has died on another host.
+
+    returns the number of released claims.
+    '''
+    if cache_dir == None: cache_dir = Utils.PARAMS.get( "report_cachedir", None )
+    n = 0
+    for cache_name in getCacheNames( cache_dir ):
+        storage = SQLiteStorage( os.path.join( cache_dir, cache_name ) )
+        try:
+            n += storage.releaseOwner( owner )
+        finally:
+            storage.close()
+    return n
+
+def getDiskUsage( cache_dir, cache_name ):
+    '''return the number of bytes used on disk by the cache *cache_name*
+    including write-ahead logs and array files.'''
+    filename = os.path.join( cache_dir, cache_name )
+    size = 0
+    for fn in (filename, filename + "-wal", filename + "-shm"):
+        if os.path.exists( fn ): size += os.path.getsize( fn )
+    for root, dirs, files in os.walk( filename + ".arrays" ):
+        for f in files:
+            size += os.path.getsize( os.path.join( root, f ) )
+    return size
+
+def collectArrays( cache_dir, cache_name, min_age = 3600 ):
+    '''remove array files of *cache_name* that are not referenced by
+    any item in the cache.
+
+    Only files older than *min_age* seconds are removed so that files
+    written by a concurrent process, whose items have not been 
+    committed yet, are kept.
+
+    returns a list of removed files.
+    '''
+    array_dir = os.path.join( cache_dir, cache_name + ".arrays" )
+    if not os.path.isdir( array_dir ): return []
+
+    serializer = Serializer()
+    storage = SQLiteStorage( os.path.join( cache_dir, cache_name ) )
+    referenced = set()
+    try:
+        for key in storage.keys():
+            referenced.update( serializer.getArrayFiles( storage[key] ) )
+    finally:
+        storage.close()
+
+    removed = []
+    now = time.time()
+    for filename in os.listdir( array_dir ):
+        if filename in referenced: continue
+        fn = os.path.join( array_dir, filename )
+        try:
+            if now - os.path.getmtime( fn ) < min_age: continue
+            os.remove( fn )
+            removed.append( fn )
+        except OSError:
+            pass
+    return removed
+
+def mergeCache( src_dir, dest_dir, cache_name ):
+    '''add entries of the cache *cache_name* in *src_dir* to the 
+    cache of the same name in *dest_dir*.
+
+    Existing entries are replaced. Usage counters are added and
+    array files are copied.
+
+    returns the number of entries merged.
+    '''
+    # open source to add columns missing in old caches
+    src = SQLiteStorage( os.path.join( src_dir, cache_name ) )
+    stats = src.getStats()
+    src.close()
+
+    dest = SQLiteStorage( os.path.join( dest_dir, cache_name ) )
+    try:
+        db = dest._db
+        db.execute( "ATTACH DATABASE ? AS src", (os.path.join( src_dir, cache_name ),) )
+        try:
+            n = db.execute( "INSERT OR REPLACE INTO data (key, value, size, atime) SELECT key, value, size, atime FROM src.data" ).rowcount
+            db.commit()
+        finally:
+            db.execute( "DETACH DATABASE src" )
+        dest.addStats( stats )
+    finally:
+        dest.close()
+
+    src_arrays = os.path.join( src_dir, cache_name + ".arrays" )
+    if os.path.isdir( src_arrays ):
+        dest_arrays = os.path.join( dest_dir, cache_name + ".arrays" )
+        if not os.path.isdir( dest_arrays ): os.makedirs( dest_arrays )
+        for filename in os.listdir( src_arrays ):
+            if filename.endswith( ".tmp" ): continue
+            fn = os.path.join( dest_arrays, filename )
+            # array files are named by their contents
+            if not os.path.exists( fn ):
+                shutil.copyfile( os.path.join( src_arrays, filename ), fn )
+    return n
+
+def evictCache( cache_dir = None, maxsize = None, fraction = 0.9 ):
+    '''evict least-recently-used items from the caches in *cache_dir*
+    until their total size is below *fraction* times *maxsize* bytes.
+
+    If *cache_dir* or *maxsize* are not given, ``report_cachedir`` and 
+    ``report_cache_maxsize`` are used. Nothing is evicted if the total 
+    size does not exceed *maxsize*.
+
+    returns the number of evicted items.
+    '''
+    if cache_dir == None: cache_dir = Utils.PARAMS.get( "report_cachedir", None )
+    if maxsize == None: maxsize = int(Utils.PARAMS.get( "report_cache_maxsize", 0 ))
+    if not maxsize: return 0
+
+    items = []
+    for cache_name in getCacheNames( cache_dir ):
+        storage = SQLiteStorage( os.path.join( cache_dir, cache_name ) )
+        try:
+            items.extend( [ (atime, size, cache_name, key) for atime, size, key in storage.getAccessTimes() ] )
+        finally:
+            storage.close()
+
+    total = sum( [ x[1] for x in items ] )
+    if total <= maxsize: return 0
+    
+    items.sort()
+    target = total - fraction * maxsize
+    evicted = collections.defaultdict( list )
+    for atime, size, cache_name, key in items:
+        if target <= 0: break
+        evicted[cache_name].append( key )
+        target -= size
+
+    nevicted = 0
+    for cache_name, keys in evicted.iteritems():
+        storage = SQLiteStorage( os.path.join( cache_dir, cache_name ) )
+        try:
+            storage.removeItems( keys )
+            storage.addStats( { "evicted" : len(keys) } )
+        finally:
+            storage.close()
+        collectArrays( cache_dir, cache_name )
+        debug( "evicted %i items from cache %s" % (len(keys), cache_name ))
+        nevicted += len(keys)
+
+    return nevicted
+
+def isMemoryMapped( array ):
+    '''return True if the data of *array* are mapped from a file.'''
+    import numpy
+    while array is not None:
+        if isinstance( array, (numpy.memmap, mmap.mmap) ): return True
+        array = getattr( array, "base", None )
+    return False
+
+def getSize( data ):
+    '''return approximate number of bytes used by *data*.
+
+    Memory maps only count their header, as their data are 
+    paged in from the file on demand and shared between processes.
+    '''
+    if Utils.isNumpyArray( data ):
+        if isMemoryMapped( data ): return sys.getsizeof( data )
+        return data.nbytes
+    elif isinstance( data, dict ):
+        return sys.getsizeof( data ) + \
+            sum( [ getSize( key ) + getSize( value ) for key, value in data.iteritems() ] )
+    elif isinstance( data, (list, tuple) ):
+        return sys.getsizeof( data ) + sum( [ getSize( value ) for value in data ] )
+    else:
+        return sys.getsizeof( data )
+
+def copyData( data ):
+    '''return a structural copy of *data*.
+
+    Dictionaries, lists and writeable arrays are copied so that
+    they can be modified without changing *data*. Read-only
+    arrays, such as memory maps, and immutable values are shared.
+    '''
+    if Utils.isNumpyArray( data ):
+        if data.flags.writeable: return data.copy()
+        return data
+    elif isinstance( data, dict ):
+        result = data.__class__()
+        for key, value in data.iteritems(): result[key] = copyData( value )
+        return result
+    elif isinstance( data, list ):
+        return [ copyData( value ) for value in data ]
+    elif isinstance( data, tuple ):
+        return tuple( [ copyData( value ) for value in data ] )
+    else:
+        return data
+
+class MemoryCache( object ):
+    '''in-memory cache of tracker results with least-recently-used
+    eviction.
+
+    The cache holds at most *maxsize* bytes of data as estimated by 
+    :func:`getSize`. Results are stored and returned as structural 
+    copies (see :func:`copyData`) so that callers can modify them.
+
+    Usage is counted in :attr:`stats`.
+    '''
+
+    def __init__(self, maxsize ):
+        self.maxsize = maxsize
+        self.size = 0
+        self._data = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+        self.stats = collections.defaultdict( int )
+
+    def __getitem__( self, key ):
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._data[key]
+            except KeyError:
+                self.stats["misses"] += 1
+                raise
+            self.stats["hits"] += 1
+            self._tick += 1
+            entry[0] = self._tick
+        finally:
+            self._lock.release()
+        return copyData( entry[2] )
+
+    def __setitem__( self, key, data ):
+        size = getSize( data )
+        # do not let a single result flush the whole cache
+        if size > self.maxsize / 2: return
+        data = copyData( data )
+        self._lock.acquire()
+        try:
+            if key in self._data: 
+                self.size -= self._data[key][1]
+            self._tick += 1
+            self._data[key] = [self._tick, size, data]
+            self.size += size
+            if self.size > self.maxsize: self.evict()
+        finally:
+            self._lock.release()
+
+    def __contains__( self, key ):
+        return key in self._data
+
+    def __len__( self ):
+        return len(self._data)
+
+    def evict( self, fraction = 0.9 ):
+        '''evict least recently used entries until the cache is below 
+        *fraction* times :attr:`maxsize`.'''
+        entries = sorted( [ (tick, key) for key, (tick, size, data) in self._data.iteritems() ] )
+        for tick, key in entries:
+            if self.size <= fraction * self.maxsize: break
+            self.size -= self._data.pop( key )[1]
+            self.stats["evicted"] += 1
+
+    def clear( self ):
+        '''remove all entries.'''
+        self._lock.acquire()
+        try:
+            self._data = {}
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def getStats( self ):
+        '''return dictionary with usage counters, number of entries
+        and memory used.'''
+        stats = dict( self.stats )
+        stats["entries"] = len(self._data)
+        stats["bytes"] = self.size
+        stats["maxsize"] = self.maxsize
+        return stats
+
+# the process-wide memory cache
+_memory_cache = None
+
+def getMemoryCache():
+    '''return the process-wide :class:`MemoryCache`.
+
+    The size is set by ``report_cache_memory_size``. Returns None
+    if the memory cache is disabled.
+    '''
+    global _memory_cache
+    maxsize = int(Utils.PARAMS.get( "report_cache_memory_size", 0 ))
+    if not maxsize: return None
+    if _memory_cache == None or _memory_cache.maxsize != maxsize:
+        _memory_cache = MemoryCache( maxsize )
+    return _memory_cache
+
+# fraction of ``report_cache_maxsize`` written by a process
+# before the size of the cache is checked
+CHECK_FRACTION = 0.05
+# bytes written to caches since the last size check
+_written = 0
+
 class Cache( Component ):
-    '''persistent storage for tracker results.'''
+    '''persistent storage for tracker results.
+
+    The storage backend is selected by the configuration 
+    variable ``report_cache_backend``: 
+
+    sqlite
+       an sqlite database, by default in write-ahead-logging 
+       mode (see ``report_journal_mode``). This is the default 
+       and permits several processes to read and write the same 
+       cache. Writes are committed in batches of
+       ``report_cache_batchsize`` items.
+    shelve
+       a python :mod:`shelve`. Only a single process can write
+       to the cache at a time.
+
+    Data are converted to strings by a :class:`Serializer`. Serialized 
+    data larger than ``report_cache_compress_threshold`` bytes are 
+    compressed. Arrays larger than ``report_cache_memmap_threshold`` 
+    bytes are stored in separate files in the directory :attr:`array_dir`
+    and are returned as read-only memory maps.
+
+    If *stamp* is given, each entry is saved with the stamp. Entries
+    with a different stamp are stale and treated as missing, so that 
+    they will be recomputed.
+
+    The cache counts hits, misses, stale entries and bytes read and
+    written in :attr:`stats`. With the sqlite backend, the counters
+    are accumulated in the cache file and the total size of all caches
+    in ``report_cachedir`` is limited to ``report_cache_maxsize`` bytes 
+    by evicting the least recently used entries (see :func:`evictCache`).
+    '''
 
-    def __init__(self, cache_name, mode = "a" ):
+    def __init__(self, cache_name, mode = "a", serializer = None, stamp = None ):
 
         self.cache_filename = None
         self._cache = None
         self.cache_name = cache_name 
+        self.stamp = stamp
+        self.backend = getBackend()
+        self.stats = collections.defaultdict( int )
         if "report_cachedir" in Utils.PARAMS:
             self.cache_dir = Utils.PARAMS["report_cachedir"]
         else:
             self.cache_dir = None
 
+        if self.cache_dir:
+            self.array_dir = os.path.join( self.cache_dir, cache_name + ".arrays" )
+        else:
+            self.array_dir = None
+
+        if serializer == None:
+            serializer = Serializer( compress_threshold = \
+                                         int(Utils.PARAMS.get( "report_cache_compress_threshold", 1048576 )),
+                                     array_dir = self.array_dir,
+                                     memmap_threshold = \
+                                         int(Utils.PARAMS.get( "report_cache_memmap_threshold", 16777216 )) )
+        self.serializer = serializer
+
         if self.cache_dir:
             
             try:
@@ -50,10 +1067,15 @@ class Cache( Component ):
                 
             # on Windows XP, the shelve does not work, work without cache
             try:
-                self._cache = shelve.open(self.cache_filename,"c", writeback = False)
-                debug( "disp%s: using cache %s" % (id(self), self.cache_filename ))
-                debug( "disp%s: keys in cache: %s" % (id(self,), str(self._cache.keys() ) ))                
-            except bsddb.db.DBFileExistsError, msg:    
+                if self.backend == "sqlite":
+                    self._cache = SQLiteStorage( self.cache_filename,
+                                                 batch_size = int(Utils.PARAMS.get( "report_cache_batchsize", 100 )) )
+                else:
+                    self._cache = shelve.open(self.cache_filename,"c", 
+                                              protocol = cPickle.HIGHEST_PROTOCOL,
+                                              writeback = False)
+                debug( "disp%s: using %s cache %s" % (id(self), self.backend, self.cache_filename ))
+            except SHELVE_OPEN_ERRORS + (sqlite3.DatabaseError,), msg:    
                 warn("disp%s: could not open cache %s - continuing without. Error = %s" %\
                      (id(self), self.cache_filename, msg))
                 self.cache_filename = None
@@ -62,13 +1084,101 @@ class Cache( Component ):
             debug( "disp%s: not using cache"% (id(self),) )
             
     def __del__(self):
+        self.close()
 
-        if self._cache != None: 
+    def close( self ):
+        '''write pending data and close the cache.'''
+        if self._cache == None: 
             return
         self.debug( "closing cache %s" % self.cache_filename )
-        self.debug( "keys in cache %s" % (str(self._cache.keys() ) ))
-        self._cache.close()
+        try:
+            self.saveStats()
+            self._cache.close()
+        except SHELVE_ERRORS + (sqlite3.Error,), msg:
+            self.warn( "could not close cache '%s': msg=%s" % (self.cache_filename, msg) )
         self._cache = None
+        self.checkSize()
+
+    def sync( self ):
+        '''write pending data to disk.'''
+        if self._cache == None: 
+            return
+        try:
+            self.saveStats()
+            self._cache.sync()
+        except SHELVE_ERRORS + (sqlite3.Error,), msg:
+            self.warn( "could not write to cache '%s': msg=%s" % (self.cache_filename, msg) )
+
+    def claim( self, keys ):
+        '''claim *keys* for computation.
+
+        If several processes share a cache (see :func:`setShared`), 
+        only the process that claimed a key computes it. Others wait 
+        for the result with :meth:`waitFor`. All keys are claimed 
+        in a single transaction.
+
+        returns the set of keys this process should compute. These
+        are all *keys* if the cache is not shared or if the storage 
+        does not support claims.
+        '''
+        keys = set( keys )
+        if self._cache == None or not isShared(): return keys
+        try:
+            return self._cache.claim( keys )
+        except AttributeError:
+            return keys
+        except sqlite3.Error, msg:
+            self.warn( "could not claim %i keys in '%s': msg=%s" % (len(keys), self.cache_filename, msg) )
+            return keys
+
+    def waitFor( self, key ):
+        '''wait until the claim of another process on *key* has 
+        been released.'''
+        try:
+            while self._cache.isClaimed( key ):
+                time.sleep( CLAIM_INTERVAL )
+        except sqlite3.Error, msg:
+            self.warn( "could not check claim on key '%s' in '%s': msg=%s" % (key, self.cache_filename, msg) )
+        self.stats["waits"] += 1
+
+    def release( self, keys ):
+        '''release claims on *keys* after saving their data.'''
+        if self._cache == None or not isShared() or not keys: return
+        try:
+            self.saveStats()
+            self._cache.release( keys )
+        except AttributeError:
+            pass
+        except sqlite3.Error, msg:
+            self.warn( "could not release %i keys in '%s': msg=%s" % (len(keys), self.cache_filename, msg) )
+
+    def saveStats( self ):
+        '''add counters in :attr:`stats` to the counters in the cache.'''
+        global _written
+        if not self.stats: return
+        _written += self.stats["bytes_written"]
+        try:
+            self._cache.addStats( self.stats )
+        except AttributeError:
+            # storage without counters
+            pass
+        self.stats = collections.defaultdict( int )
+
+    def checkSize( self ):
+        '''evict entries if the caches exceed ``report_cache_maxsize``.
+
+        For efficiency, the size is only checked after a fraction of
+        the permitted size has been written by this process.
+        '''
+        global _written
+        maxsize = int(Utils.PARAMS.get( "report_cache_maxsize", 0 ))
+        if not maxsize or self.backend != "sqlite" or not self.cache_dir: return
+        if _written < CHECK_FRACTION * maxsize: return
+        _written = 0
+        try:
+            evictCache( self.cache_dir, maxsize )
+        except (sqlite3.Error, OSError), msg:
+            self.warn( "could not evict entries from cache '%s': msg=%s" % (self.cache_dir, msg) )
 
     def keys( self):
         '''return keys in cache.'''
@@ -86,16 +1196,24 @@ class Cache( Component ):
 
         try:
             if key in self._cache: 
-                result = self._cache[key]
-                if result != None:
+                data = self._cache[key]
+                if self.stamp != None and self.serializer.getStamp( data ) != self.stamp:
+                    self.stats["stale"] += 1
+                    self.debug( "stale data for key '%s' in cache" % key )
+                    raise KeyError("cache contains stale data for %s" % str(key))
+                self.stats["hits"] += 1
+                self.stats["bytes_read"] += len(data)
+                result = self.serializer.loads( data )
+                if result is not None:
                     self.debug( "retrieved data for key '%s' from cache" % (key) )
                 else:
                     self.warn( "retrieved None data for key '%s' from cache" % (key ))
             else:
+                self.stats["misses"] += 1
                 self.debug( "key '%s' not found in cache" % key )
                 raise KeyError("cache does not contain %s" % str(key))
 
-        except (bsddb.db.DBPageNotFoundError, bsddb.db.DBAccessError, cPickle.UnpicklingError, ValueError, EOFError), msg:
+        except SHELVE_ERRORS + (sqlite3.Error, cPickle.UnpicklingError, zlib.error, struct.error, IOError, ValueError, EOFError), msg:
             self.warn( "could not get key '%s' or value for key in '%s': msg=%s" % (key,
                                                                                     self.cache_filename, 
                                                                                     msg) )
@@ -109,15 +1227,25 @@ class Cache( Component ):
 
         if self._cache != None:
             try:
-                self._cache[key] = data
+                files = []
+                data = self.serializer.dumps( data, self.stamp, files )
+                size = len(data)
+                for filename in files:
+                    size += os.path.getsize( os.path.join( self.array_dir, filename ) )
+                try:
+                    self._cache.setItem( key, data, size )
+                except AttributeError:
+                    self._cache[key] = data
+                self.stats["bytes_written"] += size
                 self.debug( "saved data for key '%s' in cache" % key )
-            except (bsddb.db.DBPageNotFoundError,bsddb.db.DBAccessError), msg:
+            except SHELVE_ERRORS + (sqlite3.Error, IOError, OSError), msg:
                 self.warn( "could not save key '%s' from '%s': msg=%s" % (key,
                                                                           self.cache_filename,
                                                                           msg) )
             # The following sync call is absolutely necessary when using 
             # the multiprocessing library (python 2.6.1). Otherwise the cache is emptied somewhere 
             # before the final call to close(). Even necessary, if writeback = False
-            self._cache.sync()
+            # The sqlite backend commits in batches and is synced by the Dispatcher.
+            if self.backend == "shelve": self.sync()
 
         
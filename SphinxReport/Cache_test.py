@@ -0,0 +1,225 @@
+'''tests of the persistent cache.
+
+The tests cover the serialization of results, several processes
+writing to the same cache, stale entries, eviction, the removal
+of unused array files and the merging of caches.
+
+Caches are created in a temporary directory.
+'''
+
+import os, sys, time, tempfile, shutil, unittest, multiprocessing, cPickle
+
+import numpy
+
+from SphinxReport import Cache, Utils
+from SphinxReport.odict import OrderedDict as odict
+
+def writeItems( cache_dir, prefix, n ):
+    '''write *n* items to the cache ``test`` in *cache_dir*.
+
+    The item ``shared`` is written by all processes.
+    '''
+    Utils.PARAMS["report_cachedir"] = cache_dir
+    cache = Cache.Cache( "test" )
+    for x in range( n ):
+        cache["%s%i" % (prefix, x)] = numpy.arange( x )
+        cache["shared"] = x
+    cache.close()
+
+class TestSerializer( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def checkArray( self, a, b ):
+        self.assertEqual( a.dtype, b.dtype )
+        self.assertEqual( a.shape, b.shape )
+        self.assertTrue( numpy.all( a == b ) )
+
+    def testRoundTrip( self ):
+        serializer = Cache.Serializer()
+        data = odict( [ ("b", [1, 2.5, None, "x"]),
+                        ("a", odict( [ ("float", numpy.arange( 10, dtype = numpy.float32 ) ),
+                                       ("fortran", numpy.asfortranarray( numpy.arange( 12 ).reshape( 3, 4 ) ) ),
+                                       ("empty", numpy.zeros( (0, 3) ) ),
+                                       ("objects", numpy.array( [ "a", None ], dtype = object ) ) ] ) ) ] )
+        result = serializer.loads( serializer.dumps( data, stamp = "abc" ) )
+        self.assertEqual( type(result), odict )
+        self.assertEqual( result.keys(), ["b", "a"] )
+        self.assertEqual( result["a"].keys(), ["float", "fortran", "empty", "objects"] )
+        self.assertEqual( result["b"], [1, 2.5, None, "x"] )
+        for key, value in data["a"].iteritems():
+            self.checkArray( result["a"][key], value )
+        self.assertTrue( result["a"]["fortran"].flags.f_contiguous )
+
+    def testStamp( self ):
+        serializer = Cache.Serializer()
+        self.assertEqual( serializer.getStamp( serializer.dumps( 1, stamp = "abc" ) ), "abc" )
+        self.assertEqual( serializer.getStamp( serializer.dumps( 1 ) ), None )
+
+    def testCompressed( self ):
+        serializer = Cache.Serializer( compress_threshold = 1 )
+        data = { "a" : numpy.zeros( 10000 ) }
+        s = serializer.dumps( data )
+        self.assertTrue( len(s) < data["a"].nbytes )
+        self.checkArray( serializer.loads( s )["a"], data["a"] )
+
+    def testPickle( self ):
+        # data written by previous versions
+        serializer = Cache.Serializer()
+        self.assertEqual( serializer.loads( cPickle.dumps( odict( [("a", 1)] ) ) ), odict( [("a", 1)] ) )
+
+    def testMemoryMap( self ):
+        serializer = Cache.Serializer( array_dir = self.tmpdir, memmap_threshold = 1024 )
+        data = odict( [ ("large", numpy.arange( 1000, dtype = numpy.float64 ) ),
+                        ("small", numpy.arange( 10 ) ) ] )
+        files = []
+        s = serializer.dumps( data, files = files )
+        self.assertEqual( len(files), 1 )
+        self.assertEqual( serializer.getArrayFiles( s ), files )
+        self.assertEqual( os.listdir( self.tmpdir ), files )
+
+        result = serializer.loads( s )
+        self.assertTrue( isinstance( result["large"], numpy.memmap ) )
+        self.assertTrue( Cache.isMemoryMapped( result["large"] ) )
+        self.assertFalse( result["large"].flags.writeable )
+        self.assertFalse( Cache.isMemoryMapped( result["small"] ) )
+        self.assertTrue( Cache.getSize( result["large"] ) < data["large"].nbytes )
+        for key, value in data.iteritems():
+            self.checkArray( result[key], value )
+
+        # identical arrays share a file
+        files2 = []
+        serializer.dumps( { "x" : data["large"].copy() }, files = files2 )
+        self.assertEqual( files2, files )
+        self.assertEqual( len( os.listdir( self.tmpdir ) ), 1 )
+
+class TestCache( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.params = Utils.PARAMS.copy()
+        Utils.PARAMS["report_cachedir"] = self.cache_dir = os.path.join( self.tmpdir, "cache" )
+
+    def tearDown( self ):
+        Utils.PARAMS.clear()
+        Utils.PARAMS.update( self.params )
+        shutil.rmtree( self.tmpdir )
+
+    def testStaleStamp( self ):
+        cache = Cache.Cache( "test", stamp = "a" )
+        cache["key"] = 1
+        cache.close()
+
+        cache = Cache.Cache( "test", stamp = "b" )
+        self.assertRaises( KeyError, cache.__getitem__, "key" )
+        self.assertEqual( cache.stats["stale"], 1 )
+        self.assertRaises( KeyError, cache.__getitem__, "missing" )
+        self.assertEqual( cache.stats["misses"], 1 )
+        cache.close()
+
+        cache = Cache.Cache( "test", stamp = "a" )
+        self.assertEqual( cache["key"], 1 )
+        cache.close()
+
+    def testConcurrentWriters( self ):
+        # commit often so that the writes of the processes interleave
+        Utils.PARAMS["report_cache_batchsize"] = 5
+        os.makedirs( self.cache_dir )
+        processes = [ multiprocessing.Process( target = writeItems, args = (self.cache_dir, prefix, 100) ) \
+                          for prefix in ("a", "b") ]
+        for process in processes: process.start()
+        for process in processes: process.join()
+        self.assertEqual( [ x.exitcode for x in processes ], [0, 0] )
+
+        cache = Cache.Cache( "test" )
+        self.assertEqual( len( cache.keys() ), 201 )
+        for prefix in ("a", "b"):
+            for x in range( 100 ):
+                self.assertTrue( numpy.all( cache["%s%i" % (prefix, x)] == numpy.arange( x ) ) )
+        self.assertEqual( cache["shared"], 99 )
+        cache.close()
+
+        storage = Cache.SQLiteStorage( os.path.join( self.cache_dir, "test" ) )
+        self.assertEqual( storage.getStats()["hits"], 201 )
+        storage.close()
+
+    def writeStorage( self, cache_name, keys, size ):
+        storage = Cache.SQLiteStorage( os.path.join( self.cache_dir, cache_name ) )
+        for key in keys: storage[key] = "x" * size
+        storage.close()
+
+    def testEvictCache( self ):
+        os.makedirs( self.cache_dir )
+        self.writeStorage( "old", ["a", "b"], 1000 )
+        time.sleep( 0.01 )
+        self.writeStorage( "new", ["c", "d"], 1000 )
+
+        # below the limit
+        self.assertEqual( Cache.evictCache( self.cache_dir, 4000 ), 0 )
+        # the least recently used items are evicted first
+        self.assertEqual( Cache.evictCache( self.cache_dir, 3000, fraction = 0.9 ), 2 )
+
+        storage = Cache.SQLiteStorage( os.path.join( self.cache_dir, "old" ) )
+        self.assertEqual( storage.keys(), [] )
+        self.assertEqual( storage.getStats()["evicted"], 2 )
+        storage.close()
+        storage = Cache.SQLiteStorage( os.path.join( self.cache_dir, "new" ) )
+        self.assertEqual( sorted( storage.keys() ), ["c", "d"] )
+        storage.close()
+
+    def testCollectArrays( self ):
+        Utils.PARAMS["report_cache_memmap_threshold"] = 1024
+        cache = Cache.Cache( "test" )
+        cache["a"] = numpy.arange( 1000 )
+        cache["b"] = numpy.arange( 2000 )
+        cache.close()
+        array_dir = os.path.join( self.cache_dir, "test.arrays" )
+        self.assertEqual( len( os.listdir( array_dir ) ), 2 )
+
+        storage = Cache.SQLiteStorage( os.path.join( self.cache_dir, "test" ) )
+        del storage["a"]
+        storage.close()
+
+        # recent files are kept
+        self.assertEqual( Cache.collectArrays( self.cache_dir, "test" ), [] )
+        removed = Cache.collectArrays( self.cache_dir, "test", min_age = 0 )
+        self.assertEqual( len(removed), 1 )
+        self.assertEqual( len( os.listdir( array_dir ) ), 1 )
+
+        cache = Cache.Cache( "test" )
+        self.assertTrue( numpy.all( cache["b"] == numpy.arange( 2000 ) ) )
+        cache.close()
+
+    def testMergeCache( self ):
+        Utils.PARAMS["report_cache_memmap_threshold"] = 1024
+        src_dir = os.path.join( self.tmpdir, "src" )
+        Utils.PARAMS["report_cachedir"] = src_dir
+        cache = Cache.Cache( "test" )
+        cache["a"] = "new"
+        cache["b"] = numpy.arange( 1000 )
+        cache.close()
+
+        Utils.PARAMS["report_cachedir"] = self.cache_dir
+        cache = Cache.Cache( "test" )
+        cache["a"] = "old"
+        cache["c"] = 3
+        cache.close()
+
+        self.assertEqual( Cache.mergeCache( src_dir, self.cache_dir, "test" ), 2 )
+
+        cache = Cache.Cache( "test" )
+        self.assertEqual( sorted( cache.keys() ), ["a", "b", "c"] )
+        self.assertEqual( cache["a"], "new" )
+        self.assertEqual( cache["c"], 3 )
+        self.assertTrue( numpy.all( cache["b"] == numpy.arange( 1000 ) ) )
+        cache.close()
+
+        self.assertEqual( os.listdir( os.path.join( self.cache_dir, "test.arrays" ) ),
+                          os.listdir( os.path.join( src_dir, "test.arrays" ) ) )
+
+if __name__ == "__main__":
+    unittest.main()
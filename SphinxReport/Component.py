@@ -2,19 +2,20 @@
 '''
 
 import os, sys
-import pkg_resources
 from logging import warn, log, debug, info, critical
 import logging
-import collections
-from docutils.parsers.rst import directives
+import collections, hashlib, cPickle
 
 LOGFILE = "sphinxreport.log"
 LOGGING_FORMAT='%(asctime)s %(levelname)s %(message)s'
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format= LOGGING_FORMAT,
-    stream = open( LOGFILE, "a" ) )
+# log to LOGFILE unless logging has been configured. The 
+# file is only opened when the first message is logged.
+if not logging.getLogger('').handlers:
+    _handler = logging.FileHandler( LOGFILE, "a", delay = True )
+    _handler.setFormatter( logging.Formatter( LOGGING_FORMAT ) )
+    logging.getLogger('').addHandler( _handler )
+    logging.getLogger('').setLevel( logging.DEBUG )
 
 class Component(object):
     '''base class for SphinxReport components.
@@ -41,28 +42,155 @@ plugins = None
 options = None
 ENTRYPOINT = 'SphinxReport.plugins'
 
+# file with the cached plugin registry
+PLUGINSFILE = "sphinxreport.plugins"
+
+class PluginMap( dict ):
+    '''map of plugin names to plugin classes.
+
+    Plugins are loaded from their distribution when they are first
+    requested. Until then, the map contains the distribution and
+    the options of the plugin.
+    '''
+
+    def __init__(self, pkg_env ):
+        dict.__init__(self)
+        self.pkg_env = pkg_env
+        self.mOptions = {}
+
+    def addPlugin( self, name, project, options ):
+        '''add plugin *name* from distribution *project* with *options*
+        without loading it.'''
+        dict.__setitem__( self, name, (project,) )
+        self.mOptions[name] = options
+
+    def __getitem__( self, name ):
+        value = dict.__getitem__( self, name )
+        if type(value) == tuple:
+            debug( "loading plugin %s" % name )
+            egg = self.pkg_env[value[0]][0]
+            egg.activate()
+            value = egg.get_entry_info( ENTRYPOINT, name ).load()
+            dict.__setitem__( self, name, value )
+        return value
+
+    def get( self, name, default = None ):
+        if name in self: return self[name]
+        return default
+
+    def values( self ): return [ self[x] for x in self.keys() ]
+    def itervalues( self ): return iter( self.values() )
+    def items( self ): return [ (x, self[x]) for x in self.keys() ]
+    def iteritems( self ): return iter( self.items() )
+
+    def getOptions( self, name ):
+        '''return options of plugin *name* without loading it if possible.'''
+        try:
+            options = self.mOptions[name]
+        except KeyError:
+            options = None
+        if options == None:
+            options = getattr( self[name], "options", () )
+        return options
+
+def getEnvironmentKey( pkg_env ):
+    '''return a key for the distributions in *pkg_env*.'''
+    dists = []
+    for name in pkg_env:
+        egg = pkg_env[name][0]
+        dists.append( "%s %s %s" % (egg.project_name, egg.version, egg.location) )
+    return hashlib.md5( "\n".join( [ENTRYPOINT] + sorted(dists) ) ).hexdigest()
+
+def loadPluginRegistry( key, filename = PLUGINSFILE ):
+    '''return cached plugin registry in *filename* if it has been 
+    saved for the environment *key*.
+
+    The registry is a dictionary mapping capabilities to dictionaries
+    mapping plugin names to tuples of distribution and options.
+    '''
+    try:
+        infile = open( filename, "rb" )
+    except IOError:
+        return None
+    try:
+        try:
+            cached_key, registry = cPickle.load( infile )
+        except Exception, msg:
+            warn( "could not read plugin registry from %s: %s" % (filename, msg) )
+            return None
+    finally:
+        infile.close()
+    if cached_key != key: return None
+    return registry
+
+def savePluginRegistry( key, registry, filename = PLUGINSFILE ):
+    '''save plugin *registry* for environment *key* in *filename*.'''
+    tmpfile = "%s.%i" % (filename, os.getpid())
+    try:
+        outfile = open( tmpfile, "wb" )
+        try:
+            cPickle.dump( (key, registry), outfile, cPickle.HIGHEST_PROTOCOL )
+        finally:
+            outfile.close()
+        os.rename( tmpfile, filename )
+    except (IOError, OSError, cPickle.PicklingError), msg:
+        warn( "could not save plugin registry to %s: %s" % (filename, msg) )
+        if os.path.exists( tmpfile ): os.remove( tmpfile )
+
+def getPickledOptions( cls ):
+    '''return options of *cls* if they can be cached, otherwise None.'''
+    options = tuple( getattr( cls, "options", () ) )
+    try:
+        cPickle.dumps( options, cPickle.HIGHEST_PROTOCOL )
+    except (cPickle.PicklingError, TypeError, AttributeError):
+        return None
+    return options
+
 def init_plugins():
+    '''find plugins.
 
+    The plugins found are cached for the installed distributions
+    in :data:`PLUGINSFILE`. If the cache is current, plugins are
+    only loaded when they are first requested.
+    '''
     info( "initialising plugins" )
+    import pkg_resources
     try:
         pkg_resources.working_set.add_entry(sphinxreport_plugins)
         pkg_env = pkg_resources.Environment(sphinxreport_plugins)
     except NameError:
         pkg_env = pkg_resources.Environment()
         
-    plugins = collections.defaultdict( dict )
-    for name in pkg_env:
-        egg = pkg_env[name][0]
-        egg.activate()
-        modules = []
-        for name in egg.get_entry_map(ENTRYPOINT):
-            entry_point = egg.get_entry_info(ENTRYPOINT, name)
-            cls = entry_point.load()
-            if not hasattr(cls, 'capabilities'):
-                cls.capabilities = []
-                
-            for c in cls.capabilities:
-                plugins[c][name] = cls
+    key = getEnvironmentKey( pkg_env )
+    registry = loadPluginRegistry( key )
+
+    if registry == None:
+        registry = collections.defaultdict( dict )
+        loaded = {}
+        for project in pkg_env:
+            egg = pkg_env[project][0]
+            egg.activate()
+            for name in egg.get_entry_map(ENTRYPOINT):
+                entry_point = egg.get_entry_info(ENTRYPOINT, name)
+                cls = entry_point.load()
+                if not hasattr(cls, 'capabilities'):
+                    cls.capabilities = []
+
+                for c in cls.capabilities:
+                    registry[c][name] = (project, getPickledOptions( cls ) )
+                loaded[name] = cls
+        registry = dict( registry )
+        savePluginRegistry( key, registry )
+    else:
+        loaded = {}
+
+    plugins = collections.defaultdict( lambda: PluginMap( pkg_env ) )
+    for c, entries in registry.iteritems():
+        for name, (project, options) in entries.iteritems():
+            plugins[c].addPlugin( name, project, options )
+            # keep plugins that have been loaded already
+            if name in loaded: dict.__setitem__( plugins[c], name, loaded[name] )
+
     if len(plugins) == 0:
         warn("did not find any plugins")
     else:
@@ -89,14 +217,13 @@ def getOptionMap():
     global options
 
     if options == None:
+        from docutils.parsers.rst import directives
         options = {}
         for section, plugins in getPlugins().iteritems():
             options[section] = {}
-            for name, cls in plugins.iteritems():
-                try:
-                    options[section].update( dict( cls.options) )
-                except AttributeError:
-                    pass
+            # use cached options, plugins are not loaded
+            for name in plugins.keys():
+                options[section].update( dict( plugins.getOptions( name ) ) )
         options["dispatch"] = {
             'groupby': directives.unchanged,
             'tracker': directives.unchanged,
@@ -104,6 +231,7 @@ def getOptionMap():
             'slices': directives.unchanged,
             'layout': directives.unchanged,
             'nocache': directives.flag,
+            'parallel': directives.unchanged,
             }
 
         options["display"]  = {
@@ -125,6 +253,7 @@ def getOptionSpec():
     
     This method returns a flattened :var:`options`.
     '''
+    from docutils.parsers.rst import directives
     o = getOptionMap()
     r = {}
     for x, xx in o.iteritems(): r.update( xx )
@@ -1,4 +1,4 @@
-import collections, itertools
+import collections, itertools, types
 from logging import warn, log, debug, info
 
 from SphinxReport.odict import OrderedDict as odict
@@ -337,6 +337,67 @@ def removeEmptyLeaves( work ):
         # for numpy arrays
         return len(work) > 0
 
+def isStream( work ):
+    '''return True if *work* is a stream.
+
+    A stream is a generator that yields batches of rows, each
+    batch a dictionary of columns, for example from 
+    :meth:`Tracker.TrackerSQL.getBatches`.
+    '''
+    return isinstance( work, types.GeneratorType )
+
+def getStreams( work, path = () ):
+    '''return the streams in *work*.
+
+    returns a tuple of a list of (path, stream) tuples and
+    a flag that is True if *work* contains leaves that are
+    not streams.
+    '''
+    if isStream( work ): return [ (path, work) ], False
+    if not hasattr( work, "keys" ): return [], True
+
+    streams, has_leaves = [], False
+    for label, w in work.iteritems():
+        s, l = getStreams( w, path + (label,) )
+        streams.extend( s )
+        has_leaves = has_leaves or l
+    return streams, has_leaves
+
+def concatenateBatches( batches ):
+    '''read all *batches* of a stream.
+
+    Columns that are numeric arrays in all batches are 
+    concatenated into a numpy array, other columns into
+    a tuple.
+
+    returns a dictionary of columns. The dictionary is
+    empty if there are no batches.
+    '''
+    columns = odict()
+    for batch in batches:
+        for header, values in batch.iteritems():
+            columns.setdefault( header, [] ).append( values )
+
+    import numpy
+    result = odict()
+    for header, b in columns.iteritems():
+        if all( [ Utils.isNumericArray( x ) for x in b ] ):
+            result[header] = numpy.concatenate( b )
+        else:
+            values = []
+            for x in b:
+                if isinstance( x, numpy.ndarray ): values.extend( x.tolist() )
+                else: values.extend( x )
+            result[header] = tuple( values )
+    return result
+
+def concatenateStreams( work ):
+    '''replace all streams in *work* with the concatenated batches.'''
+    streams, has_leaves = getStreams( work )
+    for path, stream in streams:
+        setLeaf( work, path, concatenateBatches( stream ) )
+    return work
+
 def prettyprint(work):
     paths = work.getPaths()
     if len(paths) == 0: return "NA"
@@ -363,7 +424,7 @@ def count_levels( labels ):
     '''count number of levels for each level in labels'''
     counts = []
     for x in labels:
-        if type( x[0] ) in Utils.ContainerTypes:
+        if type( x[0] ) in Utils.getContainerTypes():
             counts.append( len(x[0]) )
         else:
             counts.append( 1 )
@@ -421,7 +482,7 @@ def tree2table( data, transpose = False ):
 
             # add row header only for first row (if there are sub-rows)
             if first: 
-                if type(row) in Utils.ContainerTypes:
+                if type(row) in Utils.getContainerTypes():
                     row_headers.append( row[0] )
                     for z, p in enumerate( row[1:] ):
                         row_data[z] = p
@@ -440,7 +501,7 @@ def tree2table( data, transpose = False ):
             max_rows = None
             for y, column in enumerate(labels[-1]):
                 if column not in work: continue
-                if type(work[column]) not in Utils.ContainerTypes:
+                if type(work[column]) not in Utils.getContainerTypes():
                     is_container = False
                     break
                 if max_rows == None:
@@ -0,0 +1,199 @@
+'''index of report directives in restructured text files.
+
+The index records for each restructured text file the
+:term:`report` directives it contains together with the
+modification time and size of the file. Files that have
+not changed since they were indexed are not parsed again.
+
+The index is stored in an sqlite database and shared by
+all phases of a build and by :mod:`clean`. Files are indexed
+by their absolute path.
+'''
+
+import os, re, sqlite3, cPickle
+
+from SphinxReport.Component import *
+
+# database with the index
+INDEXFILE = "sphinxreport.index"
+
+class ReportBlock:
+    '''quick and dirty parsing of rst of a report block.'''
+    def __init__(self):
+        self.mLines = []
+        self.mOptions = {}
+        self.mArguments = None
+        self.mCaption = []
+
+    def append(self,v):
+        s = v.strip()
+        if s.startswith( ".. report::" ):
+            self.mArguments = re.match( ".. report::\s+(\S+)", s ).groups()
+        else:
+            s = re.match( ":(\S+):\s*(\S*)", v.strip())
+            if s:
+                key, value = s.groups()
+                self.mOptions[key] = value
+            else:
+                self.mCaption.append( v )
+        self.mLines.append( v )
+
+def rst_reader(infile ):
+    """parse infile and extract the :render: block."""
+
+    result = None
+    keep = 0
+    lineno = 0
+    for line in infile:
+        lineno += 1
+        if line.startswith( ".. report::" ):
+            if result: yield lineno, result
+            keep = True
+            result = ReportBlock()
+            result.append( line )
+        else:
+            if keep:
+                if re.match( "^\S", line ):
+                    keep = False
+                else:
+                    result.append( line )
+
+    if result: yield lineno, result
+
+def getStat( filename ):
+    '''return modification time and size of *filename*.'''
+    try:
+        st = os.stat( filename )
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+def parseFile( filename ):
+    '''return the report directives in *filename* as a list
+    of tuples of line number and :class:`ReportBlock`.
+
+    Also returns the stat of the file before it was read.
+    '''
+    stat = getStat( filename )
+    blocks = []
+    try:
+        infile = open( filename, "r" )
+    except IOError:
+        print "could not open %s - skipped" % filename
+        return stat, blocks
+
+    for lineno, rst_block in rst_reader( infile ):
+        blocks.append( (lineno, rst_block) )
+    infile.close()
+    return stat, blocks
+
+class DirectiveIndex( Component ):
+    '''index of report directives in an sqlite database.
+    '''
+
+    def __init__(self, filename = INDEXFILE ):
+        Component.__init__(self)
+        self.filename = filename
+        # directives of files read from the index
+        self._files = {}
+        self._db = sqlite3.connect( filename, timeout = 60 )
+        self._db.text_factory = str
+        self._db.execute( '''CREATE TABLE IF NOT EXISTS files (
+                             filename TEXT PRIMARY KEY,
+                             mtime REAL,
+                             size INTEGER,
+                             blocks BLOB)''' )
+        self._db.commit()
+        for filename, mtime, size, blocks in self._db.execute( "SELECT * FROM files" ):
+            self._files[filename] = ((mtime, size), blocks)
+
+    def _store( self, filename, stat, blocks ):
+        '''store *blocks* of *filename*.'''
+        data = sqlite3.Binary( cPickle.dumps( blocks, cPickle.HIGHEST_PROTOCOL ) )
+        self._files[filename] = (stat, blocks)
+        if stat == None:
+            self._db.execute( "DELETE FROM files WHERE filename = ?", (filename,) )
+        else:
+            self._db.execute( "INSERT OR REPLACE INTO files VALUES (?,?,?,?)",
+                              (filename, stat[0], stat[1], data) )
+
+    def update( self, rst_files, num_jobs = 1, prune = False ):
+        '''index *rst_files*.
+
+        Files that have changed are parsed, in parallel if *num_jobs* is
+        larger than 1. If *prune* is set, *rst_files* are all files
+        of the document and entries of other files are removed.
+
+        returns the number of files parsed.
+        '''
+        rst_files = [ os.path.abspath( x ) for x in rst_files ]
+        changed = [ x for x in rst_files if not self.isCurrent( x ) ]
+        if num_jobs > 1 and len(changed) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool( num_jobs )
+            try:
+                results = pool.map( parseFile, changed )
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map( parseFile, changed )
+
+        for filename, (stat, blocks) in zip( changed, results ):
+            self._store( filename, stat, blocks )
+
+        if prune:
+            for filename in set( self._files ).difference( rst_files ):
+                del self._files[filename]
+                self._db.execute( "DELETE FROM files WHERE filename = ?", (filename,) )
+
+        self._db.commit()
+        self.debug( "index: %i files, %i parsed" % (len(rst_files), len(changed)) )
+        return len(changed)
+
+    def isCurrent( self, filename ):
+        '''return True if the entry for *filename* is up-to-date.'''
+        filename = os.path.abspath( filename )
+        try:
+            stat, blocks = self._files[filename]
+        except KeyError:
+            return False
+        return stat == getStat( filename )
+
+    def getBlocks( self, filename ):
+        '''return the report directives in *filename* as a list
+        of tuples of line number and :class:`ReportBlock`.
+
+        The file is parsed if it has changed since it was indexed.
+        '''
+        filename = os.path.abspath( filename )
+        if not self.isCurrent( filename ):
+            stat, blocks = parseFile( filename )
+            self._store( filename, stat, blocks )
+            self._db.commit()
+            return blocks
+
+        stat, blocks = self._files[filename]
+        if type(blocks) != list:
+            blocks = cPickle.loads( str(blocks) )
+            self._files[filename] = (stat, blocks)
+        return blocks
+
+    def getFiles( self ):
+        '''return the files in the index.'''
+        return self._files.keys()
+
+    def close( self ):
+        self._db.close()
+
+# the index of this process
+_index = None
+
+def getIndex():
+    '''return the :class:`DirectiveIndex` of this process.'''
+    global _index
+    # do not share connections with a parent process
+    if _index == None or _index.pid != os.getpid():
+        _index = DirectiveIndex()
+        _index.pid = os.getpid()
+    return _index
@@ -1,4 +1,5 @@
-import os, sys, re, shelve, traceback, cPickle, types, itertools
+import os, sys, re, shelve, traceback, cPickle, types, itertools, inspect
+import multiprocessing, multiprocessing.dummy, multiprocessing.pool
 
 from SphinxReport.ResultBlock import ResultBlock, ResultBlocks
 from SphinxReport import DataTree
@@ -10,6 +11,73 @@ VERBOSE=True
 
 from odict import OrderedDict as odict
 
+# modes for parallel data collection
+PARALLEL_MODES = ("none", "thread", "process")
+
+def parseParallel( value ):
+    '''parse the value of the :term:`parallel` option.
+
+    *value* is one of ``none``, ``thread``, ``process``, optionally
+    followed by the number of jobs, for example ``thread-8``.
+
+    returns a tuple of (mode, number of jobs).
+    '''
+    if not value: return "none", 1
+
+    parts = str(value).strip().split("-")
+    mode = parts[0]
+    if mode not in PARALLEL_MODES:
+        raise ValueError( "unknown parallel mode `%s`, expected one of %s" % (value, str(PARALLEL_MODES)) )
+
+    if len(parts) > 1:
+        njobs = int(parts[1])
+    else:
+        njobs = multiprocessing.cpu_count()
+
+    return mode, max( 1, njobs )
+
+def useBulk( tracker ):
+    '''return True if the data of *tracker* are collected with
+    its :meth:`getBulk` method.
+
+    :meth:`getBulk` is only used if :meth:`__call__` is defined in
+    the class that defines :meth:`getBulk` or in one of its base 
+    classes. Trackers that override :meth:`__call__`, for example
+    to filter the data, are called for each path.
+    '''
+    if not hasattr( tracker, "getBulk" ): return False
+    mro = inspect.getmro( type(tracker) )
+    def getOwner( name ):
+        for x, cls in enumerate( mro ):
+            if name in cls.__dict__: return x
+        return len(mro)
+    return getOwner( "__call__" ) >= getOwner( "getBulk" )
+
+def callTracker( args ):
+    '''call *tracker* with *path*.
+
+    This function is used by the thread and process pools
+    in :meth:`Dispatcher.collect`.
+    '''
+    tracker, path, kwargs = args
+    try:
+        return tracker( *path, **kwargs )
+    except Exception, msg:
+        warn( "exception for tracker '%s', path '%s': msg=%s" % (str(tracker),
+                                                                 DataTree.path2str(path), 
+                                                                 msg) )
+        if VERBOSE: warn( traceback.format_exc() )
+        raise
+
+def callTrackerConcatenated( args ):
+    '''call *tracker* with *path* and read streams completely.
+
+    Streams can not be returned from a process pool.
+    '''
+    result = callTracker( args )
+    if DataTree.isStream( result ): return DataTree.concatenateBatches( result )
+    return result
+
 class Dispatcher(Component):
     """Dispatch the directives in the ``:report:`` directive
     to a :class:`Tracker`, class:`Transformer` and :class:`Renderer`.
@@ -26,6 +94,17 @@ class Dispatcher(Component):
 
        :term:`groupby`: group data by :term:`track` or :term:`slice`.
 
+       :term:`parallel`: collect data for several paths in parallel.
+
+    If a tracker provides a :meth:`getBulk` method, it is preferred
+    over calling the tracker for each path separately, unless a 
+    subclass overrides :meth:`__call__` (see :func:`useBulk`).
+
+    Parallel collection can also be requested by a tracker through its
+    :attr:`parallel` attribute. The directive option takes precedence.
+
+    Results are kept in a process-wide memory cache (see 
+    :func:`Cache.getMemoryCache`) in front of the persistent cache.
     """
 
     def __init__(self, tracker, renderer, transformers = None ):
@@ -44,13 +123,17 @@ class Dispatcher(Component):
         self.renderer = renderer
         self.transformers = transformers
 
-        try:
-            if tracker.cache:
-                self.cache = Cache.Cache( Cache.tracker2key(tracker) )
-            else:
-                self.cache = {}
-        except AttributeError:
-            self.cache = Cache.Cache( Cache.tracker2key(tracker) )
+        if getattr( tracker, "cache", True ):
+            self.cache = Cache.Cache( Cache.tracker2key(tracker),
+                                      stamp = Cache.tracker2stamp(tracker) )
+        else:
+            self.cache = {}
+
+        # results are only kept in memory if the tracker uses the cache
+        if isinstance( self.cache, Cache.Cache ):
+            self.memory_cache = Cache.getMemoryCache()
+        else:
+            self.memory_cache = None
 
         self.data = DataTree.DataTree()
 
@@ -77,45 +160,275 @@ class Dispatcher(Component):
         except KeyError: self.mColumns = None
 
         self.tracker_options = kwargs.get( "tracker" , None )
-        
-    def getData( self, path ):
-        """get data for track and slice. Save data in persistent cache for further use.
 
-        For functions, path should be an empty tuple.
-        """
+        self.parallel, self.njobs = parseParallel( 
+            kwargs.get( "parallel", getattr( self.tracker, "parallel", None ) ) )
 
+    def getKey( self, path ):
+        '''return cache key for *path*.'''
         if path:
-            key = DataTree.path2str(path)
+            return DataTree.path2str(path)
         else:
-            key = "all"
+            return "all"
+
+    def getTrackerArguments( self ):
+        '''return keyword arguments for calling the tracker.'''
+        kwargs = {}
+        if self.tracker_options:
+            kwargs['options'] = self.tracker_options
+        return kwargs
+
+    def getMemoryKey( self, path ):
+        '''return key for *path* in the process-wide memory cache.
+
+        returns None if results are not kept in memory.
+        '''
+        if self.memory_cache == None: return None
+        return (self.cache.cache_name, 
+                self.cache.stamp, 
+                str(self.tracker_options), 
+                self.getKey( path ))
+
+    def getFromCache( self, path ):
+        '''return data for *path* from cache.
+
+        The process-wide memory cache is checked before
+        the persistent cache.
 
-        result, fromcache = None, False
+        returns None if the data is not in the cache.
+        '''
         if not self.nocache or self.tracker_options:
+            memory_key = self.getMemoryKey( path )
+            if memory_key != None:
+                try:
+                    return self.memory_cache[ memory_key ]
+                except KeyError:
+                    pass
             try:
-                result = self.cache[ key ]
-                fromcache = True
+                result = self.cache[ self.getKey( path ) ]
             except KeyError:
-                pass
+                return None
+            if memory_key != None and result is not None:
+                self.memory_cache[ memory_key ] = result
+            return result
+        return None
 
-        kwargs = {}
-        if self.tracker_options:
-            kwargs['options'] = self.tracker_options
+    def putInCache( self, path, result ):
+        '''store *result* for *path* in cache.
+
+        Streams are not stored.
+        '''
+        if DataTree.isStream( result ):
+            self.debug( "%s: data for %s is streamed and not cached" % (self.tracker, DataTree.path2str( path )))
+            return
+        if not self.nocache:
+            self.cache[self.getKey( path )] = result
+            memory_key = self.getMemoryKey( path )
+            if memory_key != None and result is not None:
+                self.memory_cache[ memory_key ] = result
+
+    def syncCache( self ):
+        '''write pending data to the persistent cache.'''
+        try:
+            self.cache.sync()
+        except AttributeError:
+            # no persistent cache
+            pass
+
+    def getData( self, path ):
+        """get data for track and slice. Save data in persistent cache for further use.
+
+        For functions, path should be an empty tuple.
+        """
+
+        result = self.getFromCache( path )
         
-        if result == None:
+        if result is None:
+            while not self.claimData( [path] ):
+                # another process computes this path
+                self.cache.waitFor( self.getKey( path ) )
+                result = self.getFromCache( path )
+                if result is not None: return result
             try:
-                result = self.tracker( *path, **kwargs )
-            except Exception, msg:
-                self.warn( "exception for tracker '%s', path '%s': msg=%s" % (str(self.tracker),
-                                                                              DataTree.path2str(path), 
-                                                                              msg) )
-                if VERBOSE: self.warn( traceback.format_exc() )
-                raise
-        
-        if not self.nocache and not fromcache:
-            self.cache[key] = result
+                result = callTracker( (self.tracker, path, self.getTrackerArguments()) )
+                self.putInCache( path, result )
+            finally:
+                self.releaseData( [path] )
 
         return result
 
+    def claimData( self, paths ):
+        '''claim *paths* for computation in the persistent cache.
+
+        Several processes can share a cache. Claiming a path 
+        ensures that it is computed only once. All paths are
+        claimed together.
+
+        returns the set of cache keys (see :meth:`getKey`) of the
+        paths claimed by this process. Paths computed by another 
+        process are not included.
+        '''
+        keys = set( [ self.getKey( path ) for path in paths ] )
+        if self.nocache or not isinstance( self.cache, Cache.Cache ): return keys
+        return self.cache.claim( keys )
+
+    def releaseData( self, paths ):
+        '''release the claims on *paths* together.'''
+        if self.nocache or not isinstance( self.cache, Cache.Cache ): return
+        self.cache.release( [ self.getKey( path ) for path in paths ] )
+
+    def getDataSerial( self, paths ):
+        '''get data for all *paths* one after the other.
+
+        returns a list of results in the same order as *paths*.
+
+        Paths that are computed by another process are waited for
+        at the end (see :meth:`claimData`).
+        '''
+        results = [ self.getFromCache( path ) for path in paths ]
+        missing = [ x for x, result in enumerate( results ) if result is None ]
+
+        if not missing: return results
+
+        # paths claimed by other processes are waited for at the end
+        claimed_keys = self.claimData( [ paths[x] for x in missing ] )
+        claimed = [ x for x in missing if self.getKey( paths[x] ) in claimed_keys ]
+        others = [ x for x in missing if self.getKey( paths[x] ) not in claimed_keys ]
+
+        kwargs = self.getTrackerArguments()
+        try:
+            for x in claimed:
+                results[x] = callTracker( (self.tracker, paths[x], kwargs) )
+                self.putInCache( paths[x], results[x] )
+        finally:
+            self.releaseData( [ paths[x] for x in claimed ] )
+
+        for x in others:
+            results[x] = self.getData( paths[x] )
+
+        return results
+
+    def getDataBulk( self, paths ):
+        '''get data for all *paths* with a single call to the tracker.
+
+        The tracker's :meth:`getBulk` method is called with all paths 
+        that are not in the cache. It can return either a nested dictionary
+        (:term:`data tree`) or a dictionary mapping paths to results.
+
+        returns a list of results in the same order as *paths*.
+
+        Paths that are computed by another process are waited for
+        at the end (see :meth:`claimData`).
+        '''
+        results = [ self.getFromCache( path ) for path in paths ]
+        missing = [ x for x, result in enumerate( results ) if result is None ]
+
+        if not missing: return results
+
+        # paths claimed by other processes are waited for at the end
+        claimed_keys = self.claimData( [ paths[x] for x in missing ] )
+        claimed = [ x for x in missing if self.getKey( paths[x] ) in claimed_keys ]
+        others = [ x for x in missing if self.getKey( paths[x] ) not in claimed_keys ]
+
+        try:
+            if claimed:
+                self.debug( "%s: collecting %i data paths in bulk" % (self.tracker, len(claimed)))
+
+                claimed_paths = [ paths[x] for x in claimed ]
+                try:
+                    computed = self.tracker.getBulk( claimed_paths, **self.getTrackerArguments() )
+                except Exception, msg:
+                    self.warn( "exception for tracker '%s' in bulk collection of %i paths: msg=%s" % \
+                                   (str(self.tracker), len(claimed_paths), msg) )
+                    if VERBOSE: self.warn( traceback.format_exc() )
+                    raise
+
+                if computed is None: computed = {}
+
+                # distinguish between path->result mapping and data tree
+                is_mapping = any( [ path in computed for path in claimed_paths ] )
+
+                for x, path in zip( claimed, claimed_paths ):
+                    if is_mapping: result = computed.get( path, None )
+                    else: result = DataTree.getLeaf( computed, path )
+                    if result is None: continue
+                    results[x] = result
+                    self.putInCache( path, result )
+        finally:
+            self.releaseData( [ paths[x] for x in claimed ] )
+
+        for x in others:
+            results[x] = self.getData( paths[x] )
+
+        return results
+
+    def getPool( self ):
+        '''return a pool of workers for parallel data collection.
+
+        Process pools are only used if the tracker can be pickled
+        and the dispatcher is not running within a daemonic process
+        (such as a worker of :command:`sphinxreport-build`), as
+        these are not permitted to have children. Threads are used
+        instead.
+        '''
+        if self.parallel == "process":
+            if multiprocessing.current_process().daemon:
+                self.debug( "%s: daemonic process - collecting data with threads" % self.tracker )
+            else:
+                try:
+                    cPickle.dumps( self.tracker, cPickle.HIGHEST_PROTOCOL )
+                    return multiprocessing.Pool( self.njobs )
+                except (cPickle.PicklingError, TypeError), msg:
+                    self.warn( "%s: tracker can not be pickled - collecting data with threads: msg=%s" % (self.tracker, msg) )
+
+        return multiprocessing.dummy.Pool( self.njobs )
+
+    def getDataParallel( self, paths ):
+        '''get data for all *paths* in parallel.
+
+        Cached data is retrieved first. The remaining paths 
+        are distributed across a pool of threads or processes. 
+        Only the calling thread accesses the cache.
+
+        returns a list of results in the same order as *paths*.
+        '''
+        results = [ self.getFromCache( path ) for path in paths ]
+        missing = [ x for x, result in enumerate( results ) if result is None ]
+
+        if not missing: return results
+
+        self.debug( "%s: collecting %i data paths with %i %s workers" % \
+                        (self.tracker, len(missing), self.njobs, self.parallel ) )
+
+        # paths claimed by other processes are waited for at the end
+        claimed_keys = self.claimData( [ paths[x] for x in missing ] )
+        claimed = [ x for x in missing if self.getKey( paths[x] ) in claimed_keys ]
+        others = [ x for x in missing if self.getKey( paths[x] ) not in claimed_keys ]
+
+        kwargs = self.getTrackerArguments()
+        try:
+            pool = self.getPool()
+            if isinstance( pool, multiprocessing.pool.ThreadPool ): f = callTracker
+            else: f = callTrackerConcatenated
+            try:
+                computed = pool.map( f, 
+                                     [ (self.tracker, paths[x], kwargs) for x in claimed ],
+                                     chunksize = 1 )
+            finally:
+                pool.close()
+                pool.join()
+
+            for x, result in zip( claimed, computed ):
+                results[x] = result
+                self.putInCache( paths[x], result )
+        finally:
+            self.releaseData( [ paths[x] for x in claimed ] )
+
+        for x in others:
+            results[x] = self.getData( paths[x] )
+
+        return results
+
     def getDataPaths( self, obj ):
         '''determine data paths from a tracker.
 
@@ -196,25 +509,17 @@ class Dispatcher(Component):
 
         return datapaths
 
-    def collect( self ):
-        '''collect all data.
+    def getCollectionPaths( self ):
+        '''return the data paths to be collected from the tracker
+        after filtering.
 
-        Data is stored in a multi-level dictionary (DataTree)
+        returns a tuple (is_function, paths). If the tracker is 
+        a function, paths is empty.
         '''
-
-        self.data = odict()
-
         is_function, datapaths = self.getDataPaths(self.tracker)
         
         # if function, no datapaths
-        if is_function:
-            d = self.getData( () )
-
-            # save in data tree as leaf
-            DataTree.setLeaf( self.data, ("all",), d )
-
-            self.debug( "%s: collecting data finished for function." % (self.tracker))
-            return
+        if is_function: return is_function, []
 
         # if no tracks, error
         if len(datapaths) == 0 or len(datapaths[0]) == 0:
@@ -229,31 +534,65 @@ class Dispatcher(Component):
             self.warn( "%s: no tracks remain after filtering - no output" % self.tracker )
             raise ValueError( "no tracks found from %s" % self.tracker )
 
-        all_paths = list(itertools.product( *datapaths ))
+        return is_function, list(itertools.product( *datapaths ))
+
+    def collect( self ):
+        '''collect all data.
+
+        Data is stored in a multi-level dictionary (DataTree)
+        '''
+
+        self.data = odict()
+
+        is_function, all_paths = self.getCollectionPaths()
+
+        if is_function:
+            d = self.getData( () )
+
+            # save in data tree as leaf
+            DataTree.setLeaf( self.data, ("all",), d )
+
+            self.debug( "%s: collecting data finished for function." % (self.tracker))
+            return
+
         self.debug( "%s: collecting data started for %i data paths" % (self.tracker, 
                                                                        len( all_paths) ) )
 
+        if useBulk( self.tracker ):
+            all_data = self.getDataBulk( all_paths )
+        elif self.parallel != "none" and len(all_paths) > 1:
+            all_data = self.getDataParallel( all_paths )
+        elif Cache.isShared():
+            all_data = self.getDataSerial( all_paths )
+        else:
+            all_data = itertools.imap( self.getData, all_paths )
+
         self.data = odict()
-        for path in all_paths:
+        for path, d in itertools.izip( all_paths, all_data ):
             
-            d = self.getData( path )
-
             # ignore empty data sets
-            if d == None: continue
+            if d is None: continue
 
             # save in data tree as leaf
             DataTree.setLeaf( self.data, path, d )
 
         self.debug( "%s: collecting data finished for %i data paths" % (self.tracker, 
                                                                        len( all_paths) ) )
+        if self.memory_cache != None:
+            self.debug( "%s: memory cache: %s" % (self.tracker, str(self.memory_cache.getStats())))
 
     def transform(self): 
         '''call data transformers and group tree
+
+        Streams that have not been consumed by a transformer
+        are read completely.
         '''
         for transformer in self.transformers:
             self.debug( "%s: applying %s" % (self.renderer, transformer ))
             self.data = transformer( self.data )
 
+        DataTree.concatenateStreams( self.data )
+
     def group( self ):
         '''rearrange data tree for grouping.
 
@@ -418,6 +757,7 @@ class Dispatcher(Component):
 
         try: self.collect()
         except: return ResultBlocks(ResultBlocks( Utils.buildException( "collection" ) ))
+        finally: self.syncCache()
 
         self.debug( "profile: finished: tracker: %s" % (self.tracker))
 
@@ -0,0 +1,84 @@
+'''test that importing the command line utilities is fast
+and free of side-effects.
+
+Each module is imported in a fresh interpreter in an empty
+directory. The test fails if the import takes longer than
+the budget, if heavy dependencies are imported or if files
+are created.
+
+The budget in seconds can be set with the environment variable
+SPHINXREPORT_IMPORT_BUDGET. The default is generous, so that the 
+test does not fail on slow or busy machines. Slow imports are 
+mostly caught by the check for heavy dependencies.
+'''
+
+import os, sys, subprocess, tempfile, shutil, unittest
+
+# modules of the command line utilities
+MODULES = ( "SphinxReport.build",
+            "SphinxReport.clean",
+            "SphinxReport.get",
+            "SphinxReport.cachemanager" )
+
+# modules that should only be imported when used
+HEAVY = ( "sqlalchemy", "matplotlib", "rpy2", "scipy", "pkg_resources", "numpy" )
+
+BUDGET = float( os.environ.get( "SPHINXREPORT_IMPORT_BUDGET", 2.0 ) )
+
+# number of imports, the fastest is compared to the budget
+REPEATS = 3
+
+SCRIPT = '''
+import sys, time
+start = time.time()
+import %s
+print time.time() - start
+print " ".join( [ x for x in %r if x in sys.modules ] )
+'''
+
+class TestImports( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        # build requires a configuration file
+        open( os.path.join( self.tmpdir, "conf.py" ), "w" ).write( "source_suffix = '.rst'\n" )
+        self.env = dict( os.environ )
+        self.env["PYTHONPATH"] = os.pathsep.join(
+            [ os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) ] + \
+                [ x for x in self.env.get( "PYTHONPATH", "" ).split( os.pathsep ) if x ] )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def importModule( self, module ):
+        '''import *module* in a new interpreter.
+
+        returns the duration and the heavy modules imported.
+        '''
+        process = subprocess.Popen( [ sys.executable, "-c", SCRIPT % (module, HEAVY) ],
+                                    cwd = self.tmpdir,
+                                    env = self.env,
+                                    stdout = subprocess.PIPE,
+                                    stderr = subprocess.PIPE )
+        stdout, stderr = process.communicate()
+        self.assertEqual( process.returncode, 0, "import of %s failed:\n%s" % (module, stderr) )
+        lines = stdout.splitlines()
+        return float( lines[-2] ), lines[-1].split()
+
+    def testImports( self ):
+        for module in MODULES:
+            durations = []
+            for x in range( REPEATS ):
+                duration, imported = self.importModule( module )
+                self.assertEqual( imported, [],
+                                  "%s imports %s" % (module, ", ".join( imported ) ) )
+                durations.append( duration )
+
+            self.assertTrue( min(durations) < BUDGET,
+                             "import of %s took %.2fs, budget is %.2fs" % (module, min(durations), BUDGET) )
+
+            self.assertEqual( sorted( os.listdir( self.tmpdir ) ), ["conf.py"],
+                              "import of %s created files" % module )
+
+if __name__ == "__main__":
+    unittest.main()
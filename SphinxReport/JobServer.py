@@ -0,0 +1,425 @@
+'''distribute work to processes on several hosts.
+
+A :class:`JobServer` hands out work items to workers that
+connect to it over TCP. Workers are started with :func:`runWorker`
+on any host that can reach the server. Workers report when they
+start and finish a work item, send a heartbeat while they run it
+and send their log messages to the server. Work items of workers
+whose heartbeat stops are handed out again.
+
+A job server can also run as a daemon with a pool of persistent
+workers (see :func:`runDaemon`). Successive builds connect to the 
+daemon with a :class:`JobServer` created with *connect* set and
+reuse the warm workers. Each build has its own queues for results
+and log messages.
+
+The server and the workers use :mod:`multiprocessing.managers`.
+'''
+
+import os, sys, socket, time, logging, Queue, threading, multiprocessing, signal
+
+from multiprocessing.managers import BaseManager
+
+from SphinxReport.Component import *
+
+# queues and state of the job server. These are held
+# by the server process of the :class:`JobManager`.
+_jobs = Queue.Queue()
+# queues with results and log messages of each build
+_build_queues = {}
+# builds that have not been removed
+_live_builds = set()
+_build_lock = threading.Lock()
+
+# interval in seconds between heartbeats of a worker
+HEARTBEAT_INTERVAL = 10
+
+class JobError( Exception ):
+    '''a work item could not be completed.'''
+    pass
+
+class JobState( object ):
+    '''state of a job server shared with workers.'''
+    def __init__(self):
+        self._finished = False
+        self._builds = 0
+        self._lock = threading.Lock()
+    def finish( self ):
+        self._finished = True
+    def isFinished( self ):
+        return self._finished
+    def newBuild( self ):
+        '''return the identifier of a new build.'''
+        with self._lock:
+            self._builds += 1
+            with _build_lock:
+                _live_builds.add( self._builds )
+            return self._builds
+    def isLive( self, build ):
+        '''return True if build *build* has not been removed.'''
+        return build in _live_builds
+    def removeBuild( self, build ):
+        '''remove the queues of build *build*. Remaining work
+        items of the build are skipped by the workers.'''
+        with _build_lock:
+            _live_builds.discard( build )
+            for key in _build_queues.keys():
+                if key[0] == build: del _build_queues[key]
+
+_state = JobState()
+
+def getJobs(): return _jobs
+def getState(): return _state
+
+def getBuildQueue( build, name ):
+    '''return the queue *name* of build *build*.
+
+    Queues of builds that have been removed are not created
+    again, a queue that is discarded is returned instead.
+    '''
+    with _build_lock:
+        if build not in _live_builds: return Queue.Queue()
+        return _build_queues.setdefault( (build, name), Queue.Queue() )
+
+class JobManager( BaseManager ):
+    '''manager serving the queues of a job server.'''
+    pass
+
+JobManager.register( "getJobs", callable = getJobs )
+JobManager.register( "getState", callable = getState )
+JobManager.register( "getBuildQueue", callable = getBuildQueue )
+
+class JobClient( BaseManager ):
+    '''manager connecting to a job server.'''
+    pass
+
+JobClient.register( "getJobs" )
+JobClient.register( "getState" )
+JobClient.register( "getBuildQueue" )
+
+def isLocal( host ):
+    '''return True if *host* only accepts connections
+    from the local host.'''
+    return host in ("localhost", "127.0.0.1", "::1")
+
+def parseAddress( address ):
+    '''parse *address* of the form ``host:port``.
+
+    returns a tuple of host and port. If host is empty,
+    all interfaces are used.
+    '''
+    try:
+        host, port = address.rsplit( ":", 1 )
+        return host, int(port)
+    except ValueError:
+        raise ValueError( "invalid address `%s`, expected host:port" % address )
+
+class QueueLogHandler( logging.Handler ):
+    '''send log records to *queue*.
+
+    Messages are formatted before sending so that records
+    can be pickled.
+    '''
+    def __init__(self, queue ):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit( self, record ):
+        # no build to send records to
+        if self.queue == None: return
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.msg += "\n" + logging.Formatter().formatException( record.exc_info )
+                record.exc_info = None
+            self.queue.put( record )
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError( record )
+
+def connect( address, authkey, polltime = 1, timeout = 60 ):
+    '''connect to the job server at *address*.
+
+    Connecting is retried for *timeout* seconds.
+
+    returns a :class:`JobClient`.
+    '''
+    client = JobClient( address = address, authkey = authkey )
+    start = time.time()
+    while True:
+        try:
+            client.connect()
+            return client
+        except socket.error:
+            if time.time() - start > timeout: raise
+            time.sleep( polltime )
+
+class JobServer( Component ):
+    '''serve work items to workers connecting to *address*.
+
+    If *daemon* is set, the work items are submitted to a 
+    daemon already running at *address* (see :func:`runDaemon`).
+
+    Log records of workers are put into the queue :attr:`logs`, 
+    for example to be consumed by a 
+    :class:`Logger.MultiProcessingLogHandler`.
+    '''
+
+    def __init__(self, address, authkey, daemon = False ):
+        Component.__init__(self)
+        self.isDaemon = daemon
+        if daemon:
+            self.manager = connect( address, authkey )
+        else:
+            self.manager = JobManager( address = address, authkey = authkey )
+            self.manager.start()
+        self.address = self.manager.address
+        self.jobs = self.manager.getJobs()
+        self.state = self.manager.getState()
+        self.build = self.state.newBuild()
+        self.results = self.manager.getBuildQueue( self.build, "results" )
+        self.logs = self.manager.getBuildQueue( self.build, "logs" )
+
+    def getWorkerAddress( self ):
+        '''return address for workers on the local host.'''
+        host, port = self.address
+        if host in ("", "0.0.0.0"): host = "localhost"
+        return host, port
+
+    def run( self, work, polltime = 1, timeout = 6 * HEARTBEAT_INTERVAL, 
+             retries = 1, onDead = None, wait = 600 ):
+        '''hand out *work* to workers and wait for all results.
+
+        A worker is considered dead if no heartbeat has been
+        received for *timeout* seconds while it runs a work item.
+        Its work item is handed out again up to *retries* times. 
+        If given, *onDead* is called with the name of the dead
+        worker, for example to release resources it held.
+
+        Work items that have been taken from the queue, but have
+        not been started within *timeout* seconds are handed out 
+        again as well. If no worker has reported for *wait* seconds 
+        while no work item is running, the remaining work items fail.
+
+        returns a list of results in the same order as *work*. 
+        The result of a work item that could not be completed is
+        a :class:`JobError`.
+        '''
+        for x, w in enumerate( work ):
+            self.jobs.put( (self.build, x, w) )
+
+        results = [ None ] * len(work)
+        finished = [ False ] * len(work)
+        attempts = [ 0 ] * len(work)
+        # worker and time of the last heartbeat of running work items
+        running = {}
+        # time since work items have been taken from the queue
+        # without being started
+        taken = {}
+        nfinished = 0
+        last_report = time.time()
+
+        def fail( x, msg ):
+            results[x] = JobError( "job %i failed: %s" % (x, msg) )
+            finished[x] = True
+            return 1
+
+        def retry( x, msg ):
+            '''hand out work item *x* again or fail it.'''
+            if attempts[x] < retries:
+                attempts[x] += 1
+                self.jobs.put( (self.build, x, work[x]) )
+                return 0
+            return fail( x, "%s after %i attempts" % (msg, attempts[x] + 1) )
+
+        while nfinished < len(work):
+            try:
+                status, x, worker, result = self.results.get( True, polltime )
+                last_report = time.time()
+            except Queue.Empty:
+                status = None
+
+            if status == "started":
+                self.debug( "job server: job %i started on %s" % (x, worker) )
+                running[x] = (worker, time.time())
+                taken.pop( x, None )
+            elif status == "alive":
+                if x in running and running[x][0] == worker:
+                    running[x] = (worker, time.time())
+            elif status == "finished":
+                # ignore results of work items that have been handed out again
+                if running.get( x, (worker,) )[0] == worker: running.pop( x, None )
+                taken.pop( x, None )
+                if not finished[x]:
+                    results[x] = result
+                    finished[x] = True
+                    nfinished += 1
+                    self.info( "job server: job %i finished on %s (%i/%i)" % \
+                                   (x, worker, nfinished, len(work)) )
+
+            now = time.time()
+            for x, (worker, last) in running.items():
+                if now - last < timeout: continue
+                del running[x]
+                self.warn( "job server: no heartbeat from %s for job %i for %i seconds" % \
+                               (worker, x, now - last) )
+                if onDead: onDead( worker )
+                if finished[x]: continue
+                nfinished += retry( x, "worker %s died" % worker )
+
+            # work items that are neither queued, running nor finished have 
+            # been taken by a worker that has not reported them as started
+            if self.jobs.qsize() == 0:
+                for x in range( len(work) ):
+                    if finished[x] or x in running: continue
+                    since = taken.setdefault( x, now )
+                    if now - since < timeout: continue
+                    del taken[x]
+                    self.warn( "job server: job %i was not started within %i seconds" % (x, timeout) )
+                    nfinished += retry( x, "not started" )
+
+            if not running and now - last_report > wait:
+                self.warn( "job server: no worker has reported for %i seconds" % wait )
+                for x in range( len(work) ):
+                    if not finished[x]: 
+                        nfinished += fail( x, "no worker available" )
+
+        return results
+
+    def finish( self ):
+        '''tell workers to stop once all work items are done.
+
+        Workers of a daemon keep running.
+        '''
+        if not self.isDaemon: self.state.finish()
+
+    def shutdown( self ):
+        '''tell workers to stop and shut down the server.
+
+        If submitting to a daemon, only the queues of this
+        build are removed.
+        '''
+        if self.isDaemon:
+            self.state.removeBuild( self.build )
+        else:
+            self.finish()
+            self.manager.shutdown()
+
+def sendHeartbeats( results, x, worker, done ):
+    '''report to *results* that *worker* runs work item *x* 
+    every :data:`HEARTBEAT_INTERVAL` seconds until *done* is set.
+
+    Proxies connect separately in each thread, so that *results* 
+    can be shared with the worker.
+    '''
+    try:
+        while not done.wait( HEARTBEAT_INTERVAL ):
+            results.put( ("alive", x, worker, None) )
+    except (EOFError, IOError, socket.error):
+        pass
+
+def runWorker( address, authkey, func, polltime = 1, timeout = 60, reset = None ):
+    '''run work items from the job server at *address*
+    with *func* until the server has finished.
+
+    The worker tries to connect to the server for *timeout* 
+    seconds. Log messages of the worker are sent to the 
+    server only. 
+
+    If given, *reset* is called before the first work item
+    of each build. 
+
+    returns the number of work items processed.
+    '''
+    client = connect( address, authkey, polltime, timeout )
+
+    jobs, state = client.getJobs(), client.getState()
+    worker = "%s:%i" % (socket.gethostname(), os.getpid())
+
+    root = logging.getLogger('')
+    handlers = root.handlers
+    handler = QueueLogHandler( None )
+    root.handlers = [ handler ]
+
+    nprocessed, current = 0, None
+    try:
+        while True:
+            try:
+                build, x, work = jobs.get( True, polltime )
+            except Queue.Empty:
+                if state.isFinished(): break
+                continue
+            # skip work items of interrupted builds
+            if not state.isLive( build ): continue
+            if build != current:
+                results = client.getBuildQueue( build, "results" )
+                handler.queue = client.getBuildQueue( build, "logs" )
+                if reset: reset()
+                current = build
+            results.put( ("started", x, worker, None) )
+            done = threading.Event()
+            heartbeat = threading.Thread( target = sendHeartbeats, 
+                                          args = (results, x, worker, done) )
+            heartbeat.daemon = True
+            heartbeat.start()
+            try:
+                result = func( work )
+            finally:
+                done.set()
+                heartbeat.join()
+            results.put( ("finished", x, worker, result ) )
+            nprocessed += 1
+    except (EOFError, IOError, socket.error):
+        # the server has shut down
+        pass
+    finally:
+        root.handlers = handlers
+
+    return nprocessed
+
+def ignoreInterrupt():
+    '''ignore keyboard interrupts in this process.'''
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+
+def runPersistentWorker( address, authkey, func, preload = None, reset = None ):
+    '''call *preload* and run work items with :func:`runWorker`.
+
+    Keyboard interrupts are left to the daemon.
+    '''
+    ignoreInterrupt()
+    if preload: preload()
+    return runWorker( address, authkey, func, reset = reset )
+
+def runDaemon( address, authkey, func, num_workers, 
+               preload = None, reset = None ):
+    '''run a job server at *address* with *num_workers* persistent 
+    workers until interrupted or terminated.
+
+    Each worker calls *preload* once after starting and 
+    *reset* before the first work item of each build. Work items
+    are processed with *func*.
+    '''
+    manager = JobManager( address = address, authkey = authkey )
+    manager.start( ignoreInterrupt )
+    host, port = manager.address
+    if host in ("", "0.0.0.0"): host = "localhost"
+
+    workers = [ multiprocessing.Process( target = runPersistentWorker,
+                                         args = ((host, port), authkey, func, preload, reset ) ) \
+                    for x in range( num_workers ) ]
+    for worker in workers: worker.start()
+
+    # terminate as if interrupted
+    def _terminate( signum, frame ): raise KeyboardInterrupt
+    signal.signal( signal.SIGTERM, _terminate )
+
+    try:
+        while True: time.sleep( 1 )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.getState().finish()
+        for worker in workers: worker.join()
+        manager.shutdown()
@@ -0,0 +1,103 @@
+'''test that a job server on localhost completes all work items
+when workers die.
+
+Workers are started as processes on the local host. Heartbeats
+and timeouts are shortened so that the test finishes quickly.
+'''
+
+import os, sys, time, signal, tempfile, shutil, unittest, multiprocessing
+
+from SphinxReport import JobServer
+
+AUTHKEY = "test"
+
+def square( work ):
+    '''return the square of the number in *work*.
+
+    If *work* is a tuple (number, marker) and the file *marker*
+    does not exist, the file is created and the worker is killed.
+    '''
+    if isinstance( work, tuple ):
+        work, marker = work
+        if not os.path.exists( marker ):
+            open( marker, "w" ).close()
+            os.kill( os.getpid(), signal.SIGKILL )
+    time.sleep( 0.1 )
+    return work * work
+
+def takeAndDie( address ):
+    '''take a work item from the server and die without
+    reporting it.'''
+    client = JobServer.connect( address, AUTHKEY )
+    client.getJobs().get()
+    os._exit( 0 )
+
+class TestJobServer( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.heartbeat = JobServer.HEARTBEAT_INTERVAL
+        JobServer.HEARTBEAT_INTERVAL = 0.2
+        self.server = JobServer.JobServer( ("localhost", 0), AUTHKEY )
+        self.workers = []
+
+    def tearDown( self ):
+        self.server.finish()
+        for worker in self.workers: worker.join( 10 )
+        self.server.shutdown()
+        # proxies to a manager that has shut down can not be
+        # inherited by processes started later
+        self.server = None
+        JobServer.HEARTBEAT_INTERVAL = self.heartbeat
+        shutil.rmtree( self.tmpdir )
+
+    def startWorkers( self, n ):
+        for x in range( n ):
+            worker = multiprocessing.Process( target = JobServer.runWorker,
+                                              args = (self.server.getWorkerAddress(), AUTHKEY, square ) )
+            worker.start()
+            self.workers.append( worker )
+
+    def testAllResults( self ):
+        self.startWorkers( 3 )
+        results = self.server.run( range( 20 ), polltime = 0.1, timeout = 1 )
+        self.assertEqual( results, [ x * x for x in range( 20 ) ] )
+
+    def testWorkerKilled( self ):
+        self.startWorkers( 3 )
+        dead = []
+        work = range( 10 )
+        work[5] = (5, os.path.join( self.tmpdir, "killed" ))
+        results = self.server.run( work, polltime = 0.1, timeout = 1, onDead = dead.append )
+        self.assertEqual( results, [ x * x for x in range( 10 ) ] )
+        self.assertEqual( len(dead), 1 )
+        self.assertEqual( len( [ x for x in self.workers if not x.is_alive() ] ), 1 )
+
+    def testWorkerKilledWithoutRetries( self ):
+        self.startWorkers( 2 )
+        work = range( 4 )
+        work[2] = (2, os.path.join( self.tmpdir, "killed" ))
+        results = self.server.run( work, polltime = 0.1, timeout = 1, retries = 0 )
+        self.assertTrue( isinstance( results[2], JobServer.JobError ) )
+        self.assertEqual( [ results[x] for x in (0,1,3) ], [0, 1, 9] )
+
+    def testLostBeforeStarted( self ):
+        # the first process waiting for work takes the first item
+        thief = multiprocessing.Process( target = takeAndDie, args = (self.server.getWorkerAddress(),) )
+        thief.start()
+        time.sleep( 0.5 )
+        self.startWorkers( 2 )
+        results = self.server.run( range( 4 ), polltime = 0.1, timeout = 1 )
+        self.assertEqual( results, [0, 1, 4, 9] )
+        thief.join( 1 )
+        if thief.is_alive(): thief.terminate()
+        self.assertEqual( thief.exitcode, 0, "no work item was taken" )
+
+    def testNoWorkers( self ):
+        start = time.time()
+        results = self.server.run( range( 2 ), polltime = 0.1, timeout = 1, wait = 1 )
+        self.assertTrue( time.time() - start < 10 )
+        self.assertTrue( all( [ isinstance( x, JobServer.JobError ) for x in results ] ) )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+'''build manifest for incremental builds.
+
+The manifest records for each :term:`report` directive that has
+been rendered the restructured text it produced, the files the
+directive depends on, a hash of the code of the :term:`tracker`,
+the fingerprint of the tracker's data (see :meth:`Tracker.getFingerprint`)
+and the output files.
+
+A directive is up-to-date, if its entry exists, its output files
+exist and its input files have not been modified or, if they have, 
+the code of the tracker is unchanged. The code is read from the 
+module file without loading the module. If ``report_manifest_fingerprint``
+is set, the data fingerprint must not have changed either. This 
+requires instantiating the tracker. Files, code and fingerprints 
+are checked only once per build.
+'''
+
+import os, sqlite3, hashlib, cPickle
+
+from SphinxReport.Component import *
+from SphinxReport import Utils, Cache
+
+# database with the manifest
+MANIFESTFILE = "sphinxreport.manifest"
+
+def getRelativePath( filename ):
+    '''return *filename* relative to the current directory
+    if it is within it.
+
+    Relative paths permit manifests to be merged between
+    copies of a report (see :meth:`Manifest.merge`).
+    '''
+    path = os.path.relpath( os.path.abspath( filename ) )
+    if path.startswith( os.pardir ): return os.path.abspath( filename )
+    return path
+
+def getDirectiveKey( document, template_name, content ):
+    '''return key of a directive.
+
+    The key is built from the document, the name of the output
+    template (tracker, renderer and hash of options) and the caption.
+    '''
+    return hashlib.md5( "%s\0%s\0%s" % (getRelativePath( str(document) ),
+                                          template_name,
+                                          "\n".join( content or [] ) ) ).hexdigest()
+
+class Manifest( Component ):
+    '''manifest of rendered directives in an sqlite database.
+    '''
+
+    def __init__(self, filename = MANIFESTFILE ):
+        Component.__init__(self)
+        self.filename = filename
+        # cache of file stats, code hashes and fingerprints
+        self._stats = {}
+        self._hashes = {}
+        self._fingerprints = {}
+        self._db = sqlite3.connect( filename, timeout = 60 )
+        self._db.text_factory = str
+        self._db.execute( "PRAGMA journal_mode=%s" % Cache.getJournalMode() )
+        self._db.execute( '''CREATE TABLE IF NOT EXISTS directives (
+                             key TEXT PRIMARY KEY,
+                             tracker TEXT,
+                             stamp TEXT,
+                             inputs BLOB,
+                             outputs BLOB,
+                             lines BLOB,
+                             fingerprint TEXT)''' )
+        # add columns to manifests created by previous versions
+        columns = [ x[1] for x in self._db.execute( "PRAGMA table_info(directives)" ) ]
+        if "fingerprint" not in columns:
+            self._db.execute( "ALTER TABLE directives ADD COLUMN fingerprint TEXT" )
+        self._db.execute( "CREATE INDEX IF NOT EXISTS directives_tracker ON directives (tracker)" )
+        self._db.commit()
+
+    def reset( self ):
+        '''forget file stats, code hashes and fingerprints, so that 
+        they are checked again.'''
+        self._stats = {}
+        self._hashes = {}
+        self._fingerprints = {}
+
+    def getStat( self, filename ):
+        '''return modification time and size of *filename*.'''
+        try:
+            return self._stats[filename]
+        except KeyError:
+            try:
+                st = os.stat( filename )
+                stat = (st.st_mtime, st.st_size)
+            except OSError:
+                stat = None
+            self._stats[filename] = stat
+            return stat
+
+    def getInputs( self, reference ):
+        '''return files that the output of tracker *reference*
+        depends on.'''
+        name, cls = os.path.splitext( reference )
+        try:
+            pathname = Utils.getModulePath( name )
+        except (ImportError, NotImplementedError):
+            return []
+        return [ getRelativePath( pathname ) ]
+
+    def getCodeHash( self, reference ):
+        '''return hash of the code of tracker *reference*.
+
+        The code is read from the module file without loading
+        the module or instantiating the tracker.
+        '''
+        try:
+            return self._hashes[reference]
+        except KeyError:
+            name, cls = os.path.splitext( reference )
+            pathname = Utils.getModulePath( name )
+            codehash = hashlib.md5( "".join( Utils.getCode( cls[1:], pathname ) ) ).hexdigest()
+            self._hashes[reference] = codehash
+            return codehash
+
+    def checkFingerprints( self ):
+        '''return True if data fingerprints are checked, see
+        ``report_manifest_fingerprint``.'''
+        return bool( Utils.PARAMS.get( "report_manifest_fingerprint", True ) )
+
+    def getFingerprint( self, reference ):
+        '''return the data fingerprint of tracker *reference*.
+
+        The tracker is instantiated once per process and its 
+        fingerprint is computed once per build.
+        '''
+        try:
+            return self._fingerprints[reference]
+        except KeyError:
+            code, tracker = Utils.makeTracker( reference )
+            fingerprint = None
+            if hasattr( tracker, "getFingerprint" ):
+                fingerprint = tracker.getFingerprint()
+            if fingerprint is not None: fingerprint = str(fingerprint)
+            self._fingerprints[reference] = fingerprint
+            return fingerprint
+
+    def get( self, key ):
+        '''return the restructured text of the directive *key*.
+
+        returns None if there is no up-to-date entry for *key*.
+        '''
+        row = self._db.execute( "SELECT tracker, stamp, fingerprint, inputs, outputs, lines FROM directives WHERE key = ?",
+                                (key,) ).fetchone()
+        if row == None: return None
+        reference, codehash, fingerprint, inputs, outputs, lines = row
+        for filename in cPickle.loads( str(outputs) ):
+            if self.getStat( filename ) == None:
+                self.debug( "manifest: %s is missing" % filename )
+                return None
+        try:
+            for filename, stat in cPickle.loads( str(inputs) ):
+                if self.getStat( filename ) == stat: continue
+                if self.getCodeHash( reference ) != codehash:
+                    self.debug( "manifest: code of tracker %s has changed" % reference )
+                    return None
+            if self.checkFingerprints() and self.getFingerprint( reference ) != fingerprint:
+                self.debug( "manifest: data of tracker %s have changed" % reference )
+                return None
+        except Exception, msg:
+            # redo, the error will be reported by the directive
+            self.debug( "manifest: could not check tracker %s: %s" % (reference, msg) )
+            return None
+        return cPickle.loads( str(lines) )
+
+    def put( self, key, reference, lines, outputs ):
+        '''record *lines* and *outputs* produced by the directive
+        *key* using tracker *reference*.'''
+        inputs = [ (x, self.getStat( x )) for x in self.getInputs( reference ) ]
+        if self.checkFingerprints(): fingerprint = self.getFingerprint( reference )
+        else: fingerprint = None
+        self._db.execute( '''INSERT OR REPLACE INTO directives 
+                             (key, tracker, stamp, fingerprint, inputs, outputs, lines) 
+                             VALUES (?,?,?,?,?,?,?)''',
+                          (key,
+                           reference,
+                           self.getCodeHash( reference ),
+                           fingerprint,
+                           sqlite3.Binary( cPickle.dumps( inputs, cPickle.HIGHEST_PROTOCOL ) ),
+                           sqlite3.Binary( cPickle.dumps( outputs, cPickle.HIGHEST_PROTOCOL ) ),
+                           sqlite3.Binary( cPickle.dumps( lines, cPickle.HIGHEST_PROTOCOL ) ) ) )
+        self._db.commit()
+
+    def getOutputs( self, reference ):
+        '''return output files of directives using tracker *reference*.'''
+        result = []
+        for outputs, in self._db.execute( "SELECT outputs FROM directives WHERE tracker = ?",
+                                          (reference,) ):
+            result.extend( cPickle.loads( str(outputs) ) )
+        return result
+
+    def getTrackers( self ):
+        '''return trackers used by directives in the manifest.'''
+        return [ x[0] for x in self._db.execute( "SELECT DISTINCT tracker FROM directives" ) ]
+
+    def removeTracker( self, reference ):
+        '''remove all entries of directives using tracker *reference*.
+
+        returns the number of removed entries.
+        '''
+        n = self._db.execute( "DELETE FROM directives WHERE tracker = ?", (reference,) ).rowcount
+        self._db.commit()
+        return n
+
+    def merge( self, filename ):
+        '''add entries from the manifest in *filename*.
+
+        Existing entries are replaced.
+        '''
+        # add missing columns to the other manifest
+        Manifest( filename ).close()
+        columns = "key, tracker, stamp, fingerprint, inputs, outputs, lines"
+        self._db.execute( "ATTACH DATABASE ? AS other", (filename,) )
+        try:
+            self._db.execute( "INSERT OR REPLACE INTO directives (%s) SELECT %s FROM other.directives" % \
+                                  (columns, columns) )
+            self._db.commit()
+        finally:
+            self._db.execute( "DETACH DATABASE other" )
+
+    def close( self ):
+        self._db.close()
+
+# the manifest of this process
+_manifest = None
+
+def getManifest():
+    '''return the :class:`Manifest` of this process.'''
+    global _manifest
+    # do not share connections with a parent process
+    if _manifest == None or _manifest.pid != os.getpid():
+        _manifest = Manifest()
+        _manifest.pid = os.getpid()
+    return _manifest
@@ -1,13 +1,14 @@
 import types
 import math
 import numpy
-import scipy
-import scipy.stats
 import collections, itertools
 
-from rpy2.robjects import r as R
-import rpy2.robjects as ro
-import rpy2.robjects.numpy2ri
+from SphinxReport.Utils import LazyImport
+
+# scipy and R are imported on first use
+scipy = LazyImport( "scipy", modules = ("scipy.stats",) )
+R = LazyImport( "rpy2.robjects", "r", modules = ("rpy2.robjects.numpy2ri",) )
+ro = LazyImport( "rpy2.robjects" )
 
 import odict
 
@@ -203,7 +204,7 @@ class Summary( Result ):
         self.counts, self.min, self.max, self.mean, self.median, self.samplestd, self.sum, self.q1, self.q3 = \
                     (0, 0, 0, 0, 0, 0, 0, 0, 0)
         
-        if values != None:
+        if values is not None:
 
             values = [x for x in values if x != None ]
 
@@ -267,6 +268,89 @@ class Summary( Result ):
                             format_vals % self.q3,                            
                             ) )
 
+class StreamSummary:
+    '''compute a :class:`Summary` from batches of values.
+
+    The number of values, minimum, maximum, mean, standard deviation
+    and sum are exact. The median and quartiles are computed from
+    a uniform random sample of at most *sample_size* values and are
+    exact if there are fewer values. The sample is drawn with a fixed
+    *seed*.
+    '''
+
+    def __init__(self, sample_size = 100000, seed = 0 ):
+        self.counts = 0
+        self.min, self.max, self.sum = None, None, 0
+        self._mean, self._m2 = 0.0, 0.0
+        self._sample = numpy.zeros( sample_size, numpy.float )
+        self._random = numpy.random.RandomState( seed )
+        self._nerrors = 0
+
+    def add( self, values ):
+        '''add a batch of *values*.
+
+        None values are ignored. Values that can not be 
+        converted to float are counted as errors.
+        '''
+        if not (isinstance( values, numpy.ndarray ) and values.dtype.kind in "biuf"):
+            n = []
+            for x in values:
+                if x == None: continue
+                try:
+                    n.append( float(x) )
+                except ValueError:
+                    self._nerrors += 1
+            values = numpy.array( n, numpy.float )
+
+        m = len(values)
+        if m == 0: return
+
+        # combine mean and sum of squared differences of the batch
+        a = values.astype( numpy.float )
+        mean = a.mean()
+        m2 = ((a - mean) ** 2).sum()
+        total = self.counts + m
+        delta = mean - self._mean
+        self._mean += delta * m / total
+        self._m2 += m2 + delta ** 2 * self.counts * m / total
+
+        if self.counts == 0:
+            self.min, self.max = a.min(), a.max()
+        else:
+            self.min, self.max = min( self.min, a.min() ), max( self.max, a.max() )
+        self.sum += a.sum()
+
+        # reservoir sampling: the value at position t in the
+        # stream replaces a random sample with probability k / (t+1)
+        k = len(self._sample)
+        nfill = max( 0, min( k - self.counts, m ) )
+        self._sample[self.counts:self.counts+nfill] = a[:nfill]
+        if nfill < m:
+            t = numpy.arange( self.counts + nfill, total )
+            r = (self._random.random_sample( m - nfill ) * (t + 1)).astype( numpy.int64 )
+            keep = r < k
+            self._sample[ r[keep] ] = a[nfill:][keep]
+
+        self.counts = total
+
+    def getSummary( self, format = "%6.4f", mode = "float" ):
+        '''return the :class:`Summary` of all values added.'''
+        if self.counts == 0:
+            raise ValueError( "no data for statistics" )
+
+        n = numpy.sort( self._sample[:min( self.counts, len(self._sample) )] )
+        s = Summary( format = format, mode = mode )
+        s.counts = self.counts
+        s.min = self.min
+        s.max = self.max
+        s.mean = self._mean
+        s.median = numpy.median( n )
+        s.samplestd = math.sqrt( self._m2 / self.counts )
+        s.sum = self.sum
+        s.q1 = n[len(n) / 4]
+        s.q3 = n[len(n) * 3 / 4]
+        return s
+
 class FDRResult:
     def __init__(self):
         pass
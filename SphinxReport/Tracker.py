@@ -1,20 +1,255 @@
 from __future__ import with_statement 
 
 import os, sys, re, types, copy, warnings, ConfigParser, inspect, logging, glob
+import sqlite3, hashlib, cPickle
 
-import sqlalchemy
-try:
-    import sqlalchemy.exceptions as exc
-except ImportError:
-    import sqlalchemy.exc as exc
-
-from SphinxReport import Utils
+from SphinxReport import Utils, DataTree
 
 from odict import OrderedDict as odict
 
+def getSQLAlchemy():
+    '''return the :mod:`sqlalchemy` module and its exceptions.
+
+    sqlalchemy is slow to import and only imported once
+    a database is used.
+    '''
+    import sqlalchemy
+    try:
+        import sqlalchemy.exceptions as exc
+    except ImportError:
+        import sqlalchemy.exc as exc
+    return sqlalchemy, exc
+
 class SQLError( Exception ):
     pass
 
+# database with the tables and columns of sql backends
+SCHEMAFILE = "sphinxreport.schema"
+
+def reflect( f, *args, **kwargs ):
+    '''call reflection function *f* ignoring warnings about
+    unknown types such as BigInt.'''
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return f( *args, **kwargs )
+    except AttributeError:
+        return f( *args, **kwargs )
+
+def openSchemaFile( filename = SCHEMAFILE ):
+    '''open the database with the schemas of sql backends.'''
+    dbhandle = sqlite3.connect( filename, timeout = 60 )
+    dbhandle.text_factory = str
+    dbhandle.execute( '''CREATE TABLE IF NOT EXISTS schemas (
+                         backend TEXT PRIMARY KEY,
+                         version TEXT)''' )
+    dbhandle.execute( '''CREATE TABLE IF NOT EXISTS tables (
+                         backend TEXT,
+                         name TEXT,
+                         columns BLOB,
+                         PRIMARY KEY (backend, name))''' )
+    return dbhandle
+
+class Database:
+    '''an engine for a database backend and an index of the 
+    tables in the database.
+
+    The engine and the index are shared by all trackers of
+    a process using the same backend (see :func:`getDatabase`).
+    For backends that pool their connections, the pool keeps
+    ``report_sql_pool_size`` connections and opens up to 
+    ``report_sql_max_overflow`` connections in addition.
+
+    The index contains the names of all tables and the columns
+    of tables that have been reflected. Tables are reflected
+    individually when they are first needed. The index is stored
+    in :file:`sphinxreport.schema` together with a version of 
+    the schema of the database computed from the database catalog 
+    (``sqlite_master`` or ``information_schema``). The stored index 
+    is used while the version is the same. The version is checked
+    once per process.
+    '''
+
+    def __init__(self, backend ):
+        sqlalchemy, exc = getSQLAlchemy()
+        kwargs = {}
+        if backend.startswith( "sqlite" ):
+            # keep a connection open for each thread, so that sqlite can re-use
+            # the parsed schema and prepared statements
+            kwargs["poolclass"] = sqlalchemy.pool.SingletonThreadPool
+        else:
+            kwargs["pool_size"] = int(Utils.PARAMS.get( "report_sql_pool_size", 5 ))
+            kwargs["max_overflow"] = int(Utils.PARAMS.get( "report_sql_max_overflow", 10 ))
+
+        logging.debug( "connecting to %s" % backend )
+        self.backend = backend
+        self.engine = sqlalchemy.create_engine( backend, **kwargs )
+        self.engine.echo = False
+        self.pid = os.getpid()
+        self.reset()
+
+    def reset( self ):
+        '''forget the schema, the version of the schema is checked 
+        and tables are reflected again on next use.'''
+        self._metadata = None
+        # reflected tables and views
+        self._tablemetadata = None
+        self._tables = {}
+        # table names and their columns, None if not reflected
+        self._columns = None
+        self._version = None
+
+    def getVersion( self ):
+        '''return a version of the schema of the database.
+
+        returns None if the catalog of the database can not be queried.
+        '''
+        sqlalchemy, exc = getSQLAlchemy()
+        if self.backend.startswith( "sqlite" ):
+            statement = "SELECT type, name, sql FROM sqlite_master ORDER BY type, name"
+        else:
+            statement = '''SELECT table_schema, table_name, column_name, data_type 
+                           FROM information_schema.columns
+                           ORDER BY table_schema, table_name, ordinal_position'''
+        try:
+            rows = self.engine.execute( statement ).fetchall()
+        except exc.SQLAlchemyError, msg:
+            logging.debug( "no schema version for %s: %s" % (self.backend, msg) )
+            return None
+        return hashlib.md5( repr( [tuple(x) for x in rows] ) ).hexdigest()
+
+    def load( self ):
+        '''load the index of tables.
+
+        The index is read from :file:`sphinxreport.schema` if 
+        the schema has not changed, otherwise the table names
+        are read from the database.
+        '''
+        if self._columns != None: return
+
+        self._version = self.getVersion()
+        if self._version != None:
+            dbhandle = openSchemaFile()
+            try:
+                r = dbhandle.execute( "SELECT version FROM schemas WHERE backend = ?", 
+                                      (self.backend,) ).fetchone()
+                if r and r[0] == self._version:
+                    self._columns = {}
+                    for name, columns in dbhandle.execute( 
+                        "SELECT name, columns FROM tables WHERE backend = ?", (self.backend,) ):
+                        if columns != None: columns = cPickle.loads( str(columns) )
+                        self._columns[name] = columns
+                    logging.debug( "read %i tables of %s from index" % (len(self._columns), self.backend) )
+                    return
+            finally:
+                dbhandle.close()
+
+        names = reflect( self.engine.table_names )
+        self._columns = dict( [ (x, None) for x in names ] )
+        logging.debug( "read %i tables of %s from database" % (len(self._columns), self.backend) )
+
+        if self._version != None:
+            dbhandle = openSchemaFile()
+            try:
+                dbhandle.execute( "DELETE FROM tables WHERE backend = ?", (self.backend,) )
+                dbhandle.executemany( "INSERT INTO tables VALUES (?,?,NULL)", 
+                                      [ (self.backend, x) for x in names ] )
+                dbhandle.execute( "INSERT OR REPLACE INTO schemas VALUES (?,?)", 
+                                  (self.backend, self._version ) )
+                dbhandle.commit()
+            finally:
+                dbhandle.close()
+
+    def getTableNames( self ):
+        '''return a sorted list of the tables in the database.
+
+        Views are not included.
+        '''
+        self.load()
+        return sorted( self._columns.keys() )
+
+    def hasTable( self, tablename ):
+        '''return True if the database contains table *tablename*.'''
+        self.load()
+        return tablename in self._columns
+
+    def getTable( self, tablename ):
+        '''return the table or view *tablename*.
+
+        The table is reflected on first use.
+        '''
+        try:
+            return self._tables[tablename]
+        except KeyError:
+            pass
+
+        sqlalchemy, exc = getSQLAlchemy()
+        if self._tablemetadata == None:
+            self._tablemetadata = sqlalchemy.MetaData( self.engine )
+        try:
+            table = reflect( sqlalchemy.Table, tablename, self._tablemetadata, autoload = True )
+        except exc.NoSuchTableError:
+            raise IndexError( "table %s not found" % tablename )
+        self._tables[tablename] = table
+        return table
+
+    def getColumns( self, tablename ):
+        '''return the names of the columns in table or view *tablename*.
+
+        The columns of tables are recorded in the index.
+        '''
+        self.load()
+        columns = self._columns.get( tablename, None )
+        if columns != None: return columns
+
+        columns = [ x.name for x in self.getTable( tablename ).columns ]
+        if tablename in self._columns:
+            self._columns[tablename] = columns
+            if self._version != None:
+                dbhandle = openSchemaFile()
+                try:
+                    dbhandle.execute( "UPDATE tables SET columns = ? WHERE backend = ? AND name = ?",
+                                      (sqlite3.Binary( cPickle.dumps( columns, cPickle.HIGHEST_PROTOCOL ) ),
+                                       self.backend, tablename ) )
+                    dbhandle.commit()
+                finally:
+                    dbhandle.close()
+        return columns
+
+    def getMetaData( self ):
+        '''return the schema of the database with all tables reflected.
+
+        The database is reflected on first use.
+        '''
+        if self._metadata == None:
+            sqlalchemy, exc = getSQLAlchemy()
+            logging.debug( "reflecting %s" % self.backend )
+            self._metadata = reflect( sqlalchemy.MetaData, self.engine, reflect = True )
+        return self._metadata
+
+# databases of this process, indexed by backend
+_databases = {}
+
+def getDatabase( backend ):
+    '''return the :class:`Database` for *backend*.
+
+    Databases are shared within a process, but not with
+    child processes.
+    '''
+    database = _databases.get( backend, None )
+    if database == None or database.pid != os.getpid():
+        database = Database( backend )
+        _databases[backend] = database
+    return database
+
+def resetDatabases():
+    '''forget the schemas of all databases of this process.
+
+    Engines and their connections are kept.
+    '''
+    for database in _databases.values():
+        database.reset()
+
 ###########################################################################
 ###########################################################################
 ###########################################################################
@@ -77,6 +312,20 @@ class Tracker(object):
        tracker("car", "blue")
 
     would return the lengths of blue cars.
+
+    Trackers can optionally provide a method :meth:`getBulk` to 
+    return the data for several paths at once::
+
+       def getBulk( self, paths ):
+          ...
+
+    *paths* is the list of (filtered) paths that the
+    :class:`Dispatcher` requires. The method should return
+    either a nested dictionary (:term:`data tree`) or a dictionary
+    mapping each path (a tuple) to its data. If present, the
+    :class:`Dispatcher` will call :meth:`getBulk` instead of calling
+    the tracker for each path. Subclasses that override :meth:`__call__` 
+    are called for each path.
     """
 
     mMinData = 1
@@ -84,6 +333,10 @@ class Tracker(object):
     # set to False, if results of tracker should be cached
     cache = True
 
+    # set to "thread" or "process" to collect data for 
+    # several tracks/slices in parallel (see :term:`parallel`)
+    parallel = None
+
     # default: empty tracks/slices
     # tracks = []
     # slices = []
@@ -92,6 +345,16 @@ class Tracker(object):
     def __init__(self, *args, **kwargs):
         pass
 
+    def __getstate__( self ):
+        '''remove attributes that can not be pickled.
+
+        Trackers are pickled for parallel data collection
+        in a process pool.
+        '''
+        state = self.__dict__.copy()
+        state.pop( "dispatcher", None )
+        return state
+
     # def getTracks( self ):
     #     """return a list of all tracks that this tracker provides."""
     #     return self.tracks
@@ -106,6 +369,19 @@ class Tracker(object):
     #     """
     #     return self.paths
 
+    def getFingerprint( self ):
+        '''return a fingerprint of the data sources of this tracker.
+
+        Cached data are stamped with the fingerprint and recomputed 
+        if it changes. The fingerprint should be cheap to compute, 
+        for example file modification times or the number of rows 
+        in a table.
+
+        The default is to return None, in which case only changes
+        to the tracker's code invalidate cached data.
+        '''
+        return None
+
     def getShortCaption( self ):
         """return one line caption.
 
@@ -138,9 +414,12 @@ class Tracker(object):
         # todo: do this for the general case
         # 1. subtract property attributes, or
         # 2. subtract members of Tracker()
+        # properties are not evaluated, they might query a database
+        cls = self.__class__
         l = dict( [(attr,getattr(self,attr)) for attr in dir(self) \
-                      if not callable(attr) and not attr.startswith("__") and attr != "tracks" and attr != "slices"] )
-            
+                      if not callable(attr) and not attr.startswith("__") and attr != "tracks" and attr != "slices" \
+                      and not isinstance( getattr( cls, attr, None ), property ) ] )
+
         if locals: return dict( l, **locals)
         else: return l
 
@@ -158,6 +437,13 @@ class TrackerCSV( Tracker ):
 
     def getTracks(self, subset = None ):
         return ["all",]
+
+    def getFingerprint( self ):
+        '''return modification time and size of :attr:`filename`.'''
+        filename = getattr( self, "filename", None )
+        if not filename or not os.path.exists( filename ): return None
+        st = os.stat( filename )
+        return "%s:%i:%i" % (filename, st.st_mtime, st.st_size)
     
     def getSlices(self, subset = None ):
         return []
@@ -175,15 +461,45 @@ class TrackerSQL( Tracker ):
     The basic tracker identifies tracks as tables that match a
     certain pattern (:attr:`pattern`)
 
-    This tracker connects to the database. Each tracker will establish
-    its own connection for efficient multi-processing.
+    This tracker connects to the database. All trackers of a process
+    share one engine and connection pool for each backend, while each 
+    process establishes its own connections for efficient multi-processing.
 
     If :attr:`as_tables` is set, the full table names will be returned.
     The default is to apply :attr:`pattern` and return the result.
+
+    The SQL statements passed to the convenience functions such as 
+    :meth:`getValues` may contain placeholders. Values for ``:name`` 
+    placeholders are passed as keyword arguments and bound by the 
+    database::
+
+       self.getValues( "SELECT data FROM table WHERE experiment = :experiment", 
+                       experiment = experiment )
+
+    ``%(name)s`` placeholders are substituted into the statement text
+    from the keyword arguments and the attributes of the tracker, for
+    example for table names. 
+
+    Older trackers fill in placeholders from the local variables 
+    of the calling function. This is deprecated. Set 
+    :attr:`use_caller_locals` to True to keep this behaviour 
+    without a warning.
+
+    Statements with bound parameters are compiled once and the same
+    statement can be re-used by the database for all tracks and slices.
+    At most :attr:`max_statements` compiled statements are kept.
     """
 
     pattern = "(.*)"
     as_tables = False
+    max_statements = 1000
+    fetch_size = 10000
+    # maximum number of bound parameters in a statement
+    max_parameters = 500
+    # fill in placeholders from the locals of the calling function.
+    # If None, the locals are only used with a DeprecationWarning
+    # if a placeholder can not be filled in otherwise.
+    use_caller_locals = None
 
     def __init__(self, backend = None, *args, **kwargs ):
         Tracker.__init__(self, *args, **kwargs )
@@ -206,29 +522,68 @@ class TrackerSQL( Tracker ):
             warnings.warn( "mAsTables is deprecated, use as_tables instead", DeprecationWarning )
             self.as_tables = self.mAsTables
 
-    def connect( self ):
-        """lazy connection function."""
+    def __getstate__( self ):
+        '''remove the database connection.
 
-        if not self.db:
-            
-            logging.debug( "connecting to %s" % self.backend )
-            db = sqlalchemy.create_engine( self.backend )
+        The connection will be re-established lazily.
+        '''
+        state = Tracker.__getstate__( self )
+        state["db"] = None
+        state.pop( "_statements", None )
+        return state
+
+    def getFingerprint( self ):
+        '''return a fingerprint of the database.
+
+        For sqlite databases, this is the modification time and 
+        size of the database file. For postgresql, the counts of
+        inserted, updated and deleted rows in :attr:`table` are
+        taken from the statistics collector. Other backends count 
+        the rows in :attr:`table`. Without :attr:`table`, no 
+        fingerprint is returned for backends other than sqlite.
+        '''
+        x = re.match( "sqlite:///(.*)", self.backend )
+        if x:
+            fingerprint = []
+            filename = x.groups()[0]
+            # include write-ahead log
+            for fn in (filename, filename + "-wal"):
+                if os.path.exists( fn ):
+                    st = os.stat( fn )
+                    fingerprint.append( "%s:%i:%i" % (fn, st.st_mtime, st.st_size) )
+            return ",".join( fingerprint )
+
+        table = getattr( self, "table", None )
+        if not table: return None
+
+        if self.backend.startswith( "postgres" ):
+            # avoid a full table scan
+            row = self.getFirstRow( '''SELECT n_tup_ins, n_tup_upd, n_tup_del
+                                       FROM pg_stat_user_tables WHERE relname = :table''',
+                                    table = table )
+            if row is not None:
+                return "%s:%s" % (table, ":".join( map(str, row) ))
+
+        return "%s:%i" % (table, self.getValue( "SELECT COUNT(*) FROM %s" % table ))
 
-            if not db:
-                raise ValueError( "could not connect to database %s" % self.backend )
+    def connect( self ):
+        """lazy connection function.
 
-            db.echo = False  
+        The engine and the schema of the database are shared with
+        all other trackers using the same backend.
+        """
+        # look up the engine every time, a tracker might
+        # have been created in a parent process
+        self.db = getDatabase( self.backend ).engine
 
-            # ignore unknown type BigInt warnings
-            if db:
-                try:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore")
-                        self.metadata = sqlalchemy.MetaData(db, reflect = True)
-                except AttributeError:
-                    self.metadata = sqlalchemy.MetaData(db, reflect = True)
+    @property
+    def metadata( self ):
+        '''the reflected schema of the database.
 
-            self.db = db
+        Accessing the metadata reflects all tables in the database.
+        Use :meth:`getTable` to reflect a single table.
+        '''
+        return getDatabase( self.backend ).getMetaData()
 
     def getTables(self, pattern = None ):
         """return a list of tables matching a *pattern*.
@@ -237,63 +592,95 @@ class TrackerSQL( Tracker ):
 
         returns a list of table objects.
         """
-        # older versions of sqlalchemy have no sorted_tables attribute
-        self.connect()
-        try:
-            sorted_tables = self.metadata.sorted_tables
-        except AttributeError, msg:
-            sorted_tables = []
-            for x in sorted(self.metadata.tables.keys()):
-                sorted_tables.append( self.metadata.tables[x])
-
-        if pattern:
-            rx = re.compile(pattern)
-            return [ x for x in sorted_tables if rx.search( x.name ) ]
-        else:
-            return sorted_tables
+        return [ self.getTable( x ) for x in self.getTableNames( pattern ) ]
 
     def getTableNames( self, pattern = None ):
         '''return a list of tablenames matching a *pattern*.
+
+        The tables are not reflected.
         '''
-        return [x.name for x in self.getTables( pattern ) ]
+        self.connect()
+        names = getDatabase( self.backend ).getTableNames()
+        if pattern:
+            rx = re.compile(pattern)
+            return [ x for x in names if rx.search( x ) ]
+        else:
+            return names
 
     def hasTable( self, tablename ):
-        """return table with name *tablename*."""
+        """return True if the database contains a table *tablename*."""
         self.connect()
-        return tablename in set( [x.name for x in self.metadata.sorted_tables])
+        return getDatabase( self.backend ).hasTable( tablename )
 
     def getTable( self, tablename ):
         """return table or view with name *tablename*."""
         self.connect()
-        try:
-            for table in self.metadata.sorted_tables:
-                if table.name == tablename: return table
-        except AttributeError, msg:
-            return self.metadata.tables[tablename]
-
-        raise IndexError( "table %s no found" % name )
+        return getDatabase( self.backend ).getTable( tablename )
 
     def getColumns( self, tablename ):
         '''return a list of columns in table *tablename*.'''
-        c = self.getTable( tablename ).columns
-        return [ re.sub( "%s[.]" % tablename, "", x.name) for x in c ]
+        self.connect()
+        c = getDatabase( self.backend ).getColumns( tablename )
+        return [ re.sub( "%s[.]" % tablename, "", x) for x in c ]
 
-    def execute(self, stmt ):
+    def execute(self, stmt, kwargs = None ):
+        '''execute SQL statement *stmt*.
+
+        If *kwargs* are given, they are bound to the ``:name`` parameters 
+        in *stmt*. Statements with parameters are compiled once per 
+        tracker (see :meth:`getStatement`).
+        '''
         self.connect()
+        sqlalchemy, exc = getSQLAlchemy()
         try:
-            r = self.db.execute(stmt)
-        except exc.SQLError, msg:
+            if kwargs:
+                r = self.db.execute( self.getStatement( stmt ), kwargs )
+            else:
+                r = self.db.execute(stmt)
+        except exc.SQLAlchemyError, msg:
             raise SQLError(msg)
         return r
 
-    def buildStatement( self, stmt ):
-        '''fill in placeholders in stmt.'''
-        
-        kwargs = self.members( getCallerLocals() )
-        statement = stmt % dict( kwargs.items() )
+    def getStatement( self, stmt ):
+        '''return the compiled statement with bound parameters for *stmt*.'''
+        try:
+            return self._statements[stmt]
+        except AttributeError:
+            self._statements = {}
+        except KeyError:
+            pass
+
+        # statements with interpolated values are all different
+        if len(self._statements) >= self.max_statements:
+            self._statements.clear()
+
+        sqlalchemy, exc = getSQLAlchemy()
+        statement = self._statements[stmt] = sqlalchemy.text( stmt )
         return statement
 
-    def getValue( self, stmt ):
+    def buildStatement( self, stmt, kwargs = None ):
+        '''fill in placeholders in stmt.
+
+        ``%(name)s`` placeholders are filled in from *kwargs* and the
+        attributes of the tracker. The local variables of the calling 
+        function are only used if :attr:`use_caller_locals` is set.
+        '''
+        if "%" not in stmt: return stmt
+        if kwargs:
+            return stmt % self.members( kwargs )
+        if self.use_caller_locals:
+            return stmt % self.members( getCallerLocals() )
+        try:
+            return stmt % self.members()
+        except KeyError, msg:
+            if self.use_caller_locals == False: raise
+            warnings.warn( "%s: placeholder %s filled in from the locals of the caller; "
+                           "pass it as a keyword argument or set use_caller_locals = True" % \
+                               (self.__class__.__name__, msg), 
+                           DeprecationWarning, stacklevel = 3 )
+            return stmt % self.members( getCallerLocals() )
+
+    def getValue( self, stmt, **kwargs ):
         """returns a single value from SQL statement *stmt*.
 
         The SQL statement is subjected to variable interpolation.
@@ -301,13 +688,13 @@ class TrackerSQL( Tracker ):
         This function will return the first value in the first row
         from a SELECT statement.
         """
-        statement = self.buildStatement(stmt)
-        result = self.execute(statement).fetchone()
+        statement = self.buildStatement(stmt, kwargs)
+        result = self.execute(statement, kwargs).fetchone()
         if result == None:
             raise SQLError( "no result from %s" % statement )
         return result[0]
 
-    def getFirstRow( self, stmt ):
+    def getFirstRow( self, stmt, **kwargs ):
         """return a row of values from SQL statement *stmt* as a list.
 
         The SQL statement is subjected to variable interpolation.
@@ -317,11 +704,11 @@ class TrackerSQL( Tracker ):
 
         Returns None if result is empty.
         """
-        e = self.execute(self.buildStatement(stmt)).fetchone()
+        e = self.execute(self.buildStatement(stmt, kwargs), kwargs).fetchone()
         if e: return list(e)
         else: return None
 
-    def getRow( self, stmt ):
+    def getRow( self, stmt, **kwargs ):
         """return a row of values from an SQL statement as dictionary.
 
         This function will return the first row from a SELECT 
@@ -329,12 +716,12 @@ class TrackerSQL( Tracker ):
 
         Returns None if result is empty.
         """
-        e = self.execute( self.buildStatement( stmt )).fetchone()
+        e = self.execute( self.buildStatement( stmt, kwargs ), kwargs).fetchone()
         # assumes that values are sorted in ResultProxy.keys()
         if e: return odict( [x,e[x]] for x in e.keys() )
         else: return None
 
-    def getValues( self, stmt ):
+    def getValues( self, stmt, **kwargs ):
         """return values from SQL statement *stmt* as a list.
 
         This function will return the first value in each row
@@ -342,11 +729,11 @@ class TrackerSQL( Tracker ):
 
         Returns an empty list if there is no result.
         """
-        e = self.execute(self.buildStatement(stmt)).fetchall()
+        e = self.execute(self.buildStatement(stmt, kwargs), kwargs).fetchall()
         if e: return [x[0] for x in e]
         return []
 
-    def getAll( self, stmt ):
+    def getAll( self, stmt, **kwargs ):
         """return all rows from SQL statement *stmt* as a dictionary.
 
         The dictionary contains key/values pairs where keys are
@@ -358,12 +745,70 @@ class TrackerSQL( Tracker ):
         Returns an empty dictionary if there is no result.
         """
         # convert to tuples
-        e = self.execute(self.buildStatement(stmt))
+        e = self.execute(self.buildStatement(stmt, kwargs), kwargs)
         columns = e.keys()
         d = e.fetchall()
         return odict( zip( columns, zip( *d ) ) )
 
-    def get( self, stmt ):
+    def getArrays( self, stmt, **kwargs ):
+        """return all rows from SQL statement *stmt* as a dictionary 
+        of columns.
+
+        The dictionary contains key/values pairs where keys are
+        the selected columns and the values are the results. Numeric
+        columns are returned as numpy arrays, other columns and columns
+        with NULL values as tuples.
+
+        Example: SELECT column1, column2 FROM table
+        Example: { 'column1': array([1,2,3]), 'column2' : array([2.0,4.0,2.0]) }
+
+        Rows are fetched in batches of :attr:`fetch_size` rows, so that
+        large results are not held as python objects. 
+
+        Returns an empty dictionary if there is no result.
+        """
+        return DataTree.concatenateBatches( self.iterBatches( self.buildStatement( stmt, kwargs ), kwargs ) )
+
+    def getBatches( self, stmt, **kwargs ):
+        """return a stream of the rows from SQL statement *stmt*.
+
+        The stream is a generator that yields batches of at most
+        :attr:`fetch_size` rows as dictionaries of columns as in 
+        :meth:`getArrays`. A tracker can return the stream instead 
+        of the data, for example::
+
+           def __call__( self, track ):
+               return self.getBatches( "SELECT length FROM %s_lengths" % track )
+
+        Streams are not cached. Transformers such as ``stats`` or 
+        ``histogram`` summarize the batches without keeping all rows
+        in memory.
+
+        The statement is executed when the first batch is requested.
+        """
+        return self.iterBatches( self.buildStatement( stmt, kwargs ), kwargs )
+
+    def iterBatches( self, statement, kwargs = None ):
+        '''iterate over the rows of *statement* in batches of columns.'''
+        import numpy
+        e = self.execute( statement, kwargs )
+        columns = e.keys()
+        # textual statements have no result processors, read
+        # plain tuples from the database cursor
+        try:
+            while 1:
+                rows = e.cursor.fetchmany( self.fetch_size )
+                if not rows: break
+                batch = odict()
+                for column, values in zip( columns, zip( *rows ) ):
+                    a = numpy.array( values )
+                    if a.dtype.kind in "biuf": batch[column] = a
+                    else: batch[column] = values
+                yield batch
+        finally:
+            e.close()
+
+    def get( self, stmt, **kwargs ):
         """return all results from an SQL statement as list of tuples.
 
         Example: SELECT column1, column2 FROM table
@@ -371,9 +816,9 @@ class TrackerSQL( Tracker ):
 
         Returns an empty list if there is no result.
         """
-        return self.execute(self.buildStatement(stmt)).fetchall()
+        return self.execute(self.buildStatement(stmt, kwargs), kwargs).fetchall()
 
-    def getDict( self, stmt ):
+    def getDict( self, stmt, **kwargs ):
         """return results from SQL statement *stmt* as a dictionary.
 
         Example: SELECT column1, column2 FROM table
@@ -382,17 +827,17 @@ class TrackerSQL( Tracker ):
         The first column is taken as the dictionary key
         """
         # convert to tuples
-        e = self.execute(self.buildStatement(stmt))
+        e = self.execute(self.buildStatement(stmt, kwargs), kwargs)
         columns = e.keys()
         result = odict()
         for row in e:
             result[row[0]] = odict( zip( columns[1:], row[1:] ) )
         return result
 
-    def getIter( self, stmt ):
+    def getIter( self, stmt, **kwargs ):
         '''returns an iterator over results of SQL statement *stmt*.
         '''
-        return self.execute(stmt)
+        return self.execute(stmt, kwargs)
     
     def getTracks(self, *args, **kwargs):
         """return a list of all tracks that this tracker provides.
@@ -401,11 +846,11 @@ class TrackerSQL( Tracker ):
         :attr:`pattern`.
         """
         rx = re.compile(self.pattern)
-        tables = self.getTables( pattern = self.pattern )
+        tables = self.getTableNames( pattern = self.pattern )
         if self.as_tables:
-            return sorted([ x.name for x in tables ] )
+            return sorted( tables )
         else: 
-            return sorted([rx.search( x.name).groups()[0] for x in tables] )
+            return sorted([rx.search( x ).groups()[0] for x in tables] )
 
 ###########################################################################
 ###########################################################################
@@ -440,7 +885,7 @@ class TrackerSQLCheckTables(TrackerSQL):
         else:
             keep = lambda x: re.search( self.mIncludePattern % track, x )
 
-        return [ x for x in self.getTables() if keep(x.name) ]
+        return [ x for x in self.getTableNames() if keep(x) ]
         
     def __call__(self, track, slice = None):
         """count number of unique occurances of field *slice* in tables matching *track*."""
@@ -448,11 +893,11 @@ class TrackerSQLCheckTables(TrackerSQL):
         tables = self.getTablesOfInterest( track )
         data = []
         for table in tables:
-            if slice not in [x.name for x in table.columns]: continue
+            if slice not in self.getColumns( table ): continue
             # remove the table name and strip offensive characters
-            field = re.sub( self.mIncludePattern % track, "", table.name ).strip( "._:@$!?#")
+            field = re.sub( self.mIncludePattern % track, "", table ).strip( "._:@$!?#")
             data.append( (field,
-                          self.getValue( "SELECT COUNT(DISTINCT %s) FROM %s" % (slice, table.name) ) ) )
+                          self.getValue( "SELECT COUNT(DISTINCT %s) FROM %s" % (slice, table) ) ) )
         return odict( data )
         
 ###########################################################################
@@ -631,7 +1076,43 @@ class SingleTableTrackerRows( TrackerSQL ):
     def __call__(self, track, slice = None ):
         if len(self.fields) == 1: track = (track,)
         wheres = " AND ".join([ "%s = '%s'" % (x,y) for x,y in zip( self.fields, track ) ] )
-        return self.getValue( "SELECT %(slice)s FROM %(table)s WHERE %(wheres)s" ) 
+        return self.getValue( "SELECT %s FROM %s WHERE %s" % (slice, self.table, wheres) )
+
+    def getBulk( self, paths, **kwargs ):
+        '''return values for all track/slice *paths* with a single query.'''
+        columns = list(set( [ x[1] for x in paths if len(x) == 2 ] ))
+        if not columns: return {}
+
+        nfields = len(self.fields)
+        tracks = list(set( [ x[0] for x in paths if len(x) == 2 ] ))
+
+        result = {}
+        # restrict the query to the tracks required, the number of 
+        # bound parameters in a statement is limited
+        chunk = max( 1, self.max_parameters / nfields )
+        for start in range( 0, len(tracks), chunk ):
+            wheres, kwargs = [], {}
+            for x, track in enumerate( tracks[start:start+chunk] ):
+                if nfields == 1: track = (track,)
+                conditions = []
+                for y, (field, value) in enumerate( zip( self.fields, track ) ):
+                    conditions.append( "%s = :p%i_%i" % (field, x, y) )
+                    kwargs["p%i_%i" % (x,y)] = value
+                wheres.append( "(%s)" % " AND ".join( conditions ) )
+
+            statement = "SELECT %s, %s FROM %s WHERE %s" % (",".join(self.fields), 
+                                                            ",".join(columns), 
+                                                            self.table,
+                                                            " OR ".join( wheres ) )
+
+            for row in self.get( statement, **kwargs ):
+                if nfields == 1: track = row[0]
+                else: track = tuple(row[:nfields])
+                for column, value in zip( columns, row[nfields:] ):
+                    # keep the first value as in :meth:`getValue`
+                    if (track, column) not in result: result[(track,column)] = value
+                
+        return result
 
 ###########################################################################
 ###########################################################################
@@ -681,9 +1162,35 @@ class SingleTableTrackerColumns( TrackerSQL ):
         return self.getValues( "SELECT DISTINCT %(column)s FROM %(table)s" )
 
     def __call__(self, track, slice = None ):
-        data = self.getValue( "SELECT %(track)s FROM %(table)s WHERE %(column)s = '%(slice)s'" )
+        data = self.getValue( "SELECT %s FROM %s WHERE %s = '%s'" % (track, self.table, self.column, slice) )
         return data
 
+    def getBulk( self, paths, **kwargs ):
+        '''return values for all track/slice *paths* with a single query.'''
+        tracks = list(set( [ x[0] for x in paths if len(x) == 2 ] ))
+        if not tracks: return {}
+
+        slices = list(set( [ x[1] for x in paths if len(x) == 2 ] ))
+
+        result = {}
+        # restrict the query to the slices required, the number of 
+        # bound parameters in a statement is limited
+        for start in range( 0, len(slices), self.max_parameters ):
+            kwargs = dict( [ ("p%i" % x, y) for x, y in enumerate( slices[start:start+self.max_parameters] ) ] )
+            statement = "SELECT %s, %s FROM %s WHERE %s IN (%s)" % (self.column, 
+                                                                    ",".join(tracks), 
+                                                                    self.table,
+                                                                    self.column,
+                                                                    ",".join( [ ":p%i" % x for x in range(len(kwargs)) ] ) )
+
+            for row in self.get( statement, **kwargs ):
+                slice = row[0]
+                for track, value in zip( tracks, row[1:] ):
+                    # keep the first value as in :meth:`getValue`
+                    if (track, slice) not in result: result[(track,slice)] = value
+
+        return result
+
 ###########################################################################
 ###########################################################################
 ###########################################################################
@@ -728,9 +1235,24 @@ class SingleTableTrackerHistogram( TrackerSQL ):
 
     def __call__(self, track, slice = None ):
         if self.column == None: raise NotImplementedError( "column not set - Tracker not fully implemented" )
-        data = self.getAll( "SELECT %(column)s, %(track)s FROM %(table)s" )
+        data = self.getArrays( "SELECT %s, %s FROM %s" % (self.column, track, self.table) )
         return data
 
+    def getBulk( self, paths, **kwargs ):
+        '''return histograms for all track *paths* with a single query.'''
+        if self.column == None: raise NotImplementedError( "column not set - Tracker not fully implemented" )
+        tracks = list(set( [ x[0] for x in paths ] ))
+
+        data = self.getArrays( "SELECT %s, %s FROM %s" % (self.column, ",".join(tracks), self.table ) )
+        if not data: return {}
+
+        result = {}
+        for path in paths:
+            track = path[0]
+            result[path] = odict( ((self.column, data[self.column]), 
+                                   (track, data[track]) ) )
+        return result
+
 
 ###########################################################################
 ###########################################################################
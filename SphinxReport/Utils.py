@@ -9,28 +9,62 @@ import SphinxReport.Config
 
 from SphinxReport.odict import OrderedDict as odict
 
-import types, copy, numpy
+import types, copy
 
-ContainerTypes = (types.TupleType, types.ListType, type(numpy.zeros(0)))
+# types of arrays and numbers, see getContainerTypes() and getNumberTypes()
+_types = {}
 
-# Taken from numpy.scalartype, but removing the types object and unicode
-# None is allowed to represent missing values. numpy.float128 is a recent
-# numpy addition.
-try:
-    NumberTypes = (types.IntType, types.FloatType, types.LongType, types.NoneType,
-               numpy.int8, numpy.int16, numpy.int32, numpy.int64, 
-               numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64, 
-               numpy.float32, numpy.float64, numpy.float128 )
-except AttributeError, msg:
-    NumberTypes = (types.IntType, types.FloatType, types.LongType, types.NoneType,
-               numpy.int8, numpy.int16, numpy.int32, numpy.int64, 
-               numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64, 
-               numpy.float32, numpy.float64 )
-    
+def _getTypes():
+    '''return the types of arrays and numbers.
+
+    numpy is slow to import and only imported on first use.
+    '''
+    if _types: return _types
+    import numpy
+    _types["container"] = (types.TupleType, types.ListType, type(numpy.zeros(0)), numpy.memmap)
+
+    # Taken from numpy.scalartype, but removing the types object and unicode
+    # None is allowed to represent missing values. numpy.float128 is a recent
+    # numpy addition.
+    try:
+        _types["number"] = (types.IntType, types.FloatType, types.LongType, types.NoneType,
+                   numpy.int8, numpy.int16, numpy.int32, numpy.int64, 
+                   numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64, 
+                   numpy.float32, numpy.float64, numpy.float128 )
+    except AttributeError, msg:
+        _types["number"] = (types.IntType, types.FloatType, types.LongType, types.NoneType,
+                   numpy.int8, numpy.int16, numpy.int32, numpy.int64, 
+                   numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64, 
+                   numpy.float32, numpy.float64 )
+    return _types
+
+def getContainerTypes():
+    '''return the types that are arrays.'''
+    return _getTypes()["container"]
+
+def getNumberTypes():
+    '''return the types that are numbers.'''
+    return _getTypes()["number"]
 
 def isArray( data ):
     '''return True if data is an array.'''
-    return type(data) in ContainerTypes
+    return type(data) in getContainerTypes()
+
+def isNumpyArray( data ):
+    '''return True if data is a numpy array.
+
+    numpy is not imported, as no arrays exist before it is.
+    '''
+    numpy = sys.modules.get( "numpy" )
+    return numpy != None and isinstance( data, numpy.ndarray )
+
+def isNumericArray( data ):
+    '''return True if data is a numpy array of numbers.
+
+    Such arrays can not contain None values and can be used 
+    without copying, for example if they are memory-mapped.
+    '''
+    return isNumpyArray( data ) and data.dtype.kind in "biuf"
     
 def is_numeric(obj):
     attrs = ['__add__', '__sub__', '__mul__', '__div__', '__pow__']
@@ -56,7 +90,17 @@ def quote_rst( text ):
 PARAMS = {
     "report_show_errors" : True,
     "report_sql_backend" : "sqlite:///./csvdb",
+    "report_sql_pool_size" : 5,
+    "report_sql_max_overflow" : 10,
     "report_cachedir" : "_cache",
+    "report_cache_backend" : "sqlite",
+    "report_cache_batchsize" : 100,
+    "report_cache_compress_threshold" : 1048576,
+    "report_cache_memmap_threshold" : 16777216,
+    "report_cache_maxsize" : 0,
+    "report_cache_memory_size" : 134217728,
+    "report_journal_mode" : "WAL",
+    "report_manifest_fingerprint" : True,
     "report_urls" : "data,code,rst",
     "report_images" : "hires,hires.png,200,eps,eps,50",
     }
@@ -153,6 +197,62 @@ def getImageFormats( ):
         
     return default_format, additional_formats
 
+def getSphinxConfig( filename = "conf.py" ):
+    '''return the variables defined in the sphinx configuration
+    file *filename* as a dictionary.
+
+    The file is only executed once, when the configuration is
+    first requested. Returns an empty dictionary if *filename* 
+    does not exist.
+    '''
+    try:
+        return _sphinx_config[filename]
+    except KeyError:
+        config = {}
+        if os.path.exists( filename ): execfile( filename, config )
+        _sphinx_config[filename] = config
+        return config
+
+_sphinx_config = {}
+
+class LazyImport( object ):
+    '''proxy for module *name* that is imported when the proxy 
+    is first used.
+
+    If *attribute* is given, the proxy stands for this attribute
+    of the module. *modules* are imported together with *name*,
+    for example sub-modules or modules with side-effects.
+    '''
+    def __init__(self, name, attribute = None, modules = () ):
+        self._name = name
+        self._attribute = attribute
+        self._modules = modules
+        self._object = None
+
+    def _get( self ):
+        # objects might overload comparison
+        if self._object is None:
+            for x in (self._name,) + tuple(self._modules): __import__( x )
+            obj = sys.modules[self._name]
+            if self._attribute: obj = getattr( obj, self._attribute )
+            self._object = obj
+        return self._object
+
+    def __getattr__( self, key ):
+        # attributes of a proxy that has not been initialized
+        if key in ("_name", "_attribute", "_modules", "_object"): raise AttributeError( key )
+        return getattr( self._get(), key )
+
+    def __getitem__( self, key ):
+        return self._get()[key]
+
+    def __call__( self, *args, **kwargs ):
+        return self._get()( *args, **kwargs )
+
+def getSourceSuffix():
+    '''return suffix of restructured text files.'''
+    return getSphinxConfig().get( "source_suffix", ".rst" )
+
 ## read placeholders from config file in current directory
 ## It would be nice to read default values, but the location 
 ## of the documentation source files are not known to this module. 
@@ -179,13 +279,16 @@ class memoized(object):
        """Return the function's docstring."""
        return self.func.__doc__
 
-@memoized
-def getModule( name ):
-    """load module in fullpath
-    """
-    # remove leading '.'
-    debug( "entered getModule with `%s`" % name )
+# modification times of modules loaded by getModule
+_module_mtimes = {}
 
+def findModule( name ):
+    """find module *name* without loading it.
+
+    returns a tuple of the module name, the open module file,
+    the path name and the description as returned by
+    :func:`imp.find_module`.
+    """
     parts = name.split(".")
 
     if parts[0] == "Tracker":
@@ -217,6 +320,24 @@ def getModule( name ):
         warn("could not find module %s: msg=%s" % (name,msg) )        
         raise ImportError("could not find module %s: msg=%s" % (name,msg) )
 
+    return name, file, pathname, description
+
+def getModulePath( name ):
+    """return the path name of module *name* without loading it."""
+    name, file, pathname, description = findModule( name )
+    if file: file.close()
+    return pathname
+
+@memoized
+def getModule( name ):
+    """load module in fullpath
+    """
+    # remove leading '.'
+    debug( "entered getModule with `%s`" % name )
+    fullname = name
+
+    name, file, pathname, description = findModule( name )
+
     stdout = sys.stdout
     sys.stdout = cStringIO.StringIO()
     debug( "loading module: %s: %s, %s, %s" % (name, file, pathname, description) )
@@ -234,8 +355,36 @@ def getModule( name ):
         file.close()
         sys.stdout = stdout
 
+    _module_mtimes[fullname] = os.path.getmtime( pathname )
+
     return module, pathname
 
+def checkModules():
+    """forget modules loaded by :func:`getModule` whose files
+    have changed since loading and the trackers created from them.
+
+    Modules are loaded again when they are next requested. This
+    permits long-running processes to pick up changes to trackers.
+
+    returns a list of names of changed modules.
+    """
+    changed = []
+    for name, mtime in _module_mtimes.items():
+        module, pathname = getModule.cache[(name,)]
+        try:
+            if os.path.getmtime( pathname ) == mtime: continue
+        except OSError:
+            pass
+        changed.append( name )
+        del getModule.cache[(name,)]
+        del _module_mtimes[name]
+
+    for key in makeTracker.cache.keys():
+        if os.path.splitext( key[0] )[0] in changed:
+            del makeTracker.cache[key]
+
+    return changed
+
 def getCode( cls, pathname ):
     '''retrieve code for methods and functions.'''
     # extract code
@@ -444,7 +593,6 @@ def getRenderer( renderer_name, **kwargs ):
 
     return renderer
 
-from pkg_resources import resource_string
 from pkgutil import get_loader
 
 def my_get_data(package, resource):
@@ -20,9 +20,81 @@ on the command line.
 **-v/--verbose** verbosity level
     Increase the number of status messages displayed.
 
+Work is scheduled by the expected duration of each :term:`report`
+directive, longest first. Durations are recorded in the file
+:file:`sphinxreport.timings` after each build.
+
+**--serve** host:port
+    Serve work items to workers on other hosts instead of running
+    them in a local process pool. :option:`-a/--num-jobs` workers
+    are started on the local host. Log messages of all workers are
+    collected in the log file of the server.
+
+**--worker** host:port
+    Start :option:`-a/--num-jobs` workers that run work items from the
+    server at host:port. Workers need to be started in the same 
+    directory as the server, for example on a shared file system.
+    Only the sphinxreport options are required::
+
+       sphinxreport-build --worker=server:50000 --authkey=secret --num-jobs=8
+
+**--daemon** host:port
+    Run a daemon with :option:`-a/--num-jobs` persistent workers that
+    process the work items of successive builds submitted with
+    :option:`--connect`. Workers load the plugins, tracker modules and
+    trackers once and connect to databases when they start. Changed
+    tracker modules are reloaded at the start of each build. The daemon
+    needs to be started in the same directory as the builds and 
+    restarted after changes to :file:`conf.py`::
+
+       sphinxreport-build --daemon=localhost:50001 --num-jobs=8
+
+**--connect** host:port
+    Submit work items to the daemon at host:port instead of
+    starting new processes.
+
+**--authkey** key
+    Authentication key shared by the server, the daemon and the workers.
+    Required if the address is not ``localhost``: anyone who can connect
+    with the key can run code in the workers. Distributed builds on
+    other addresses also require the journal mode ``DELETE`` (see 
+    ``journal_mode``), as write-ahead logging does not work on network 
+    file systems.
+
+Work items of workers on other hosts that stop sending heartbeats,
+for example because the host has crashed, are handed out again once. 
+The claims of such workers in the cache are released.
+
+**--shard** i/n
+    Only build the i-th of n shards of the work items and do not build
+    the document. Directives are distributed by their duration in
+    previous builds, otherwise by a hash of document, line and tracker.
+    i runs from 1 to n. Outputs of trackers whose code has changed are
+    not removed, as they might belong to other shards in the same
+    directory. They are removed by the build with :option:`--merge`.
+
+**--merge** directory
+    Before building, merge the rendered files, cache entries and
+    build manifest of a sharded build in directory. The option can be 
+    given several times. Sharded builds run in the same directory 
+    only need their timings merged, which is done with ``--merge=.``.
+
+**--watch**
+    After building, watch the restructured text files and the
+    modules of the trackers used for changes. Directives whose text
+    or whose tracker code has changed are rendered again in the
+    same process and the document is rebuilt by sphinx. Changed
+    tracker modules are reloaded.
+
+**-p/--prewarm** 
+    Collect the data for all :term:`report` directives in parallel
+    and store them in the cache before rendering. Data are collected
+    separately for each :term:`track` and :term:`slice`. Rendering
+    then only reads data from the cache.
+
 """
 
-import sys, os, re, types, glob, optparse, traceback, hashlib
+import sys, os, re, types, glob, optparse, traceback, hashlib, sqlite3, shutil
 import subprocess, logging, time, collections
 USAGE = """python %s [OPTIONS] args
 
@@ -32,7 +104,8 @@ Building proceeds in three phases.
 
 """
 
-from SphinxReport import report_directive, gallery, clean, Utils
+from SphinxReport import report_directive, gallery, clean, Utils, Cache, Dispatcher, JobServer, Manifest, DirectiveIndex, Tracker
+from SphinxReport.DirectiveIndex import ReportBlock, rst_reader
 
 from SphinxReport.Component import *
 
@@ -44,11 +117,14 @@ try:
 except ImportError:
     from threading import Thread as Process
 
-# import conf.py for source_suffix
-if not os.path.exists("conf.py"):
-    raise IOError( "could not find conf.py" )
+# database with durations of directives in previous builds
+TIMINGSFILE = "sphinxreport.timings"
+
+# database with hashes of the code of trackers
+CODESFILE = "sphinxreport.codes"
 
-execfile( "conf.py" )
+# authentication key for job servers on localhost
+LOCAL_AUTHKEY = "sphinxreport"
 
 RST_TEMPLATE = """.. _%(label)s:
 
@@ -64,27 +140,15 @@ RST_TEMPLATE = """.. _%(label)s:
 #     format='%(asctime)s %(levelname)s %(message)s',
 #     stream = open( Component.LOGFILE, "a" ) )
 
-class ReportBlock:
-    '''quick and dirty parsing of rst of a report block.'''
-    def __init__(self): 
-        self.mLines = []
-        self.mOptions = {}
-        self.mArguments = None
-        self.mCaption = []
-
-    def append(self,v):
-        s = v.strip()
-        if s.startswith( ".. report::" ):
-            self.mArguments = re.match( ".. report::\s+(\S+)", s ).groups()
-        else:
-            s = re.match( ":(\S+):\s*(\S*)", v.strip())
-            if s:
-                key, value = s.groups()
-                self.mOptions[key] = value
-            else:
-                self.mCaption.append( v )
-        self.mLines.append( v )
-        
+def formatException():
+    '''return a tuple with name, value and stack of the
+    current exception.'''
+    exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
+    exception_stack  = traceback.format_exc(exceptionTraceback)
+    exception_name   = exceptionType.__module__ + '.' + exceptionType.__name__
+    exception_value  = str(exceptionValue)
+    return (exception_name, exception_value, exception_stack)
+
 def run( work ):
     """run a set of worker jobs.
     """
@@ -107,47 +171,287 @@ def run( work ):
 
         return None
     except:
-        exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
-        exception_stack  = traceback.format_exc(exceptionTraceback)
-        exception_name   = exceptionType.__module__ + '.' + exceptionType.__name__
-        exception_value  = str(exceptionValue)
-        return (exception_name, exception_value, exception_stack)
-
-def rst_reader(infile ):
-    """parse infile and extract the :render: block."""
-    
-    result = None
-    keep = 0
-    lineno = 0
-    for line in infile:
-        lineno += 1
-        if line.startswith( ".. report::" ):
-            if result: yield lineno, result
-            keep = True
-            result = ReportBlock()
-            result.append( line )
+        return formatException()
+
+def getDirectiveKey( block ):
+    '''return key identifying a :class:`ReportBlock` across builds.'''
+    return "%s %s" % (block.mArguments[0], str(sorted(block.mOptions.items())))
+
+def runTimed( work ):
+    '''run a set of worker jobs and record the duration of each.
+
+    returns a tuple of exception and a list of tuples 
+    (key, duration). Exception is None if all jobs succeeded.
+    '''
+    timings = []
+    for item in work:
+        start = time.time()
+        error = run( (item,) )
+        timings.append( (getDirectiveKey( item[2] ), time.time() - start ) )
+        if error: return error, timings
+    return None, timings
+
+def releaseWorker( worker ):
+    '''release the cache claims of *worker* that has died.'''
+    try:
+        n = Cache.releaseClaims( worker )
+    except sqlite3.Error, msg:
+        warn( "build.releaseWorker: could not release claims of %s: msg=%s" % (worker, msg) )
+        return
+    if n: warn( "build.releaseWorker: released %i claims of %s" % (n, worker) )
+
+def getJobResults( results ):
+    '''return results of a job server with work items that
+    could not be completed converted to exceptions.'''
+    return [ ((JobServer.JobError.__name__, str(x), "%s\n" % str(x)), []) \
+                 if isinstance( x, JobServer.JobError ) else x for x in results ]
+
+class TimingDatabase:
+    '''durations of directives in previous builds.
+
+    Durations are stored in an sqlite database in *filename*.
+    '''
+    def __init__(self, filename = TIMINGSFILE ):
+        self.filename = filename
+        self.mTimings = {}
+        try:
+            db = sqlite3.connect( filename )
+            try:
+                db.execute( "CREATE TABLE IF NOT EXISTS timings (key TEXT PRIMARY KEY, duration REAL)" )
+                self.mTimings = dict( db.execute( "SELECT key, duration FROM timings" ).fetchall() )
+            finally:
+                db.close()
+        except sqlite3.Error, msg:
+            warn( "could not read timings from %s: msg=%s" % (filename, msg) )
+
+    def getExpected( self, work ):
+        '''return the expected duration of the jobs in *work*.
+
+        returns None if any job has not been timed before.
+        '''
+        total = 0
+        for f, lineno, b, srcdir, builddir in work:
+            try: total += self.mTimings[getDirectiveKey( b )]
+            except KeyError: return None
+        return total
+
+    def sort( self, work ):
+        '''sort *work* by decreasing expected duration.
+
+        Work without previous timings is scheduled first.
+        '''
+        expected = [ (self.getExpected( x ), x) for x in work ]
+        expected.sort( key = lambda x: (x[0] != None, -(x[0] or 0)) )
+        return [ x[1] for x in expected ]
+
+    def update( self, timings ):
+        '''save *timings*, a list of tuples (key, duration).'''
+        if not timings: return
+        try:
+            db = sqlite3.connect( self.filename )
+            try:
+                db.executemany( "INSERT OR REPLACE INTO timings (key, duration) VALUES (?,?)", timings )
+                db.commit()
+            finally:
+                db.close()
+        except sqlite3.Error, msg:
+            warn( "could not save timings to %s: msg=%s" % (self.filename, msg) )
+        self.mTimings.update( dict(timings) )
+
+    def merge( self, filename ):
+        '''add timings from the database in *filename*.'''
+        self.update( TimingDatabase( filename ).mTimings.items() )
+
+def hashModule( args ):
+    '''return md5 hashes of the code of the trackers *names* in 
+    module file *pathname*.
+
+    *args* is a tuple of *pathname* and *names*. The module is
+    not loaded. returns a list of tuples of name and hash.
+    '''
+    pathname, names = args
+    return [ (name, hashlib.md5( "".join( Utils.getCode( name, pathname ) ) ).hexdigest() ) \
+                 for name in names ]
+
+class CodeDatabase:
+    '''hashes of the code of trackers.
+
+    Hashes are stored in an sqlite database in *filename* together
+    with the modification time and size of the module file. Hashes
+    are computed again only if the module file has changed.
+    '''
+    def __init__(self, filename = CODESFILE ):
+        self.filename = filename
+        self.mHashes = {}
+        try:
+            db = sqlite3.connect( filename )
+            db.text_factory = str
+            try:
+                db.execute( '''CREATE TABLE IF NOT EXISTS codes (pathname TEXT, name TEXT, 
+                                                                mtime REAL, size INTEGER, hash TEXT,
+                                                                PRIMARY KEY (pathname, name))''' )
+                for pathname, name, mtime, size, h in db.execute( "SELECT * FROM codes" ):
+                    self.mHashes[(pathname, name)] = ((mtime, size), h)
+            finally:
+                db.close()
+        except sqlite3.Error, msg:
+            warn( "could not read code hashes from %s: msg=%s" % (filename, msg) )
+
+    def getHashes( self, modules, num_jobs = 1 ):
+        '''return code hashes of trackers in *modules*.
+
+        *modules* is a dictionary mapping module file names to the 
+        names of trackers in them. Modules that have changed are 
+        hashed in parallel with *num_jobs* processes.
+
+        returns a dictionary mapping tuples of module file name
+        and tracker name to the hash.
+        '''
+        result, work, stats = {}, [], {}
+        for pathname, names in modules.iteritems():
+            stats[pathname] = DirectiveIndex.getStat( pathname )
+            missing = []
+            for name in names:
+                try:
+                    stat, h = self.mHashes[(pathname, name)]
+                except KeyError:
+                    missing.append( name )
+                    continue
+                if stat == stats[pathname]: result[(pathname,name)] = h
+                else: missing.append( name )
+            if missing: work.append( (pathname, missing) )
+
+        if not work: return result
+
+        if num_jobs > 1 and len(work) > 1:
+            pool = Pool( num_jobs )
+            try:
+                hashes = pool.map( hashModule, work )
+            finally:
+                pool.close()
+                pool.join()
         else:
-            if keep: 
-                if re.match( "^\S", line ):
-                    keep = False
-                else:
-                    result.append( line )
+            hashes = map( hashModule, work )
 
-    if result: yield lineno, result
-    
-def getBlocksFromRstFile( rst_file ):
+        updates = []
+        for (pathname, names), values in zip( work, hashes ):
+            stat = stats[pathname]
+            for name, h in values:
+                result[(pathname,name)] = h
+                self.mHashes[(pathname,name)] = (stat, h)
+                if stat: updates.append( (pathname, name, stat[0], stat[1], h) )
 
-    blocks = []
+        try:
+            db = sqlite3.connect( self.filename )
+            try:
+                db.executemany( "INSERT OR REPLACE INTO codes VALUES (?,?,?,?,?)", updates )
+                db.commit()
+            finally:
+                db.close()
+        except sqlite3.Error, msg:
+            warn( "could not save code hashes to %s: msg=%s" % (self.filename, msg) )
+
+        return result
+
+def getWorkKey( work ):
+    '''return key of a work item for sharding.'''
+    f, lineno, b, srcdir, builddir = work[0]
+    return "%s:%i:%s" % (f, lineno, b.mArguments[0])
+
+def parseShard( shard ):
+    '''parse a shard given as ``i/n``.
+
+    returns a tuple of the zero-based shard index and the 
+    number of shards.
+    '''
     try:
-        infile = open( rst_file, "r" )
-    except IOError:
-        print "could not open %s - skipped" % rst_file 
-        return blocks
+        i, n = map( int, shard.split( "/" ) )
+    except ValueError:
+        raise ValueError( "invalid shard `%s`, expected i/n" % shard )
+    if not 1 <= i <= n:
+        raise ValueError( "invalid shard `%s`, expected 1 <= i <= n" % shard )
+    return i - 1, n
+
+def getShard( work, shard, nshards, timings ):
+    '''return the work items of shard *shard* out of *nshards*.
+
+    Work items with known durations are distributed longest first
+    to the shard with the least expected duration so far. All other
+    items are distributed by a hash of document, line and tracker.
+    The partition only depends on *work* and *timings*, so that
+    all shards select disjoint subsets.
+    '''
+    known, unknown = [], []
+    for w in work:
+        expected = timings.getExpected( w )
+        if expected == None: unknown.append( (getWorkKey( w ), w) )
+        else: known.append( (expected, getWorkKey( w ), w) )
+
+    known.sort( key = lambda x: (-x[0], x[1]) )
+    loads = [0] * nshards
+    selected = []
+    for expected, key, w in known:
+        x = min( range( nshards ), key = lambda x: (loads[x], x) )
+        loads[x] += expected
+        if x == shard: selected.append( w )
+
+    for key, w in unknown:
+        if int( hashlib.md5( key ).hexdigest(), 16 ) % nshards == shard:
+            selected.append( w )
+
+    return timings.sort( selected )
+
+def expandPaths( directive ):
+    '''return the data paths that *directive* collects.
+
+    *directive* is a tuple of tracker name and dispatcher options.
+
+    returns a tuple of exception and a list of work items. Each work 
+    item is a tuple (tracker, options, path). *path* is None if all 
+    paths are collected with a single call to the tracker.
+    '''
+    reference, options = directive
+    try:
+        code, tracker = Utils.makeTracker( reference )
+        if not tracker:
+            raise ValueError( "tracker `%s` not found" % reference )
+        if Dispatcher.useBulk( tracker ):
+            return None, [ (reference, options, None) ]
+
+        dispatcher = Dispatcher.Dispatcher( tracker, None, [] )
+        dispatcher.parseArguments( **dict(options) )
+        is_function, paths = dispatcher.getCollectionPaths()
+        if is_function: paths = [()]
+        # only the tracker options change the data of a path
+        options = tuple( [ x for x in options if x[0] == "tracker" ] )
+        return None, [ (reference, options, path) for path in paths ]
+    except:
+        return formatException(), []
 
-    for lineno, rst_block in rst_reader( infile ):
-        blocks.append( (lineno, rst_block) )
-    infile.close()
-    return blocks
+def collectPaths( work ):
+    '''collect data for a list of work items and store it 
+    in the cache.
+
+    See :func:`expandPaths` for the format of work items.
+    '''
+    try:
+        for reference, options, path in work:
+            code, tracker = Utils.makeTracker( reference )
+            dispatcher = Dispatcher.Dispatcher( tracker, None, [] )
+            dispatcher.parseArguments( **dict(options) )
+            try:
+                if path == None: dispatcher.collect()
+                else: dispatcher.getData( path )
+            finally:
+                dispatcher.syncCache()
+        return None
+    except:
+        return formatException()
+
+def getBlocksFromRstFile( rst_file ):
+    '''return the report directives in *rst_file* from
+    the directive index.'''
+    return DirectiveIndex.getIndex().getBlocks( rst_file )
 
 class timeit:
     """simple timing+logging decorator"""
@@ -163,17 +467,27 @@ class timeit:
             return result
         return wrapped
 
-@timeit( "getDirectives" )
-def getDirectives( options, args, sourcedir ):
-    ''' getting directives.
+def indexDirectives( sourcedir, num_jobs = 1 ):
+    '''index the directives in the restructured text 
+    files in *sourcedir*.
+
+    Changed files are indexed in parallel.
+
+    returns the list of restructured text files.
     '''
     rst_files = []
     for root, dirs, files in os.walk( sourcedir ):
         for f in files:
-            if f.endswith( source_suffix ):
+            if f.endswith( Utils.getSourceSuffix() ):
                 rst_files.append( os.path.join( root, f) )
+    DirectiveIndex.getIndex().update( rst_files, num_jobs, prune = True )
     return rst_files
 
+@timeit( "getDirectives" )
+def getDirectives( options, args, sourcedir ):
+    ''' getting directives.'''
+    return indexDirectives( sourcedir, options.num_jobs )
+
 @timeit( "buildPlots" )
 def buildPlots( rst_files, options, args, sourcedir ):
     '''build all plot elements and tables.
@@ -182,89 +496,276 @@ def buildPlots( rst_files, options, args, sourcedir ):
     '''
     info( "building plot elements started" )
 
-    # build work. Group trackers of the same name together as
-    # the python shelve module does not allow concurrent write
-    # access and the cache files will get mangled.
+    # build work. If the cache permits concurrent writers, each
+    # directive is a separate work item. Otherwise, group trackers of 
+    # the same name together as the python shelve module does not allow 
+    # concurrent write access and the cache files will get mangled.
     work_per_tracker = collections.defaultdict( list )
+    work = []
     for f in rst_files:
         for lineno, b in getBlocksFromRstFile( f ):
-            work_per_tracker[b.mArguments].append( (f,
-                                                    lineno,
-                                                    b, 
-                                                    sourcedir, 
-                                                    "." ) )
+            item = (f, lineno, b, sourcedir, "." )
+            if Cache.isConcurrent():
+                work.append( [item] )
+            else:
+                work_per_tracker[b.mArguments].append( item )
 
-    work = []
     for tracker,vals in work_per_tracker.iteritems():
         work.append( vals )
 
     if len(work) == 0: return
 
-    if options.num_jobs > 1:
+    # schedule longest jobs first so that they do not
+    # extend the build at the end
+    timings = TimingDatabase()
+    work = timings.sort( work )
+
+    if options.shard:
+        shard, nshards = parseShard( options.shard )
+        nwork = len(work)
+        work = getShard( work, shard, nshards, timings )
+        print "SphinxReport: shard %s: %i of %i work items" % (options.shard, len(work), nwork)
+        # other shards might still read the timings, record 
+        # the timings of this shard separately
+        timings = TimingDatabase( "%s.shard-%i-%i" % (TIMINGSFILE, shard + 1, nshards ) )
+        if len(work) == 0: return
+
+    if options.connect:
+        # submit work to the workers of a daemon
+        server = JobServer.JobServer( JobServer.parseAddress( options.connect ), options.authkey,
+                                      daemon = True )
+        handler= Logger.MultiProcessingLogHandler(logging.FileHandler( os.path.abspath( LOGFILE ), "w"), server.logs)
+    elif options.serve:
+        # workers send log records to the job server
+        server = JobServer.JobServer( JobServer.parseAddress( options.serve ), options.authkey )
+        handler= Logger.MultiProcessingLogHandler(logging.FileHandler( os.path.abspath( LOGFILE ), "w"), server.logs)
+    elif options.num_jobs > 1:
         logQueue = Queue(100)
         handler= Logger.MultiProcessingLogHandler(logging.FileHandler( os.path.abspath( LOGFILE ), "w"), logQueue)
     else:
         handler= logging.FileHandler( os.path.abspath( LOGFILE ), "w")
 
-    handler.setFormatter(  
-        logging.Formatter( LOGGING_FORMAT ) )
+    try:
+        handler.setFormatter(  
+            logging.Formatter( LOGGING_FORMAT ) )
 
-    logging.getLogger('').addHandler(handler)
-    logging.getLogger('').setLevel(options.loglevel)
+        logging.getLogger('').addHandler(handler)
+        logging.getLogger('').setLevel(options.loglevel)
     
-    info('starting %i jobs on %i work items' % (options.num_jobs, len(work)))
-    debug( "build.py: profile: started: 0 seconds" )
-
-    if options.num_jobs > 1:
-        pool = Pool( options.num_jobs )
-        errors = pool.map( run, work )
-        pool.close()
-        pool.join()
-    else:
-        errors = []
-        for w in work: errors.append( run( w ) )
+        info('starting %i jobs on %i work items' % (options.num_jobs, len(work)))
+        debug( "build.py: profile: started: 0 seconds" )
+
+        # jobs are handed out one at a time as workers become idle
+        if options.connect:
+            print "SphinxReport: submitting %i work items to daemon at %s:%i" % ((len(work),) + server.address)
+            try:
+                results = getJobResults( server.run( work, onDead = releaseWorker ) )
+            finally:
+                server.finish()
+        elif options.serve:
+            print "SphinxReport: serving %i work items at %s:%i" % ((len(work),) + server.address)
+            # local workers
+            workers = [ Process( target = JobServer.runWorker, 
+                                 args = (server.getWorkerAddress(), options.authkey, runTimed ) ) \
+                            for x in range( options.num_jobs ) ]
+            for worker in workers: worker.start()
+            try:
+                results = getJobResults( server.run( work, onDead = releaseWorker ) )
+            finally:
+                server.finish()
+                for worker in workers: worker.join()
+        elif options.num_jobs > 1:
+            pool = Pool( options.num_jobs )
+            results = list( pool.imap_unordered( runTimed, work, chunksize = 1 ) )
+            pool.close()
+            pool.join()
+        else:
+            results = map( runTimed, work )
 
-    errors = [ e for e in errors if e ]
+        timings.update( [ x for e, t in results for x in t ] )
+        errors = [ e for e, t in results if e ]
             
-    if errors:
-        print "SphinxReport caught %i exceptions" % (len(errors))
-        print "## start of exceptions"
-        for exception_name, exception_value, exception_stack in errors:
-            print exception_stack,
-        print "## end of exceptions"
-        sys.exit(1)
-
-    if options.num_jobs > 1:
-        counts = handler.getCounts()
-
-        print "SphinxReport: messages: %i critical, %i errors, %i warnings, %i info, %i debug" \
-            % (counts["CRITICAL"],
-               counts["ERROR"],
-               counts["WARNING"],
-               counts["INFO"],
-               counts["DEBUG"] )
+        if errors:
+            print "SphinxReport caught %i exceptions" % (len(errors))
+            print "## start of exceptions"
+            for exception_name, exception_value, exception_stack in errors:
+                print exception_stack,
+            print "## end of exceptions"
+            sys.exit(1)
+
+        if options.serve or options.connect or options.num_jobs > 1:
+            counts = handler.getCounts()
+
+            print "SphinxReport: messages: %i critical, %i errors, %i warnings, %i info, %i debug" \
+                % (counts["CRITICAL"],
+                   counts["ERROR"],
+                   counts["WARNING"],
+                   counts["INFO"],
+                   counts["DEBUG"] )
     
-    logging.shutdown()
+        logging.shutdown()
+    finally:
+        # shut down after all log messages have been received
+        if options.serve or options.connect: server.shutdown()
+
+def getCollectionWork( rst_files, trackers = None ):
+    '''return the report directives in *rst_files* whose data 
+    are cached.
+
+    returns a sorted list of tuples of tracker name and dispatcher 
+    options. Directives with identical options are only returned once.
+    If *trackers* is given, only directives using trackers matching 
+    one of the regular expressions in *trackers* are returned.
+    '''
+    rx = [ re.compile( "%s$" % x ) for x in (trackers or []) ]
+    option_map = getOptionMap()["dispatch"]
+    work = set()
+    for f in rst_files:
+        for lineno, b in getBlocksFromRstFile( f ):
+            reference = b.mArguments[0]
+            if rx and not [ r for r in rx if r.match( reference ) ]: continue
+            options = report_directive.selectAndDeleteOptions( Utils.updateOptions( dict( b.mOptions ) ),
+                                                               option_map )
+            if "nocache" in options: continue
+            work.add( (reference, tuple( sorted( options.items() ) ) ) )
+    return sorted( work )
+
+def prewarm( rst_files, num_jobs = 1, trackers = None ):
+    '''collect data for report directives in *rst_files* 
+    and store them in the cache.
+
+    Data paths are collected in parallel with *num_jobs* processes. 
+
+    returns a tuple of the number of directives, the number
+    of data paths and a list of exceptions.
+    '''
+    directives = getCollectionWork( rst_files, trackers )
+    if len(directives) == 0: return 0, 0, []
+
+    if num_jobs > 1:
+        pool = Pool( num_jobs )
+        _map = pool.map
+    else:
+        pool = None
+        _map = map
+
+    try:
+        errors = []
+        items = set()
+        for error, paths in _map( expandPaths, directives ):
+            if error: errors.append( error )
+            items.update( paths )
+
+        # group paths of the same tracker if the cache does not
+        # permit concurrent writers
+        if Cache.isConcurrent():
+            work = [ [x] for x in sorted(items) ]
+        else:
+            work_per_tracker = collections.defaultdict( list )
+            for x in sorted(items): work_per_tracker[x[0]].append( x )
+            work = work_per_tracker.values()
+
+        errors.extend( [ x for x in _map( collectPaths, work ) if x ] )
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return len(directives), len(items), errors
+
+@timeit( "buildCache" )
+def buildCache( rst_files, options, args ):
+    '''collect data for all report directives and store them
+    in the cache.
+
+    Exceptions are reported again when the directives are rendered.
+    '''
+    ndirectives, npaths, errors = prewarm( rst_files, options.num_jobs )
+    print "SphinxReport: collected %i data paths for %i directives, %i exceptions" % \
+        (npaths, ndirectives, len(errors))
+    for exception_name, exception_value, exception_stack in errors:
+        debug( "build.buildCache: exception: %s" % exception_stack )
+
+def copyNewer( src_dir, dest_dir ):
+    '''copy files in *src_dir* to *dest_dir* that are missing
+    or older in *dest_dir*.
+
+    returns the number of files copied.
+    '''
+    ncopied = 0
+    for root, dirs, files in os.walk( src_dir ):
+        d = os.path.join( dest_dir, os.path.relpath( root, src_dir ) )
+        if not os.path.isdir( d ): os.makedirs( d )
+        for f in files:
+            src, dest = os.path.join( root, f ), os.path.join( d, f )
+            if os.path.exists( dest ) and os.path.getmtime( dest ) >= os.path.getmtime( src ):
+                continue
+            shutil.copy2( src, dest )
+            ncopied += 1
+    return ncopied
+
+@timeit( "mergeShards" )
+def mergeShards( shard_dirs, options, args ):
+    '''merge the output of sharded builds in *shard_dirs*.
+
+    Rendered files, cache entries, the manifest and the timings 
+    of each shard are added to those in the current directory.
+    Shards that were built in the current directory only need
+    their timings merged.
+    '''
+    cache_dir = Utils.PARAMS.get( "report_cachedir", None )
+    timings = TimingDatabase()
+    for shard_dir in shard_dirs:
+        for fn in glob.glob( os.path.join( shard_dir, TIMINGSFILE + ".shard-*" ) ):
+            timings.merge( fn )
+            os.remove( fn )
+
+        if os.path.samefile( shard_dir, "." ): continue
+
+        nfiles = copyNewer( os.path.join( shard_dir, "_static", "report_directive" ), 
+                            os.path.join( "_static", "report_directive" ) )
+
+        nentries = 0
+        if cache_dir:
+            if not os.path.isdir( cache_dir ): os.makedirs( cache_dir )
+            for cache_name in Cache.getCacheNames( os.path.join( shard_dir, cache_dir ) ):
+                nentries += Cache.mergeCache( os.path.join( shard_dir, cache_dir ), cache_dir, cache_name )
+
+        fn = os.path.join( shard_dir, Manifest.MANIFESTFILE )
+        if os.path.exists( fn ): Manifest.getManifest().merge( fn )
+
+        print "SphinxReport: merged %s: %i files, %i cache entries" % (shard_dir, nfiles, nentries)
 
 @timeit( "cleanTrackers" )
 def cleanTrackers( rst_files, options, args ):
-    '''instantiate trackers and get code.'''
+    '''remove output of trackers whose code has changed.
+
+    The code of trackers is hashed from the module files
+    without loading the modules or instantiating the trackers.
+    '''
     trackers = set()
     for f in rst_files:
         for lineno, b in getBlocksFromRstFile( f ):
             trackers.add(b.mArguments[0])
             
     ntested, ncleaned, nskipped = 0, 0, 0
+    modules = collections.defaultdict( set )
+    pathnames = {}
     for reference in trackers:
-
+        name, cls = os.path.splitext( reference )
         try:
-            code, tracker = report_directive.makeTracker( reference )
-        except AttributeError:
+            pathnames[reference] = Utils.getModulePath( name )
+        except (ImportError, NotImplementedError):
             # ignore missing trackers
             nskipped += 1
             continue
+        modules[pathnames[reference]].add( cls[1:] )
+
+    hashes = CodeDatabase().getHashes( modules, options.num_jobs )
 
-        new_codehash = hashlib.md5("".join(code)).hexdigest()
+    for reference, pathname in pathnames.iteritems():
+        name, cls = os.path.splitext( reference )
+        new_codehash = hashes[(pathname, cls[1:])]
         basedir, fname, basename, ext, outdir, codename = report_directive.buildPaths( reference )
         codefilename = os.path.join( outdir, codename )
         ntested += 1
@@ -273,7 +774,8 @@ def cleanTrackers( rst_files, options, args ):
             continue
         old_codehash = hashlib.md5("".join(open(codefilename, "r").readlines())).hexdigest()
         if new_codehash != old_codehash:
-            removed = clean.removeTracker( reference )
+            # cached data are invalidated by the code stamp, keep them
+            removed = clean.removeTracker( reference, keep_cache = True )
             removed.extend( clean.removeText( reference ))
             print "code has changed for %s: %i files removed" % (reference, len(removed))
             ncleaned += 1
@@ -308,11 +810,216 @@ def buildLog( options, args ):
     """
     runCommand( "%s" % " ".join(args) )
     
+def runWorkers( options ):
+    '''run :option:`--num-jobs` workers processing work
+    items from a job server.'''
+    address = JobServer.parseAddress( options.worker )
+    print "SphinxReport: starting %i workers for server at %s:%i" % ((options.num_jobs,) + address)
+    workers = [ Process( target = JobServer.runWorker, 
+                         args = (address, options.authkey, runTimed ) ) \
+                    for x in range( options.num_jobs ) ]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+
+def preloadWorker():
+    '''load plugins, tracker modules and the trackers used
+    in the report directives in the current directory.
+
+    Trackers with a database connection are connected.
+    '''
+    # plugins are loaded on first use, load them all
+    for plugins in getPlugins().values(): plugins.values()
+    references = set()
+    for f in indexDirectives( "." ):
+        for lineno, b in getBlocksFromRstFile( f ):
+            references.add( b.mArguments[0] )
+
+    for reference in sorted( references ):
+        try:
+            code, tracker = Utils.makeTracker( reference )
+            if hasattr( tracker, "connect" ): tracker.connect()
+        except Exception, msg:
+            warn( "build.preloadWorker: could not preload tracker %s: %s" % (reference, msg) )
+    info( "build.preloadWorker: preloaded %i trackers" % len(references) )
+
+def resetWorker():
+    '''prepare a persistent worker for a new build.
+
+    Parameters are read again, changed tracker modules are
+    reloaded, tracker stamps are recomputed and the manifest 
+    checks files again. Database
+    schemas are reflected again, connections are kept.
+    '''
+    Utils.getParameters()
+    Tracker.resetDatabases()
+    Cache.resetStamps()
+    changed = Utils.checkModules()
+    if changed:
+        info( "build.resetWorker: reloading modules %s" % ",".join( changed ) )
+    Manifest.getManifest().reset()
+
+def runDaemon( options ):
+    '''run a daemon with :option:`--num-jobs` persistent workers
+    that process work items of successive builds.'''
+    address = JobServer.parseAddress( options.daemon )
+    print "SphinxReport: starting daemon with %i workers at %s:%i" % ((options.num_jobs,) + address)
+    JobServer.runDaemon( address, options.authkey, runTimed, options.num_jobs,
+                         preload = preloadWorker, 
+                         reset = resetWorker )
+
+class Watcher:
+    '''watch restructured text files and tracker modules for changes.
+
+    A :term:`report` directive is affected by a change if its text
+    in a restructured text file is new or if the code of its tracker
+    (see :func:`Utils.getCode`) has changed.
+    '''
+
+    def __init__(self, sourcedir ):
+        self.sourcedir = sourcedir
+        # modification times of files
+        self.mtimes = {}
+        # directives in each rst file
+        self.blocks = {}
+        # code of trackers
+        self.codes = {}
+        self.update()
+
+    def getMTime( self, filename ):
+        try:
+            return os.path.getmtime( filename )
+        except OSError:
+            return None
+
+    def hasChanged( self, filename ):
+        '''return True if *filename* has changed since the last call.'''
+        mtime = self.getMTime( filename )
+        changed = self.mtimes.get( filename, None ) != mtime
+        self.mtimes[filename] = mtime
+        return changed
+
+    def getCode( self, reference ):
+        '''return code of tracker *reference* and the file it is in.'''
+        name, cls = os.path.splitext( reference )
+        try:
+            module, pathname = Utils.getModule( name )
+        except ImportError:
+            return None, None
+        return Utils.getCode( cls[1:], pathname ), pathname
+
+    def getFiles( self ):
+        '''return restructured text files in the source directory.'''
+        rst_files = []
+        for root, dirs, files in os.walk( self.sourcedir ):
+            rst_files.extend( [ os.path.join( root, f ) for f in files if f.endswith( Utils.getSourceSuffix() ) ] )
+        return rst_files
+
+    def getText( self, block ):
+        '''return text of *block* ignoring white space.'''
+        return "\n".join( [ x.strip() for x in block.mLines if x.strip() ] )
+
+    def touch( self, filename ):
+        '''mark *filename* as modified without it being detected 
+        as changed.'''
+        os.utime( filename, None )
+        self.mtimes[filename] = self.getMTime( filename )
+
+    def update( self ):
+        '''return directives affected by changes since the last call.
+
+        returns a list of tuples of rst file, line number and 
+        :class:`ReportBlock`.
+        '''
+        affected = []
+        rst_files = self.getFiles()
+        for f in set( self.blocks ).difference( rst_files ):
+            del self.blocks[f]
+
+        for f in rst_files:
+            if not self.hasChanged( f ): continue
+            old = set( [ self.getText( b ) for lineno, b in self.blocks.get( f, [] ) ] )
+            self.blocks[f] = getBlocksFromRstFile( f )
+            affected.extend( [ (f, lineno, b) for lineno, b in self.blocks[f] \
+                                   if self.getText( b ) not in old ] )
+
+        # only check trackers in modules that have changed
+        directives = collections.defaultdict( list )
+        for f, blocks in self.blocks.iteritems():
+            for lineno, b in blocks:
+                directives[b.mArguments[0]].append( (f, lineno, b) )
+
+        modules = {}
+        for reference in directives:
+            if reference in self.codes:
+                pathname = self.codes[reference][1]
+                if pathname not in modules: modules[pathname] = self.hasChanged( pathname )
+                if not modules[pathname]: continue
+            code, pathname = self.getCode( reference )
+            if pathname not in modules: modules[pathname] = self.hasChanged( pathname )
+            if reference in self.codes and self.codes[reference][0] != code:
+                debug( "build.Watcher: tracker %s has changed" % reference )
+                affected.extend( directives[reference] )
+            self.codes[reference] = (code, pathname)
+
+        # remove duplicates
+        result, seen = [], set()
+        for f, lineno, b in affected:
+            if (f, lineno) in seen: continue
+            seen.add( (f, lineno) )
+            result.append( (f, lineno, b) )
+        return result
+
+def watch( options, args, sourcedir, polltime = 1 ):
+    '''watch restructured text files and tracker modules
+    and re-render directives affected by changes.
+
+    Directives are rendered in this process, which keeps modules 
+    and trackers loaded between builds. The documents containing 
+    affected directives are then rebuilt by sphinx.
+    '''
+    root = logging.getLogger('')
+    handler = logging.FileHandler( os.path.abspath( LOGFILE ), "a" )
+    handler.setFormatter( logging.Formatter( LOGGING_FORMAT ) )
+    root.handlers = [ handler ]
+    root.setLevel( options.loglevel )
+
+    watcher = Watcher( sourcedir )
+    print "SphinxReport: watching %i documents for changes - press Ctrl-C to stop" % \
+        len( watcher.blocks )
+    
+    try:
+        while True:
+            time.sleep( polltime )
+            affected = watcher.update()
+            if not affected: continue
+
+            # reload changed modules
+            resetWorker()
+
+            print "SphinxReport: rendering %i changed directives" % len(affected)
+            errors = [ x for x in [ run( [ (f, lineno, b, sourcedir, ".") ] ) \
+                                        for f, lineno, b in affected ] if x ]
+            for exception_name, exception_value, exception_stack in errors:
+                print exception_stack,
+
+            # sphinx only reads documents that have changed
+            for f in set( [ x[0] for x in affected ] ):
+                watcher.touch( f )
+
+            buildDocument( options, args )
+    except KeyboardInterrupt:
+        pass
+
 def main():
 
     print "SphinxReport: version %s started" % str("$Id$")
     t = time.time()
 
+    # conf.py sets the source suffix and the path to the trackers
+    if not os.path.exists("conf.py"):
+        raise IOError( "could not find conf.py" )
+    Utils.getSphinxConfig()
+
     parser = optparse.OptionParser( version = "%prog version: $Id$", usage = USAGE )
 
     parser.add_option( "-a", "--num-jobs", dest="num_jobs", type="int",
@@ -321,13 +1028,75 @@ def main():
     parser.add_option( "-v", "--verbose", dest="loglevel", type="int",
                        help="loglevel. The higher, the more output [default=%default]" )
  
+    parser.add_option( "-p", "--prewarm", dest="prewarm", action="store_true",
+                       help="collect data for all directives before rendering [default=%default]" )
+
+    parser.add_option( "--serve", dest="serve", type="string",
+                       help="serve work items to workers at address host:port [default=%default]" )
+
+    parser.add_option( "--worker", dest="worker", type="string",
+                       help="run work items from the server at address host:port [default=%default]" )
+
+    parser.add_option( "--daemon", dest="daemon", type="string",
+                       help="run a daemon with persistent workers at address host:port [default=%default]" )
+
+    parser.add_option( "--connect", dest="connect", type="string",
+                       help="submit work items to the daemon at address host:port [default=%default]" )
+
+    parser.add_option( "--watch", dest="watch", action="store_true",
+                       help="after building, watch for changes and rebuild [default=%default]" )
+
+    parser.add_option( "--authkey", dest="authkey", type="string",
+                       help="authentication key for server and workers [default=%default]" )
+
+    parser.add_option( "--shard", dest="shard", type="string",
+                       help="only build shard i out of n shards given as i/n [default=%default]" )
+
+    parser.add_option( "--merge", dest="merge", type="string", action="append",
+                       help="merge output of sharded builds in directory before building [default=%default]" )
+
     parser.set_defaults( num_jobs = 2,
-                         loglevel = 10, )
+                         loglevel = 10, 
+                         prewarm = False,
+                         serve = None,
+                         worker = None,
+                         daemon = None,
+                         connect = None,
+                         watch = False,
+                         authkey = None,
+                         shard = None,
+                         merge = [] )
 
     parser.disable_interspersed_args()
     
     (options, args) = parser.parse_args()
 
+    # other hosts can connect to addresses other than localhost
+    for address in (options.serve, options.worker, options.daemon, options.connect):
+        if not address: continue
+        host, port = JobServer.parseAddress( address )
+        if JobServer.isLocal( host ): continue
+        if not options.authkey:
+            parser.error( "--authkey is required for address `%s`" % address )
+        if Cache.getJournalMode() == "WAL":
+            parser.error( "address `%s` requires journal_mode=DELETE in sphinxreport.ini, "
+                          "write-ahead logging does not work on network file systems" % address )
+    if not options.authkey: options.authkey = LOCAL_AUTHKEY
+
+    # directives of the same tracker might be computed by several
+    # processes at the same time, which claim the data they compute
+    if Cache.isConcurrent() and (options.num_jobs > 1 or options.shard or options.serve or \
+                                     options.worker or options.daemon or options.connect):
+        Cache.setShared()
+
+    if options.worker:
+        runWorkers( options )
+        return
+
+    if options.daemon:
+        runDaemon( options )
+        return
+
     assert args[0] == "sphinx-build", "command line should contain sphinx-build"
 
     sphinx_parser = optparse.OptionParser( version = "%prog version: $Id$", usage = USAGE )
@@ -357,7 +1126,16 @@ def main():
     
     rst_files = getDirectives( options, args, sourcedir )
 
-    cleanTrackers( rst_files, options, args )
+    if options.merge:
+        mergeShards( options.merge, options, args )
+
+    # shards might share the directory, outputs of trackers whose
+    # code has changed are removed by the unsharded or merging build
+    if not options.shard:
+        cleanTrackers( rst_files, options, args )
+
+    if options.prewarm:
+        buildCache( rst_files, options, args )
 
     buildPlots( rst_files, options, args, sourcedir )
 
@@ -365,7 +1143,12 @@ def main():
 
     # buildLog( options, args )
 
-    buildDocument( options, args )
+    # the document is built after merging all shards
+    if not options.shard:
+        buildDocument( options, args )
+
+    if options.watch:
+        watch( options, args, sourcedir )
 
     print "SphinxReport: finished in %i seconds" % (time.time() - t )
 
@@ -0,0 +1,68 @@
+'''test the merging of sharded builds.
+
+Two shards with caches and rendered files are created in a
+temporary directory and merged into it.
+'''
+
+import os, sys, tempfile, shutil, unittest
+
+from SphinxReport import Cache, Utils, Manifest, build
+
+class TestMergeShards( unittest.TestCase ):
+
+    def setUp( self ):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir( self.tmpdir )
+        self.params = Utils.PARAMS.copy()
+        Utils.PARAMS["report_cachedir"] = "_cache"
+        Manifest._manifest = None
+
+    def tearDown( self ):
+        Manifest._manifest = None
+        Utils.PARAMS.clear()
+        Utils.PARAMS.update( self.params )
+        os.chdir( self.cwd )
+        shutil.rmtree( self.tmpdir )
+
+    def writeShard( self, shard_dir, items, filename ):
+        d = os.path.join( shard_dir, "_static", "report_directive" )
+        os.makedirs( d )
+        open( os.path.join( d, filename ), "w" ).write( shard_dir )
+
+        Utils.PARAMS["report_cachedir"] = os.path.join( shard_dir, "_cache" )
+        for cache_name, values in items.iteritems():
+            cache = Cache.Cache( cache_name )
+            for key, value in values.iteritems(): cache[key] = value
+            cache.close()
+        Utils.PARAMS["report_cachedir"] = "_cache"
+
+    def testMerge( self ):
+        self.writeShard( "shard1", { "Trackers.A" : { "x" : 1, "y" : 2 },
+                                     "Trackers.B" : { "z" : 3 } }, "a.png" )
+        self.writeShard( "shard2", { "Trackers.A" : { "u" : 4 } }, "b.png" )
+
+        build.mergeShards( ["shard1", "shard2"], None, [] )
+
+        self.assertEqual( Cache.getCacheNames( "_cache" ), ["Trackers.A", "Trackers.B"] )
+        cache = Cache.Cache( "Trackers.A" )
+        self.assertEqual( sorted( cache.keys() ), ["u", "x", "y"] )
+        self.assertEqual( [ cache[x] for x in ("u", "x", "y") ], [4, 1, 2] )
+        cache.close()
+        cache = Cache.Cache( "Trackers.B" )
+        self.assertEqual( cache["z"], 3 )
+        cache.close()
+
+        self.assertEqual( sorted( os.listdir( os.path.join( "_static", "report_directive" ) ) ),
+                          ["a.png", "b.png"] )
+
+    def testMergeCurrentDirectory( self ):
+        # shards built in the current directory are not copied
+        self.writeShard( ".", { "Trackers.A" : { "x" : 1 } }, "a.png" )
+        build.mergeShards( ["."], None, [] )
+        cache = Cache.Cache( "Trackers.A" )
+        self.assertEqual( cache.keys(), ["x"] )
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/bin/env python
+
+"""
+sphinxreport-cache
+==================
+
+:command:`sphinxreport-cache` manages the SphinxReport cache
+in the directory ``report_cachedir``::
+
+   sphinxreport-cache [OPTIONS] command [Tracker1] [...]
+
+The full list of command line options is listed by suppling :option:`-h/--help`
+on the command line.
+
+The commands are:
+
+**list**
+   List for each :class:`Tracker` the number of cached entries, their
+   size, the disk usage and the counters for cache hits, misses, stale
+   entries, waits for other processes and evicted entries.
+
+**vacuum**
+   Reclaim unused space in the cache files and remove array files that
+   are not referenced by any entry.
+
+**evict**
+   Evict least recently used entries until the cache is below the
+   size given by :option:`-m/--max-size` or ``report_cache_maxsize``.
+
+**prewarm**
+   Collect data for all :term:`report` directives in the document and
+   store them in the cache. Data paths are collected in parallel
+   (see :option:`-a/--num-jobs`). If trackers are given, only directives
+   using these trackers are processed.
+
+Only caches using the ``sqlite`` backend are managed.
+
+The options are:
+
+**-v/--verbose** verbosity level
+   Increase the number of status messages displayed.
+
+**-m/--max-size** size
+   Maximum size of the cache in bytes for the ``evict`` command.
+
+**-p/--path** path
+   Path with restructured documents for the ``prewarm`` command.
+
+**-a/--num-jobs** number of jobs
+   Number of processes collecting data for the ``prewarm`` command.
+
+"""
+
+import sys, os, re, optparse
+
+USAGE = """python %s [OPTIONS] command [tracker] [...]
+
+manage the SphinxReport cache. Commands are list, vacuum, evict and prewarm.
+
+""" % sys.argv[0]
+
+from SphinxReport import Utils
+from SphinxReport import Cache
+from SphinxReport import DirectiveIndex
+
+COMMANDS = ("list", "vacuum", "evict", "prewarm")
+
+def selectCaches( cache_dir, patterns ):
+    '''return names of caches in *cache_dir* matching any of *patterns*.'''
+    names = Cache.getCacheNames( cache_dir )
+    if not patterns: return names
+    rx = [ re.compile( "%s$" % Utils.quote_filename( x ) ) for x in patterns ]
+    return [ x for x in names if [ r for r in rx if r.match( x ) ] ]
+
+def listCaches( cache_dir, names, outfile = sys.stdout ):
+    '''output usage statistics of caches *names*.'''
+    columns = ("hits", "misses", "stale", "waits", "evicted", "bytes_read", "bytes_written")
+    outfile.write( "\t".join( ("tracker", "entries", "size", "disk") + columns ) + "\n" )
+    totals = [0] * (3 + len(columns))
+    for name in names:
+        storage = Cache.SQLiteStorage( os.path.join( cache_dir, name ) )
+        try:
+            nitems, size = storage.getUsage()
+            stats = storage.getStats()
+        finally:
+            storage.close()
+        row = [ nitems, size, Cache.getDiskUsage( cache_dir, name ) ] + [ stats.get( x, 0 ) for x in columns ]
+        totals = [ x + y for x, y in zip( totals, row ) ]
+        outfile.write( "\t".join( [name] + map( str, row ) ) + "\n" )
+    outfile.write( "\t".join( ["total"] + map( str, totals ) ) + "\n" )
+
+def vacuumCaches( cache_dir, names ):
+    '''reclaim space in caches *names*.
+
+    returns the number of bytes freed.
+    '''
+    freed = 0
+    for name in names:
+        before = Cache.getDiskUsage( cache_dir, name )
+        storage = Cache.SQLiteStorage( os.path.join( cache_dir, name ) )
+        try:
+            storage.vacuum()
+        finally:
+            storage.close()
+        Cache.collectArrays( cache_dir, name, min_age = 0 )
+        freed += before - Cache.getDiskUsage( cache_dir, name )
+    return freed
+
+def prewarmCaches( path, trackers, num_jobs = 1 ):
+    '''collect data for all report directives in the restructured
+    text documents in *path* that use any of *trackers*.
+
+    returns the number of directives and data paths processed.
+    '''
+    from SphinxReport import build
+
+    rst_files = []
+    for root, dirs, files in os.walk( path ):
+        rst_files.extend( [ os.path.join( root, f ) for f in files if f.endswith( Utils.getSourceSuffix() ) ] )
+    DirectiveIndex.getIndex().update( rst_files, num_jobs )
+
+    ndirectives, npaths, errors = build.prewarm( rst_files, num_jobs, trackers )
+    for exception_name, exception_value, exception_stack in errors:
+        print exception_stack,
+    return ndirectives, npaths
+
+def main():
+
+    parser = optparse.OptionParser( version = "%prog version: $Id$", usage = USAGE )
+
+    parser.add_option( "-v", "--verbose", dest="loglevel", type="int",
+                       help="loglevel. The higher, the more output [default=%default]" )
+
+    parser.add_option( "-m", "--max-size", dest="maxsize", type="int",
+                       help="maximum size of the cache in bytes [default=%default]" )
+
+    parser.add_option( "-p", "--path", dest="path", type="string",
+                       help="path to rst source [default=%default]" )
+
+    parser.add_option( "-a", "--num-jobs", dest="num_jobs", type="int",
+                       help="number of parallel jobs for prewarm [default=%default]" )
+
+    parser.set_defaults(
+        loglevel = 2,
+        maxsize = None,
+        path = ".",
+        num_jobs = 1,
+        )
+
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0 or args[0] not in COMMANDS:
+        print USAGE
+        raise ValueError("please supply one of the commands %s." % ",".join(COMMANDS))
+
+    command, trackers = args[0], args[1:]
+    cache_dir = Utils.PARAMS.get( "report_cachedir", None )
+    if not cache_dir:
+        raise ValueError("no cache directory - please set report_cachedir.")
+
+    if command == "list":
+        listCaches( cache_dir, selectCaches( cache_dir, trackers ) )
+
+    elif command == "vacuum":
+        freed = vacuumCaches( cache_dir, selectCaches( cache_dir, trackers ) )
+        print "vacuum: %i bytes freed" % freed
+
+    elif command == "evict":
+        nevicted = Cache.evictCache( cache_dir, options.maxsize )
+        print "evict: %i entries evicted" % nevicted
+
+    elif command == "prewarm":
+        ndirectives, npaths = prewarmCaches( options.path, trackers, options.num_jobs )
+        print "prewarm: %i data paths of %i directives collected" % (npaths, ndirectives)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -60,19 +60,15 @@ Targets can contain wild cards.
 
 """ % sys.argv[0]
 
-from SphinxReport.Tracker import Tracker
+from SphinxReport import Utils, Manifest, DirectiveIndex
+from SphinxReport.Tracker import SCHEMAFILE
+from SphinxReport.Component import PLUGINSFILE
 
 SEPARATOR="@"
 
-# import conf.py for source_suffix
-if os.path.exists("conf.py"):
-    execfile( "conf.py" )
-else:
-    source_suffix = ".rst"
-
+# default directory with restructured text files, 
+# can be set by docsdir in conf.py
 RSTDIR = "."
-if "docsdir" in locals():
-    RSTDIR = docsdir
 
 def deleteFiles( test_f, dirs_to_check = (".",), dry_run = False ):
     """remove all files that test_f returns True for.
@@ -93,18 +89,25 @@ def deleteFiles( test_f, dirs_to_check = (".",), dry_run = False ):
 
 def removeTracker( tracker, 
                    dry_run = False,
-                   builddir = "report" ):
+                   builddir = "report",
+                   keep_cache = False ):
     """remove all files created by :class:Renderer objects
     that use tracker.
+
+    If *keep_cache* is set, the data cache is left in place.
+    Stale cache entries are detected and recomputed on lookup.
     """
     # get locations
     # this is a patch - add configuration options from conf.py
-    dirs_to_check = ("_static", "_cache", "_build", builddir )
+    if keep_cache:
+        dirs_to_check = ("_static", "_build", builddir )
+    else:
+        dirs_to_check = ("_static", "_cache", "_build", builddir )
 
     # image and text files
     rx1 = re.compile("-%s%s" % (tracker,SEPARATOR) )
-    # files in cache
-    rx2 = re.compile("-%s$" % (tracker) )
+    # files in cache (including sqlite write-ahead logs)
+    rx2 = re.compile("-%s(-wal|-shm)?$" % (tracker) )
     # .code files
     rx3 = re.compile("-%s%s" % (tracker,".code") )
     # .html files
@@ -112,31 +115,63 @@ def removeTracker( tracker,
 
     test_f = lambda x: rx1.search(x) or rx2.search(x) or rx3.search(x) or rx4.search(x)
 
-    return deleteFiles( test_f, dirs_to_check, dry_run = dry_run )
+    removed = deleteFiles( test_f, dirs_to_check, dry_run = dry_run )
+
+    # directories with memory-mapped arrays in cache
+    rx5 = re.compile("-%s[.]arrays$" % (tracker) )
+    for d in dirs_to_check:
+        for root, dirs, files in os.walk(d):
+            for x in [ os.path.join( root, x) for x in dirs if rx5.search(x) ]:
+                removed.extend( deleteFiles( lambda x: True, (x,), dry_run = dry_run ) )
+                if not dry_run: shutil.rmtree( x, ignore_errors = True )
+
+    removeFromManifest( tracker, dry_run = dry_run )
+
+    return removed
+
+def removeFromManifest( tracker, dry_run = False ):
+    """remove entries of directives using trackers matching
+    *tracker* from the build manifest.
+
+    returns the names of the trackers removed.
+    """
+    if not os.path.exists( Manifest.MANIFESTFILE ): return []
+    manifest = Manifest.Manifest()
+    rx = re.compile( tracker )
+    try:
+        removed = [ x for x in manifest.getTrackers() \
+                        if rx.search( x ) or rx.search( Utils.quote_filename( x ) ) ]
+        if not dry_run:
+            for x in removed: manifest.removeTracker( x )
+    finally:
+        manifest.close()
+    return removed
 
 def removeText( tracker, dry_run = False, sourcedir = ".", builddir = "report" ):
     """remove all files that reference the ``tracker``."""
 
-    # find all .rst files that reference tracker
+    # find all .rst files with directives that reference tracker
     nremoved = 0
     rx_tracker = re.compile( tracker )
-    files_to_check = []
+    rst_files = []
     for root, dirs, files in os.walk( sourcedir ):
         for f in files:
-            if f.endswith( source_suffix ):
-                fn = os.path.join( root, f )
-                try:
-                    found = rx_tracker.search( "".join(open(fn,"r").readlines()) )
-                except IOError:
-                    continue
+            if f.endswith( Utils.getSourceSuffix() ):
+                rst_files.append( os.path.join( root, f ) )
 
-                if found:
-                    files_to_check.append( f )
+    index = DirectiveIndex.getIndex()
+    index.update( rst_files )
+    files_to_check = []
+    for fn in rst_files:
+        for lineno, b in index.getBlocks( fn ):
+            if rx_tracker.search( b.mArguments[0] ):
+                files_to_check.append( os.path.basename( fn ) )
+                break
 
     suffixes = (".doctree", ".html" )
     patterns = []
     for f in files_to_check:
-        p = f[:-len(source_suffix)]
+        p = f[:-len(Utils.getSourceSuffix())]
         for s in suffixes:
             patterns.append( re.compile( "%s%s$" % (p, s ) ))
 
@@ -171,7 +206,7 @@ def main():
 
     parser.set_defaults( loglevel = 2,
                          dry_run = False,
-                         path = RSTDIR,
+                         path = Utils.getSphinxConfig().get( "docsdir", RSTDIR ),
                          builddir = ".",
                          sections = [] )
 
@@ -192,6 +227,12 @@ def main():
 
         if target in ("distclean",):
             dirs.append( "_static/report_directive" )
+            # rendered directives are recorded in the manifest
+            for x in ("", "-wal", "-shm"):
+                fn = Manifest.MANIFESTFILE + x
+                if os.path.exists( fn ) and not options.dry_run: os.remove( fn )
+            for fn in (DirectiveIndex.INDEXFILE, PLUGINSFILE, SCHEMAFILE):
+                if os.path.exists( fn ) and not options.dry_run: os.remove( fn )
 
         if options.dry_run:
             print "the following directories will be deleted:"
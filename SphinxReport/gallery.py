@@ -59,10 +59,6 @@ multiimage = re.compile('(.*)_\d\d')
 rootdir = '_static/report_directive'
 dest = '_templates/gallery.html'
 
-# create directory if not present
-if not os.path.exists(os.path.dirname( dest )):
-    os.makedirs( os.path.dirname( dest ))
-
 # number of columns in gallery
 columns = 5
 
@@ -86,6 +82,10 @@ basedir = '_build/html'
 
 def main( argv = sys.argv ):
 
+    # create directory if not present
+    if not os.path.exists(os.path.dirname( dest )):
+        os.makedirs( os.path.dirname( dest ))
+
     for root, dirs, files in os.walk(basedir):
         for f in files:
             if f.endswith( ".html" ):
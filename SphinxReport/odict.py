@@ -477,6 +477,21 @@ class OrderedDict(dict):
         from copy import deepcopy
         return self.__class__(deepcopy(self.items(), memo), self.strict)
 
+    def __reduce__(self):
+        """
+        To allow pickling with protocol 2 and higher. These set the
+        items before the instance has been initialised.
+        
+        >>> import cPickle
+        >>> a = OrderedDict([(1, 1), (2, 2), (3, 3)])
+        >>> b = cPickle.loads(cPickle.dumps(a, cPickle.HIGHEST_PROTOCOL))
+        >>> b == a
+        True
+        >>> b.keys()
+        [1, 2, 3]
+        """
+        return (self.__class__, (self.items(), self.strict))
+
 
 ### Read-only methods ###
 
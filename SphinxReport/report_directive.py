@@ -19,7 +19,7 @@ import traceback
 
 from docutils.parsers.rst import directives
 
-from SphinxReport import Config, Dispatcher, Utils, Cache
+from SphinxReport import Config, Dispatcher, Utils, Cache, Manifest
 from SphinxReport.ResultBlock import ResultBlock, ResultBlocks
 from SphinxReport.Component import *
 
@@ -184,45 +184,22 @@ def run(arguments,
         logging.debug( "report_directive.run: options_hash=%s" %  options_hash)
 
         ###########################################################
-        # check for existing files
-        # update strategy does not use file stamps, but checks
-        # for presence/absence of text element and if all figures
-        # mentioned in the text element are present
+        # check the manifest for an up-to-date entry. The
+        # rst text is inserted without touching the files.
         ###########################################################
-        #queries = [ re.compile( "%s(%s\S+.%s)" % ( root2builddir, outdir, suffix ) ) for suffix in ("png", "pdf") ]
-        ##### LIO-2011-09-16 : RAJOUT de guillemets autour de  root2builddir ci-dessus sinon bug "
-        queries = [ re.compile( "%s(%s\S+.%s)" % ( "root2builddir", outdir, suffix ) ) for suffix in ("png", "pdf") ]
-        logging.debug( "report_directive.run: checking for changed files." )
-
-        # check if text element exists
-        if os.path.exists( filename_text ):
-
-            lines = [ x[:-1] for x in open( filename_text, "r").readlines() ]
-            filenames = []
-
-            # check if all figures are present
-            for line in lines:
-                for query in queries:
-                    x = query.search( line )
-                    if x: filenames.extend( list( x.groups()) )
-
-            logging.debug( "report_directive.run: %s: checking for %s" % (tag, str(filenames)))
-            for filename in filenames:
-                if not os.path.exists( filename ):
-                    logging.info( "report_directive.run: %s: redo: %s missing" % (tag, filename ))
-                    break
-            else:
-                logging.info( "report_directive.run: %s: noredo: all files are present" % tag )
-                ## all is present - save text and return
-                if lines and state_machine:
-                    state_machine.insert_input(
-                        lines, state_machine.input_lines.source(0) )
-                return []
-        else:
-            logging.debug( "report_directive.run: %s: no check performed: %s missing" % (tag, str(filename_text)))
+        manifest_key = Manifest.getDirectiveKey( document, template_name, content )
+        lines = Manifest.getManifest().get( manifest_key )
+        if lines != None:
+            logging.info( "report_directive.run: %s: noredo: up-to-date in manifest" % tag )
+            if lines and state_machine:
+                state_machine.insert_input(
+                    lines, state_machine.input_lines.source(0) )
+            return []
+        logging.debug( "report_directive.run: %s: redo: no up-to-date entry in manifest" % tag )
     else:
         template_name = ""
         filename_text = None
+        manifest_key = None
       
     ##########################################################
     # Initialize collectors
@@ -333,6 +310,15 @@ def run(arguments,
         outfile.write("\n".join(lines) )
         outfile.close()
 
+    # record output in manifest, unless an exception was raised
+    if manifest_key and code != None:
+        queries = [ re.compile( r"(%s\S+\.%s)" % ( re.escape( outdir ), suffix ) ) for suffix in ("png", "pdf") ]
+        outputs = [ filename_text ]
+        for line in lines:
+            for query in queries:
+                outputs.extend( query.findall( line ) )
+        Manifest.getManifest().put( manifest_key, reference, lines, outputs )
+
     if SPHINXREPORT_DEBUG:
         for x, l in enumerate( lines): print "%5i %s" % (x, l)
 
@@ -371,6 +357,19 @@ def run(arguments,
 
 from docutils.parsers.rst import Directive
 
+class OptionSpec( object ):
+    '''option spec of the report directive.
+
+    The option spec is built when it is first requested, as 
+    building it loads all plugins.
+    '''
+    def __init__(self):
+        self.spec = None
+
+    def __get__( self, obj, cls ):
+        if self.spec == None: self.spec = getOptionSpec()
+        return self.spec
+
 class report_directive(Directive):
     required_arguments = 1
     optional_arguments = 0
@@ -378,7 +377,7 @@ class report_directive(Directive):
     final_argument_whitespace = True
 
     # build option spec
-    option_spec = getOptionSpec()
+    option_spec = OptionSpec()
 
     def run(self):
         document = self.state.document.current_source
@@ -403,8 +402,3 @@ def setup(app):
 
 directives.register_directive('report', report_directive)
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s %(message)s',
-    stream = open( LOGFILE, "a" ) )
-
@@ -1606,7 +1606,9 @@ class BoxPlot(Renderer, Plotter):
 
             for label, values in data.iteritems():
                 assert Utils.isArray( values ), "work is of type '%s'" % values
-                d = [ x for x in values if x != None ]
+                # numerical arrays contain no None and are used without copying
+                if Utils.isNumericArray( values ): d = values
+                else: d = [ x for x in values if x != None ]
                 if len(d) > 0:
                     all_data.append( d )
                     legend.append( "/".join( (str(line),str(label))))
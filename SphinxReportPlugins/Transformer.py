@@ -1,11 +1,11 @@
 from logging import warn, log, debug, info
-import itertools
+import itertools, collections
 import numpy
 from numpy import arange
 
 from SphinxReport.odict import OrderedDict as odict
 from SphinxReport.Component import *
-from SphinxReport import Stats, DataTree
+from SphinxReport import Stats, DataTree, Utils
 
 from docutils.parsers.rst import directives
 
@@ -25,6 +25,15 @@ class Transformer(Component):
 
         if self.nlevels == None: raise NotImplementedError("incomplete implementation of %s" % str(self))
 
+        # streams are passed to transformers working on the deepest
+        # dictionary, otherwise they are read completely.
+        streams, has_leaves = DataTree.getStreams( data )
+        if streams:
+            if self.nlevels == 1 and not has_leaves:
+                return self.transformStreams( data, streams )
+            debug( "transform: reading %i streams" % len(streams) )
+            DataTree.concatenateStreams( data )
+
         labels = DataTree.getPaths( data )        
         debug( "transform: started with paths: %s" % labels)
         assert len(labels) >= self.nlevels, "expected at least %i levels - got %i" % (self.nlevels, len(labels))
@@ -47,6 +56,26 @@ class Transformer(Component):
         debug( "transform: finished with paths: %s" % DataTree.getPaths( data ))
 
         return data
+
+    def transformStreams( self, data, streams ):
+        '''transform the *streams* in *data*.'''
+        for path, stream in streams:
+            new_data = self.transformStream( stream, path )
+            if new_data:
+                DataTree.setLeaf( data, path, new_data )
+            else:
+                warn( "no data at %s - removing branch" % str(path))
+                DataTree.removeLeaf( data, path )
+        return data
+
+    def transformStream( self, batches, path ):
+        '''transform a stream of *batches* at *path*.
+
+        Each batch is a dictionary of columns. Transformers that can
+        consume the batches one by one override this method. By default,
+        all batches are read and passed to :meth:`transform`.
+        '''
+        return self.transform( DataTree.concatenateBatches( batches ), path )
         
 class TransformerFilter( Transformer ):
     '''select columns in the deepest dictionary.
@@ -84,6 +113,10 @@ class TransformerFilter( Transformer ):
             
         return data
 
+    def transformStream(self, batches, path):
+        '''select columns in each batch.'''
+        return ( odict( [ (x,y) for x,y in batch.iteritems() if x in self.filter ] ) for batch in batches )
+
 ########################################################################
 ########################################################################
 ########################################################################
@@ -329,9 +362,40 @@ class TransformerStats( Transformer ):
     '''
     nlevels = 1
 
+    # maximum number of values used for median and quartiles of streams
+    sample_size = 100000
+
     def __init__(self,*args,**kwargs):
         Transformer.__init__( self, *args, **kwargs )
 
+    def transformStream(self, batches, path ):
+        '''compute summary statistics from a stream of batches.
+
+        See :class:`Stats.StreamSummary`.
+        '''
+        debug( "%s: called" % str(self))
+        summaries = odict()
+        failed = set()
+        for batch in batches:
+            for header, values in batch.iteritems():
+                if header in failed: continue
+                if header not in summaries: 
+                    summaries[header] = Stats.StreamSummary( self.sample_size )
+                try:
+                    summaries[header].add( values )
+                except TypeError:
+                    warn("%s: could not compute stats: expected an array of values for %s" % (str(self), header ) )
+                    failed.add( header )
+
+        data = odict()
+        for header, summary in summaries.iteritems():
+            if header in failed: continue
+            if summary.counts == 0: 
+                warn( "empty histogram for %s -removing" % header)
+                continue
+            data[header] = summary.getSummary()._data
+        return data
+
     def transform(self, data, path ):
         debug( "%s: called" % str(self))
         for header, values in data.iteritems():
@@ -480,7 +544,7 @@ class TransformerHistogram( Transformer ):
     def normalize_max( self, data ):
         """normalize a data vector by maximum.
         """
-        if data == None or len(data) == 0: return data
+        if data is None or len(data) == 0: return data
         m = max(data)
         data = data.astype( numpy.float )
         # numpy does not throw at division by zero, but sets values to Inf
@@ -488,7 +552,7 @@ class TransformerHistogram( Transformer ):
 
     def normalize_total( self, data ):
         """normalize a data vector by the total"""
-        if data == None or len(data) == 0: return data
+        if data is None or len(data) == 0: return data
         try:
             m = sum(data)
         except TypeError:
@@ -510,32 +574,75 @@ class TransformerHistogram( Transformer ):
             return [ (bins[x] - bins[x-1]) / 2.0 for x in range(1,len(bins)) ]
         elif self.mBbinMarker == "right": return bins[1:]
 
-    def toHistogram( self, data ):
-        '''compute the histogram.'''
-        ndata = [ x for x in data if x != None ]
-        nremoved = len(data) - len(ndata)
-        if nremoved:
-            warn( "removed %i None values" % nremoved )
-
-        data = ndata
-
-        if len(data) == 0: 
-            warn( "empty histogram" )
-            return None, None
-
-        binsize = None
+    def getRange( self ):
+        '''return minimum, maximum and bin size given by 
+        the ``tf-range`` option. 
 
+        Values that are not given are None.
+        '''
+        mi, ma, binsize = None, None, None
         if self.mRange != None: 
             vals = [ x.strip() for x in self.mRange.split(",") ]
             if len(vals) == 3: mi, ma, binsize = vals[0], vals[1], float(vals[2])
             elif len(vals) == 2: mi, ma, binsize = vals[0], vals[1], None
             elif len(vals) == 1: mi, ma, binsize = vals[0], None, None
-            if mi == None or mi == "": mi = min(data)
+            if mi == None or mi == "": mi = None
             else: mi = float(mi)
-            if ma == None or ma == "": ma = max(data)
+            if ma == None or ma == "": ma = None
             else: ma = float(ma)
+        return mi, ma, binsize
+
+    def getBins( self, mi, ma, binsize ):
+        '''return the bins for a histogram of values 
+        between *mi* and *ma*.'''
+        if self.mBins.startswith("log"):
+
+            try:
+                a,b = self.mBins.split( "-" )
+            except ValueError:
+                raise SyntaxError( "expected log-xxx, got %s" % self.mBins )
+            nbins = float(b)
+            if ma < 0 or mi < 0: raise ValueError( "can not bin logarithmically for negative values.")
+            if mi == 0: mi = numpy.MachAr().epsneg
+            ma = numpy.log10( ma )
+            mi = numpy.log10( mi )
+            try:
+                bins = [ 10 ** x for x in arange( mi, ma, ma / nbins ) ]
+            except ValueError, msg:
+                raise ValueError("can not compute %i bins for %f-%f: %s" % \
+                                     (nbins, mi, ma, msg ) )
+        elif binsize != None:
+            # make sure that ma is part of bins
+            bins = numpy.arange(mi, ma + binsize, binsize )
         else:
-            mi, ma= min( data ), max(data)
+            try:
+                bins = eval(self.mBins)
+            except SyntaxError, msg:
+                raise SyntaxError( "could not evaluate bins from `%s`, error=`%s`" \
+                                       % (self.mBins, msg))
+        return bins
+
+    def toHistogram( self, data ):
+        '''compute the histogram.
+
+        Numerical arrays, for example memory-mapped arrays from the
+        cache, are used without copying.
+        '''
+        if not Utils.isNumericArray( data ):
+            ndata = [ x for x in data if x != None ]
+            nremoved = len(data) - len(ndata)
+            if nremoved:
+                warn( "removed %i None values" % nremoved )
+
+            data = ndata
+
+        if len(data) == 0: 
+            warn( "empty histogram" )
+            return None, None
+
+        mi, ma, binsize = self.getRange()
+        if mi == None: mi = numpy.min(data)
+        if ma == None: ma = numpy.max(data)
 
         if self.mBins.startswith("dict"):
             h = collections.defaultdict( int )
@@ -545,33 +652,7 @@ class TransformerHistogram( Transformer ):
             for x in range(len(bin_edges)): hist[x] = h[bin_edges[x]]
             bin_edges.append( bin_edges[-1] + 1 )
         else:
-            if self.mBins.startswith("log"):
-
-                try:
-                    a,b = self.mBins.split( "-" )
-                except ValueError:
-                    raise SyntaxError( "expected log-xxx, got %s" % self.mBins )
-                nbins = float(b)
-                if ma < 0 or mi < 0: raise ValueError( "can not bin logarithmically for negative values.")
-                if mi == 0: mi = numpy.MachAr().epsneg
-                ma = numpy.log10( ma )
-                mi = numpy.log10( mi )
-                try:
-                    bins = [ 10 ** x for x in arange( mi, ma, ma / nbins ) ]
-                except ValueError, msg:
-                    raise ValueError("can not compute %i bins for %f-%f: %s" % \
-                                         (nbins, mi, ma, msg ) )
-            elif binsize != None:
-                # make sure that ma is part of bins
-                data.sort()
-                bins = numpy.arange(mi, ma + binsize, binsize )
-            else:
-                try:
-                    bins = eval(self.mBins)
-                except SyntaxError, msg:
-                    raise SyntaxError( "could not evaluate bins from `%s`, error=`%s`" \
-                                           % (self.mBins, msg))
-
+            bins = self.getBins( mi, ma, binsize )
 
             if hasattr( bins, "__iter__") and len(bins) == 0:
                 warn( "empty bins")
@@ -584,13 +665,54 @@ class TransformerHistogram( Transformer ):
         
         return self.binToX(bin_edges), hist
 
+    def transformStream(self, batches, path):
+        '''compute histograms from a stream of batches.
+
+        The batches are summed up if the bins are known in advance, 
+        that is if minimum and maximum are given by the ``tf-range`` 
+        option. Otherwise all batches are read first.
+        '''
+        mi, ma, binsize = self.getRange()
+        if mi == None or ma == None or self.mBins.startswith("dict"):
+            debug( "%s: range not given - reading stream completely" % str(self))
+            return Transformer.transformStream( self, batches, path )
+
+        debug( "%s: called" % str(self))
+        bins = self.getBins( mi, ma, binsize )
+        if hasattr( bins, "__iter__") and len(bins) == 0:
+            warn( "empty bins")
+            return None
+
+        hists, bin_edges, counts = odict(), None, collections.defaultdict( int )
+        for batch in batches:
+            for header, values in batch.iteritems():
+                if not Utils.isNumericArray( values ):
+                    values = [ x for x in values if x != None ]
+                counts[header] += len(values)
+                # ignore histogram semantics warning
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    hist, bin_edges = numpy.histogram( values, bins=bins, range=(mi,ma) )
+                if header in hists: hists[header] += hist
+                else: hists[header] = hist
+
+        data = odict()
+        for header, hist in hists.iteritems():
+            if counts[header] == 0:
+                warn( "empty histogram" )
+                continue
+            values = hist
+            for converter in self.mConverters: values = converter(values)
+            data[header] = odict( ((header, self.binToX(bin_edges)), ("frequency", values)))
+        return data
+
     def transform(self, data, path):
         debug( "%s: called" % str(self))
 
         to_delete = set()
         for header, values in data.iteritems():
             bins, values = self.toHistogram(values)
-            if bins != None:
+            if bins is not None:
                 for converter in self.mConverters: values = converter(values)
                 data[header] =  odict( ((header, bins), ("frequency", values)))
             else:
@@ -53,6 +53,7 @@ setup(name='SphinxReport',
             'sphinxreport-test = SphinxReport.test:main',
             'sphinxreport-quickstart = SphinxReport.quickstart:main',            
             'sphinxreport-get = SphinxReport.get:main',            
+            'sphinxreport-cache = SphinxReport.cachemanager:main',
             'sphinxreport-profile = SphinxReport.profile:main',
             'sphinxreport-serve = SphinxReport.serve:main',            
             ],